@@ -0,0 +1,62 @@
+"""
+Measures TimerConnection with 10,000 active timers: how long it takes to start them, to cancel
+half of them, and to fire the rest, and how many threads that takes. Run with:
+
+    python -m impbot.connections.bench_timer
+"""
+import datetime
+import queue
+import random
+import threading
+import time
+from typing import List
+
+from impbot.connections import timer
+from impbot.handlers import lambda_event
+
+TIMERS = 10_000
+SPREAD = datetime.timedelta(seconds=2)  # Timers come due at random times within this long.
+
+
+def main() -> None:
+    events: queue.Queue[lambda_event.LambdaEvent] = queue.Queue()
+    timer_conn = timer.TimerConnection()
+    threads_before = threading.active_count()
+    timer_thread = threading.Thread(target=timer_conn.run, args=(events.put,))
+    timer_thread.start()
+
+    lateness: List[datetime.timedelta] = []
+
+    def run(end_time: datetime.datetime) -> None:
+        lateness.append(datetime.datetime.now() - end_time)
+
+    start = time.perf_counter()
+    timers = []
+    for _ in range(TIMERS):
+        end_time = datetime.datetime.now() + SPREAD * random.random()
+        timers.append(timer_conn.start_once(end_time - datetime.datetime.now(),
+                                            lambda end_time=end_time: run(end_time)))
+    elapsed = time.perf_counter() - start
+    print(f'start {TIMERS:,} timers: {elapsed * 1e3:.1f}ms '
+          f'({elapsed / TIMERS * 1e6:.1f} µs/timer)')
+    print(f'threads for {TIMERS:,} timers: {threading.active_count() - threads_before}')
+
+    start = time.perf_counter()
+    for t in timers[::2]:
+        t.cancel()
+    elapsed = time.perf_counter() - start
+    print(f'cancel {TIMERS // 2:,} timers: {elapsed * 1e3:.1f}ms')
+
+    remaining = TIMERS - TIMERS // 2
+    while len(lateness) < remaining:
+        events.get().run()
+    worst = max(lateness).total_seconds() * 1e3
+    mean = sum(lateness, datetime.timedelta()).total_seconds() / remaining * 1e3
+    print(f'fire {remaining:,} timers: lateness mean {mean:.2f}ms, worst {worst:.2f}ms')
+
+    timer_conn.shutdown()
+    timer_thread.join()
+
+
+if __name__ == '__main__':
+    main()
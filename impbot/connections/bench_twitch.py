@@ -0,0 +1,85 @@
+"""
+Measures how fast TwitchChatConnection turns IRC events into TwitchMessages.
+
+A big raid can push a few hundred chat lines per second through the bot, almost all of them full of
+badges and emotes that no handler ever looks at. Run with:
+
+    python -m impbot.connections.bench_twitch
+"""
+import sqlite3
+import timeit
+from unittest import mock
+
+from irc import client
+
+from impbot.connections import twitch
+from impbot.core import data
+from impbot.util import user_cache
+
+TAGS = {
+    'badge-info': 'subscriber/14',
+    'badges': 'vip/1,subscriber/12,bits/1000',
+    'client-nonce': '0123456789abcdef0123456789abcdef',
+    'color': '#1E90FF',
+    'display-name': 'SomeRaider',
+    'emotes': '25:0-4,12-16,24-28/1902:6-10,18-22/305954156:30-37',
+    'first-msg': '0',
+    'flags': '',
+    'id': 'b34ccfc7-4977-403a-8a94-33c6bac34fb8',
+    'mod': '0',
+    'room-id': '1234',
+    'subscriber': '1',
+    'tmi-sent-ts': '1507246572675',
+    'turbo': '0',
+    'user-id': '5678',
+    'user-type': '',
+}
+TEXT = 'Kappa Keepo Kappa Keepo Kappa Keepo Kappa PogChamp raid hype'
+MESSAGES = 10_000
+REPEAT = 5
+
+
+def event(i: int) -> client.Event:
+    # Every message is from a different chatter, like in a raid, so each one is new to the user
+    # cache.
+    nick = f'raider{i}'
+    tags = dict(TAGS, **{'display-name': f'Raider{i}', 'user-id': str(i)})
+    return client.Event('pubmsg', client.NickMask(f'{nick}!{nick}@{nick}.tmi.twitch.tv'),
+                        '#streamer', [TEXT], [{'key': k, 'value': v} for k, v in tags.items()])
+
+
+def main() -> None:
+    # Every message also updates the user cache, which is saved in a database.
+    db = 'file:bench_twitch?mode=memory&cache=shared'
+    keep_db = sqlite3.connect(db, uri=True)  # An in-memory database lasts while it's connected.
+    data.startup(db)
+    # It holds MESSAGES users, so from the second round on, every message also evicts one.
+    users = user_cache.UserCache(max_size=MESSAGES)
+    util = mock.Mock(streamer_username='streamer', users=users)
+    conn = twitch.TwitchChatConnection('bot', 'token', util, admins=[])
+    # A different batch of chatters for every round.
+    rounds = iter([[event(n * MESSAGES + i) for i in range(MESSAGES)] for n in range(REPEAT * 2)])
+
+    def parse() -> None:
+        for e in next(rounds):
+            conn._message(e)
+
+    def parse_and_read() -> None:
+        for e in next(rounds):
+            message = conn._message(e)
+            message.emotes
+            message.user.is_subscriber
+
+    for name, func in [('parse only', parse), ('parse, read emotes & badges', parse_and_read)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print(f'{name}: {MESSAGES / seconds:,.0f} messages/s '
+              f'({seconds / MESSAGES * 1e6:.1f} µs/message)')
+    start = timeit.default_timer()
+    users.flush()
+    print(f'saving {len(users.users):,} users in the background: '
+          f'{(timeit.default_timer() - start) * 1e3:.0f}ms')
+    keep_db.close()
+
+
+if __name__ == '__main__':
+    main()
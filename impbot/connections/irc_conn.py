@@ -1,73 +1,191 @@
-import datetime
+import collections
 import logging
 import threading
 import time
-from typing import List, Optional
+from typing import Deque, Dict, List, Optional, Sequence, Set, Tuple, Union
 
+import attr
 from irc import client
 
 from impbot.core import base
+from impbot.util import backoff, metrics, ratelimit
 
-PING_TIMEOUT = datetime.timedelta(minutes=5, seconds=30)
+# Outgoing message priorities: lower numbers are sent first.
+PRIORITY_HIGH = 0  # For example, moderation commands.
+PRIORITY_NORMAL = 1
 
 logger = logging.getLogger(__name__)
 
 
 class IrcConnection(base.ChatConnection):
-    def __init__(self, host: str, port: int, nickname: str, channel: str,
-                 password: Optional[str] = None, capabilities: Optional[List[str]] = None) -> None:
+    def __init__(self, host: str, port: int, nickname: str, channel: Union[str, Sequence[str]],
+                 password: Optional[str] = None, capabilities: Optional[List[str]] = None,
+                 rate_limit: Optional[ratelimit.TokenBucket] = None,
+                 keepalive_interval: float = 60.0, pong_timeout: float = 10.0,
+                 join_rate_limit: Optional[ratelimit.TokenBucket] = None,
+                 connection_rate_limit: Optional[Tuple[float, float]] = None,
+                 send_pool_size: int = 0, send_only: bool = False) -> None:
+        """
+        `channel` can be a list of channels to join, in which case the first is the primary channel:
+        say() sends there, and messages from the others are tagged with Message.channel and reply
+        via for_channel(). Joins are throttled to `join_rate_limit`.
+
+        Outgoing messages are queued and sent from a separate thread. If `rate_limit` is provided,
+        each message spends one token from it. If `connection_rate_limit` (capacity, rate) is
+        provided, each connection also gets a TokenBucket of its own, for servers that throttle
+        each connection separately.
+
+        With `send_pool_size`, that many extra send-only connections (which don't join any
+        channels) send from the same queue as this one, each with its own sender thread. Whichever
+        connection has the budget to send next takes the next message, so with a per-connection
+        rate limit, the pool multiplies how much can be sent; `rate_limit` still caps the total.
+        Each target's messages are handed out one at a time, in order, but if consecutive ones go
+        over different connections and one of them lags, the server could see them out of order.
+
+        If nothing arrives from the server for `keepalive_interval` seconds, we PING it, and if
+        nothing arrives within `pong_timeout` seconds after that, we assume the connection is dead
+        and reconnect.
+        """
         super().__init__()
         self.host = host
         self.port = port
         self.nickname = nickname
-        self.channel = channel
+        self.channels = [channel] if isinstance(channel, str) else list(channel)
+        self.channel = self.channels[0]
+        self.to_join: List[str] = []
+        self.join_rate_limit = join_rate_limit
+        self.channel_views: Dict[str, ChannelView] = {}
         self.password = password
         self.capabilities = capabilities if capabilities is not None else []
         self.shutdown_event = threading.Event()
         self.expect_disconnection = threading.Event()
-        self.last_ping = datetime.datetime.now()
+        self.welcomed = threading.Event()
+        self.outbound = OutboundQueue(rate_limit)
+        self.connection_rate_limit = (ratelimit.TokenBucket(*connection_rate_limit)
+                                      if connection_rate_limit else None)
+        self.sender_thread = threading.Thread(
+            name=f'{type(self).__name__} sender', target=self.send_forever)
+        self.send_only = send_only
+        self.send_pool = [
+            IrcConnection(host, port, nickname, channel, password, capabilities,
+                          keepalive_interval=keepalive_interval, pong_timeout=pong_timeout,
+                          connection_rate_limit=connection_rate_limit, send_only=True)
+            for _ in range(send_pool_size)]
+        for pooled in self.send_pool:
+            pooled.outbound = self.outbound
+        self.keepalive_interval = keepalive_interval
+        self.pong_timeout = pong_timeout
+        self.backoff = backoff.ExponentialBackoff(base=1.0, cap=60.0)
+        self.last_received = time.monotonic()
+        self.ping_sent: Optional[float] = None  # When we sent a PING that hasn't been answered.
+        self.disconnected_at: Optional[float] = None
         self.on_event: Optional[base.EventCallback] = None
         self.reactor = client.Reactor()
+        self.connection = self.reactor.server()
+        self.reactor.add_global_handler('all_raw_messages', self.on_raw_message)
         self.reactor.add_global_handler('welcome', self.on_welcome)
+        self.reactor.add_global_handler('disconnect', self.on_disconnect)
         self.reactor.add_global_handler('pubmsg', self.on_pubmsg)
         self.reactor.add_global_handler('action', self.on_action)
-        self.reactor.add_global_handler('ping', self.on_ping)
+        self.reactor.scheduler.execute_every(min(1.0, pong_timeout / 2), self.check_keepalive)
 
     # bot.Connection overrides:
 
     def say(self, text: str) -> None:
-        self.connection.privmsg(self.channel, text)
+        self.send(self.channel, text, PRIORITY_NORMAL)
 
     def run(self, on_event: base.EventCallback) -> None:
         self.on_event = on_event
+        for i, pooled in enumerate(self.send_pool):
+            threading.Thread(name=f'{type(self).__name__} send pool {i}', target=pooled.run,
+                             args=(on_event,)).start()
+        self.sender_thread.start()
+        self.connect()
+        # Reconnecting and keepalives are scheduled on the reactor, so this is all there is to do.
         while not self.shutdown_event.is_set():
-            logger.info('Connecting...')
-            self.last_ping = datetime.datetime.now()
-            self.connection = self.reactor.server().connect(
-                self.host, self.port, self.nickname, self.password)
-
-            # We run this loop ourselves, instead of calling reactor.process_forever(), so that we
-            # can time out when we haven't gotten a ping.
-            # TODO: See if scheduler.execute_every() would work instead.
-            while self.connection.connected:
-                self.reactor.process_once(0.2)
-                if datetime.datetime.now() - self.last_ping > PING_TIMEOUT:
-                    logger.info(f'{datetime.datetime.now() - self.last_ping} since last ping; '
-                                f'reconnecting.')
-                    self.disconnect()
-            logger.info('Disconnected.')
-            if not self.expect_disconnection.is_set():
-                time.sleep(3)  # It's, uh, exponential backoff with a base of 1.
-            self.expect_disconnection.clear()
+            self.reactor.process_once(timeout=0.2)
 
     def shutdown(self) -> None:
         self.shutdown_event.set()
+        self.outbound.close()
         self.disconnect()
+        if self.sender_thread.is_alive():
+            self.sender_thread.join()
+        for pooled in self.send_pool:
+            pooled.shutdown()
 
     def disconnect(self) -> None:
+        """Disconnects on purpose: unless we're shutting down, this reconnects right away."""
         self.expect_disconnection.set()
-        if self.connection.connected:
-            self.connection.close()
+        if self.connection.is_connected():
+            self.connection.disconnect()
+
+    def connect(self) -> None:
+        if self.shutdown_event.is_set():
+            return
+        logger.info('Connecting...')
+        self.last_received = time.monotonic()
+        self.ping_sent = None
+        try:
+            self.connection.connect(self.host, self.port, self.nickname, self.password)
+        except client.ServerConnectionError:
+            delay = self.backoff.next_delay()
+            logger.exception('Connection failed; retrying in %.1fs.', delay)
+            self.reactor.scheduler.execute_after(delay, self.connect)
+
+    def check_keepalive(self) -> None:
+        if not self.connection.is_connected():
+            return
+        now = time.monotonic()
+        if self.ping_sent is not None:
+            if now - self.ping_sent > self.pong_timeout:
+                logger.info('No response to PING after %.1fs; reconnecting.', now - self.ping_sent)
+                metrics.counter('irc.keepalive_timeouts').inc()
+                # Not self.disconnect(): this wasn't on purpose, so back off before reconnecting.
+                self.connection.disconnect()
+        elif now - self.last_received > self.keepalive_interval:
+            self.ping_sent = now
+            self.connection.ping(self.host)
+
+    def for_channel(self, channel: Optional[str]) -> base.ChatConnection:
+        """
+        The connection to reply to messages from `channel` with: this one for the primary channel
+        (or None), or otherwise a ChannelView that sends to `channel` through this one.
+        """
+        if channel is None or channel == self.channel:
+            return self
+        if channel not in self.channel_views:
+            self.channel_views[channel] = self._channel_view(channel)
+        return self.channel_views[channel]
+
+    def _channel_view(self, channel: str) -> 'ChannelView':
+        # Subclasses with more to send than say() override this to return their own kind of view.
+        return ChannelView(self, channel)
+
+    def send(self, target: str, text: str, priority: int) -> None:
+        """
+        Queues a PRIVMSG to send as soon as the rate limit allows, after any other pending messages
+        of the same or higher priority.
+        """
+        self.outbound.put(target, text, priority)
+
+    def send_forever(self) -> None:
+        while not self.shutdown_event.is_set():
+            if not self.welcomed.wait(timeout=1):
+                continue
+            message = self.outbound.get(self.connection_rate_limit, exclusive=True)
+            if message is None:
+                return  # Shutting down.
+            try:
+                self.connection.privmsg(message.target, message.text)
+            except client.ServerNotConnectedError:
+                logger.error('Disconnected, dropped message to %s: %s', message.target,
+                             message.text)
+                continue
+            finally:
+                self.outbound.done(message)
+            metrics.timing('irc.outbound.queue_delay').observe(
+                time.monotonic() - message.enqueued)
 
     # IRC handlers:
 
@@ -75,7 +193,42 @@ class IrcConnection(base.ChatConnection):
         if self.capabilities:
             connection.cap('REQ', *self.capabilities)
             connection.cap('END')
-        connection.join(self.channel)
+        if not self.send_only:
+            self.to_join = list(self.channels)
+            self.join_pending()
+        self.backoff.reset()
+        if self.disconnected_at is not None:
+            metrics.timing('irc.reconnect_time').observe(time.monotonic() - self.disconnected_at)
+            self.disconnected_at = None
+        self.welcomed.set()
+
+    def on_disconnect(self, _: client.ServerConnection, event: client.Event) -> None:
+        self.welcomed.clear()
+        if self.shutdown_event.is_set():
+            return
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+        metrics.counter('irc.disconnects').inc()
+        if self.expect_disconnection.is_set():
+            self.expect_disconnection.clear()
+            delay = 0.0
+        else:
+            delay = self.backoff.next_delay()
+        logger.info('Disconnected (%s); reconnecting in %.1fs.', event.arguments[0], delay)
+        self.reactor.scheduler.execute_after(delay, self.connect)
+
+    def join_pending(self) -> None:
+        while self.to_join and self.connection.is_connected():
+            wait = self.join_rate_limit.try_acquire() if self.join_rate_limit else 0.0
+            if wait:
+                self.reactor.scheduler.execute_after(wait, self.join_pending)
+                return
+            self.connection.join(self.to_join.pop(0))
+
+    def on_raw_message(self, _conn: client.ServerConnection, _event: client.Event) -> None:
+        # Anything at all from the server, not just a PONG, shows that the connection is alive.
+        self.last_received = time.monotonic()
+        self.ping_sent = None
 
     def on_pubmsg(self, _: client.ServerConnection, event: client.Event) -> None:
         self.on_event(self._message(event))
@@ -83,15 +236,148 @@ class IrcConnection(base.ChatConnection):
     def on_action(self, _: client.ServerConnection, event: client.Event) -> None:
         self.on_event(self._action(event))
 
-    def on_ping(self, _conn: client.ServerConnection, _event: client.Event) -> None:
-        self.last_ping = datetime.datetime.now()
-
     # Hook for subclasses to override:
 
     def _message(self, event: client.Event) -> base.Message:
         user = base.User(event.source.nick)
-        return base.Message(self, user, event.arguments[0])
+        channel = self._channel(event)
+        return base.Message(self.for_channel(channel), user, event.arguments[0], channel=channel)
+
+    def _channel(self, event: client.Event) -> Optional[str]:
+        # The value for Message.channel.
+        return event.target if event.target != self.channels[0] else None
 
     def _action(self, event: client.Event) -> base.Message:
         # By default, actions look just like messages with the same text.
         return self._message(event)
+
+
+class ChannelView(base.ChatConnection):
+    """
+    Sends to one of an IrcConnection's other channels. It's only for sending: the IrcConnection
+    runs the actual IRC connection, so run() and shutdown() do nothing.
+    """
+
+    def __init__(self, parent: IrcConnection, channel: str) -> None:
+        self.parent = parent
+        self.channel = channel
+
+    def say(self, text: str) -> None:
+        self.send(self.channel, text, PRIORITY_NORMAL)
+
+    def send(self, target: str, text: str, priority: int) -> None:
+        self.parent.send(target, text, priority)
+
+    def run(self, on_event: base.EventCallback) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class OutgoingMessage:
+    target: str
+    text: str
+    enqueued: float  # time.monotonic() when it was queued.
+
+
+class OutboundQueue:
+    """
+    Messages waiting to be sent. Each priority has its own FIFO lane, and the highest-priority lane
+    that has anything in it always goes first.
+
+    A message identical to one that's still waiting is dropped. If duplicate_window is set, so is a
+    message identical to the last one sent to the same target less than that many seconds ago.
+    (Twitch silently drops those from non-moderators anyway.)
+
+    Several senders can take messages from the same queue. rate_limit is shared by all of them.
+    """
+
+    def __init__(self, rate_limit: Optional[ratelimit.TokenBucket] = None,
+                 duplicate_window: Optional[float] = None) -> None:
+        self.rate_limit = rate_limit
+        self.duplicate_window = duplicate_window
+        self.cond = threading.Condition()
+        self.lanes: Dict[int, Deque[OutgoingMessage]] = {}
+        self.pending: Dict[Tuple[str, str], int] = collections.Counter()
+        self.last_sent: Dict[str, Tuple[str, float]] = {}  # Target -> text, time.monotonic().
+        self.in_flight: Set[str] = set()  # Targets of messages taken with exclusive=True.
+        self.closed = False
+
+    def put(self, target: str, text: str, priority: int = PRIORITY_NORMAL) -> bool:
+        """Returns False if the message was dropped as a duplicate."""
+        now = time.monotonic()
+        with self.cond:
+            if self.pending[(target, text)] or self._recently_sent(target, text, now):
+                metrics.counter('irc.outbound.duplicates_dropped').inc()
+                logger.info('Dropping duplicate message to %s: %s', target, text)
+                return False
+            self.lanes.setdefault(priority, collections.deque()).append(
+                OutgoingMessage(target, text, now))
+            self.pending[(target, text)] += 1
+            self.cond.notify_all()
+            return True
+
+    def _recently_sent(self, target: str, text: str, now: float) -> bool:
+        if self.duplicate_window is None or target not in self.last_sent:
+            return False
+        last_text, last_time = self.last_sent[target]
+        return last_text == text and now - last_time < self.duplicate_window
+
+    def get(self, sender_rate_limit: Optional[ratelimit.TokenBucket] = None,
+            exclusive: bool = False) -> Optional[OutgoingMessage]:
+        """
+        Blocks until there's a message to send and the rate limits (the queue's, and the sender's
+        own if given) allow sending it, then returns it. Returns None once the queue is closed.
+
+        With exclusive, no one gets another message to the same target until done() is called for
+        this one, so that several senders still send each target's messages one at a time, in order.
+        """
+        with self.cond:
+            while not self.closed:
+                lane, message = self._next()
+                if message is None:
+                    self.cond.wait()
+                    continue
+                buckets = [b for b in (self.rate_limit, sender_rate_limit) if b is not None]
+                wait = max((b.peek() for b in buckets), default=0.0)
+                if wait:
+                    # Wait without holding the lock, then start over -- something with a higher
+                    # priority might have come in in the meantime.
+                    self.cond.wait(wait)
+                    continue
+                for bucket in buckets:
+                    bucket.try_acquire()
+                lane.remove(message)
+                if exclusive:
+                    self.in_flight.add(message.target)
+                key = (message.target, message.text)
+                self.pending[key] -= 1
+                if not self.pending[key]:
+                    # Otherwise every distinct message would stay in here forever.
+                    del self.pending[key]
+                self.last_sent[message.target] = (message.text, time.monotonic())
+                metrics.gauge('irc.outbound.pending').set(sum(len(l) for l in self.lanes.values()))
+                return message
+            return None
+
+    def _next(self) -> Tuple[Optional[Deque[OutgoingMessage]], Optional[OutgoingMessage]]:
+        # The first message in the highest-priority lane that isn't waiting on another one to the
+        # same target. Call this with self.cond held.
+        for priority in sorted(self.lanes):
+            for message in self.lanes[priority]:
+                if message.target not in self.in_flight:
+                    return self.lanes[priority], message
+        return None, None
+
+    def done(self, message: OutgoingMessage) -> None:
+        """Call this once a message taken with get(exclusive=True) is sent (or dropped)."""
+        with self.cond:
+            self.in_flight.discard(message.target)
+            self.cond.notify_all()
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
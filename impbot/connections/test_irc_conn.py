@@ -0,0 +1,222 @@
+import socketserver
+import threading
+import time
+import unittest
+from unittest import mock
+
+from impbot.connections import irc_conn
+from impbot.util import backoff, ratelimit
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def test_priority(self):
+        queue = irc_conn.OutboundQueue()
+        queue.put('#channel', 'hello', irc_conn.PRIORITY_NORMAL)
+        queue.put('#channel', '.timeout spammer 600', irc_conn.PRIORITY_HIGH)
+        queue.put('#channel', 'world', irc_conn.PRIORITY_NORMAL)
+        self.assertEqual([queue.get().text for _ in range(3)],
+                         ['.timeout spammer 600', 'hello', 'world'])
+
+    def test_pending_duplicate(self):
+        queue = irc_conn.OutboundQueue()
+        self.assertTrue(queue.put('#channel', 'hello'))
+        self.assertFalse(queue.put('#channel', 'hello'))
+        self.assertTrue(queue.put('#other', 'hello'))
+        self.assertEqual(queue.get().target, '#channel')
+        self.assertEqual(queue.get().target, '#other')
+        # Once it's been sent, it's no longer pending.
+        self.assertTrue(queue.put('#channel', 'hello'))
+
+    def test_pending_drains(self):
+        queue = irc_conn.OutboundQueue()
+        for i in range(100):
+            queue.put('#channel', f'message {i}')
+        for _ in range(100):
+            queue.get()
+        self.assertEqual(queue.pending, {})
+
+    def test_duplicate_window(self):
+        queue = irc_conn.OutboundQueue(duplicate_window=30)
+        queue.put('#channel', 'hello')
+        queue.get()
+        self.assertFalse(queue.put('#channel', 'hello'))
+        self.assertTrue(queue.put('#channel', 'world'))
+
+    def test_rate_limit(self):
+        bucket = ratelimit.TokenBucket(capacity=1, rate=20)
+        queue = irc_conn.OutboundQueue(bucket)
+        queue.put('#channel', 'one')
+        queue.put('#channel', 'two')
+        queue.get()
+        self.assertGreater(bucket.try_acquire(), 0)
+        # The second message has to wait for the bucket to refill (about 50ms).
+        self.assertEqual(queue.get().text, 'two')
+
+    def test_sender_rate_limit(self):
+        shared = ratelimit.TokenBucket(capacity=10, rate=1)
+        sender = ratelimit.TokenBucket(capacity=1, rate=20)
+        queue = irc_conn.OutboundQueue(shared)
+        queue.put('#channel', 'one')
+        queue.put('#channel', 'two')
+        queue.get(sender)
+        self.assertGreater(sender.peek(), 0)
+        # The second message has to wait for the sender's bucket to refill (about 50ms).
+        self.assertEqual(queue.get(sender).text, 'two')
+        # Both messages count against the shared bucket, too.
+        self.assertEqual(shared.tokens // 1, 8)
+
+    def test_exclusive(self):
+        queue = irc_conn.OutboundQueue()
+        queue.put('#channel', 'one')
+        queue.put('#channel', 'two')
+        queue.put('#other', 'hello')
+        first = queue.get(exclusive=True)
+        self.assertEqual(first.text, 'one')
+        # '#channel' is taken until the first message is done, so '#other' goes ahead of 'two'.
+        self.assertEqual(queue.get(exclusive=True).text, 'hello')
+        queue.done(first)
+        self.assertEqual(queue.get(exclusive=True).text, 'two')
+
+    def test_close(self):
+        queue = irc_conn.OutboundQueue()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(queue.get()))
+        thread.start()
+        queue.close()
+        thread.join(timeout=5)
+        self.assertEqual(results, [None])
+
+
+class FakeIrcHandler(socketserver.StreamRequestHandler):
+    server: 'FakeIrcServer'
+
+    def handle(self) -> None:
+        self.server.connections += 1
+        connection = self.server.connections
+        for line in self.rfile:
+            command, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            if command == 'QUIT' or self.server.hang_up:
+                return
+            elif command == 'NICK':
+                self.wfile.write(f':irc.example.com 001 {rest} :Welcome\r\n'.encode())
+            elif command == 'PING' and self.server.pong:
+                self.wfile.write(f':irc.example.com PONG irc.example.com {rest}\r\n'.encode())
+            elif command in ('JOIN', 'PRIVMSG'):
+                self.server.received.append((connection, command, rest))
+
+
+class FakeIrcServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeIrcHandler)
+        self.connections = 0
+        self.pong = True
+        self.hang_up = False
+        self.received = []
+
+
+class KeepaliveTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIrcServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.conn = irc_conn.IrcConnection(
+            '127.0.0.1', self.server.server_address[1], 'bot', '#channel',
+            keepalive_interval=0.1, pong_timeout=0.2)
+        self.conn.backoff = backoff.ExponentialBackoff(base=0.01, cap=0.05)
+        self.thread = threading.Thread(target=self.conn.run, args=(mock.Mock(),))
+        self.thread.start()
+        self.assertTrue(self.conn.welcomed.wait(timeout=5))
+
+    def tearDown(self):
+        self.conn.shutdown()
+        self.thread.join()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for_connections(self, n: int) -> None:
+        deadline = time.monotonic() + 5
+        while self.server.connections < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(self.server.connections, n)
+
+    def test_healthy(self):
+        time.sleep(1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_no_pong(self):
+        self.server.pong = False
+        self.wait_for_connections(2)
+
+    def test_server_hangs_up(self):
+        self.server.hang_up = True
+        self.wait_for_connections(2)
+
+
+class SendPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIrcServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.conns = []
+
+    def tearDown(self):
+        for conn, thread in self.conns:
+            conn.shutdown()
+            thread.join()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start(self, **kwargs) -> irc_conn.IrcConnection:
+        conn = irc_conn.IrcConnection(
+            '127.0.0.1', self.server.server_address[1], 'bot', '#channel', **kwargs)
+        thread = threading.Thread(target=conn.run, args=(mock.Mock(),))
+        thread.start()
+        self.conns.append((conn, thread))
+        for c in [conn] + conn.send_pool:
+            self.assertTrue(c.welcomed.wait(timeout=5))
+        return conn
+
+    def privmsgs(self):
+        return [(conn, rest) for conn, command, rest in self.server.received
+                if command == 'PRIVMSG']
+
+    def test_send_pool(self):
+        # Each connection can send 10 messages right away, and then hardly any more.
+        conn = self.start(send_pool_size=2, connection_rate_limit=(10, 0.001))
+        targets = [f'#target{i}' for i in range(10)]
+        for i in range(3):
+            for target in targets:
+                conn.send(target, f'message {i}', irc_conn.PRIORITY_NORMAL)
+        deadline = time.monotonic() + 5
+        while len(self.privmsgs()) < 30 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Only the main connection joins the channel.
+        joins = [rest for _, command, rest in self.server.received if command == 'JOIN']
+        self.assertEqual(joins, ['#channel'])
+        by_conn = {}
+        for c, rest in self.privmsgs():
+            target, _, text = rest.partition(' :')
+            by_conn.setdefault(c, []).append((target, text))
+        # It takes all three connections to send them all.
+        self.assertEqual([len(messages) for messages in by_conn.values()], [10, 10, 10])
+        self.assertCountEqual(
+            [message for messages in by_conn.values() for message in messages],
+            [(target, f'message {i}') for i in range(3) for target in targets])
+        # Each connection still sends each target's messages in order.
+        for messages in by_conn.values():
+            for target in targets:
+                texts = [text for t, text in messages if t == target]
+                self.assertEqual(texts, sorted(texts))
+
+    def test_more_per_window(self):
+        sent = []
+        for send_pool_size in (0, 2):
+            self.server.received.clear()
+            conn = self.start(send_pool_size=send_pool_size, connection_rate_limit=(3, 0.001))
+            for i in range(20):
+                conn.send('#channel', f'message {i}', irc_conn.PRIORITY_NORMAL)
+            time.sleep(0.5)
+            sent.append(len(self.privmsgs()))
+            conn.shutdown()
+        self.assertEqual(sent, [3, 9])
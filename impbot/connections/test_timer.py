@@ -2,43 +2,20 @@ import datetime
 import queue
 import threading
 import unittest
-from typing import Optional, Union, cast
+from typing import List, Optional, Union, cast
 from unittest import mock
 
-import freezegun
-
 from impbot.connections import timer
 from impbot.core import bot
 from impbot.handlers import lambda_event
+from impbot.util import tests_util
 
-
-class MockThreadingTimer(threading.Timer):
-    def __init__(self, queue, time, interval, *args, **kwargs):
-        super().__init__(interval, *args, **kwargs)
-        self.queue = queue
-        self.time = time
-        self.end_time = time() + datetime.timedelta(interval)
-
-    def run(self):
-        # RepeatingTimer schedules new lambdas on time, without waiting for the run function to
-        # complete. When we mock out the actual delay for unit testing, that's basically running in
-        # a tight loop, so lambdas stack up faster than they get executed. (Where that actually
-        # turns into a problem is, the end_time overflows the maximum date, which is very funny.) We
-        # join the queue here to block until the last timer execution has completed before we start
-        # the next one.
-        self.queue.join()
-        if self.end_time > self.time():
-            self.time.move_to(self.end_time)
-        if not self.finished.is_set():
-            self.function(*self.args, **self.kwargs)
-        self.finished.set()
+# Short enough to keep the tests fast, long enough to be ordered reliably.
+TICK = datetime.timedelta(milliseconds=20)
 
 
 class TestTimer(unittest.TestCase):
     def setUp(self):
-        start_time = datetime.datetime(2020, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
-        self._freeze_time = freezegun.freeze_time(start_time)
-        self.time = self._freeze_time.start()
         self.queue: queue.Queue[Union[lambda_event.LambdaEvent, bot.Shutdown]] = queue.Queue()
         self.timer: Optional[timer.Timer] = None
         self.counter = 0
@@ -56,11 +33,6 @@ class TestTimer(unittest.TestCase):
         self.timer_thread.join()
         self.event_thread.join()
 
-        self._freeze_time.stop()
-
-    def new_mock_timer(self, *args, **kwargs):
-        return MockThreadingTimer(self.queue, self.time, *args, **kwargs)
-
     def run_event_thread(self):
         while True:
             event = self.queue.get()
@@ -72,11 +44,12 @@ class TestTimer(unittest.TestCase):
 
     def test_single(self):
         run = mock.Mock()
-
-        with mock.patch('threading.Timer', new=self.new_mock_timer):
-            self.timer = self.timer_conn.start_once(datetime.timedelta(minutes=1), run)
-        self.timer.finished.wait()
+        self.timer = self.timer_conn.start_once(TICK, run)
+        self.assertTrue(self.timer.active())
+        self.assertTrue(self.timer.finished.wait(timeout=5))
         run.assert_called_once()
+        self.assertFalse(self.timer.active())
+        self.assertEqual(self.timer_conn.timers, set())
 
     def test_repeating(self):
         def side_effect():
@@ -87,10 +60,200 @@ class TestTimer(unittest.TestCase):
         run = mock.Mock(side_effect=side_effect)
 
         def start_timer():
-            with mock.patch('threading.Timer', new=self.new_mock_timer):
-                self.timer = self.timer_conn.start_repeating(datetime.timedelta(minutes=1), run)
+            self.timer = self.timer_conn.start_repeating(TICK, run)
 
         self.queue.put(lambda_event.LambdaEvent(start_timer))
         self.queue.join()
-        self.timer.cancelled.wait()
+        self.assertTrue(self.timer.cancelled.wait(timeout=5))
         run.assert_has_calls([mock.call()] * 3)
+
+    def test_order(self):
+        fired: List[int] = []
+        done = threading.Event()
+        for i in reversed(range(5)):
+            self.timer_conn.start_once(TICK * (i + 1), lambda i=i: fired.append(i))
+        self.timer_conn.start_once(TICK * 6, done.set)
+        self.assertTrue(done.wait(timeout=5))
+        self.assertEqual(fired, [0, 1, 2, 3, 4])
+
+    def test_cancel(self):
+        run = mock.Mock()
+        done = threading.Event()
+        self.timer = self.timer_conn.start_once(TICK, run)
+        self.timer.cancel()
+        self.assertFalse(self.timer.active())
+        self.timer_conn.start_once(TICK * 2, done.set)
+        self.assertTrue(done.wait(timeout=5))
+        run.assert_not_called()
+
+    def test_extend(self):
+        order: List[str] = []
+        self.timer = self.timer_conn.start_once(TICK, lambda: order.append('extended'))
+        self.timer.extend(TICK * 2)
+        self.timer_conn.start_once(TICK * 2, lambda: order.append('other'))
+        self.assertTrue(self.timer.finished.wait(timeout=5))
+        self.assertEqual(order, ['other', 'extended'])
+
+    def test_compaction(self):
+        timers = [self.timer_conn.start_once(datetime.timedelta(hours=1), mock.Mock())
+                  for _ in range(timer.MIN_COMPACTION * 2)]
+        for t in timers:
+            t.cancel()
+        self.assertLess(len(self.timer_conn.heap), timer.MIN_COMPACTION * 2)
+        self.assertEqual(self.timer_conn.timers, set())
+
+    def test_cancel_after_due(self):
+        # A timer that's already come out of the heap (its run is queued on the event thread)
+        # doesn't count as a canceled entry in the heap.
+        timer_conn = timer.TimerConnection()
+        due = timer_conn.start_once(datetime.timedelta(0), mock.Mock())
+        waiting = timer_conn.start_once(datetime.timedelta(hours=1), mock.Mock())
+        with timer_conn.cond:
+            self.assertIs(timer_conn._next_due(), due)
+        due.cancel()
+        self.assertEqual(timer_conn.canceled_in_heap, 0)
+        waiting.cancel()
+        self.assertEqual(timer_conn.canceled_in_heap, 1)
+
+    def test_skip_if_running(self):
+        run = mock.Mock()
+        unblock = threading.Event()
+        # Stall the event thread for a few ticks.
+        self.queue.put(lambda_event.LambdaEvent(lambda: unblock.wait(timeout=5)))
+        self.timer = self.timer_conn.start_repeating(TICK, run, skip_if_running=True)
+        threading.Event().wait((TICK * 10).total_seconds())
+        unblock.set()
+        self.queue.join()
+        self.timer.cancel()
+        self.assertLess(run.call_count, 5)
+
+
+class RepeatingTimerTest(unittest.TestCase):
+    def setUp(self):
+        self.timer_conn = mock.Mock()
+        self.interval = datetime.timedelta(minutes=1)
+        self.run = mock.Mock()
+
+    def fire(self, t: timer.RepeatingTimer) -> None:
+        # Fires the timer, then runs the event it sent to the event thread.
+        self.timer_conn.on_event.reset_mock()
+        t.fire()
+        self.timer_conn.on_event.assert_called_once()
+        self.timer_conn.on_event.call_args[0][0].run()
+
+    def test_fixed_rate(self):
+        t = timer.RepeatingTimer(self.timer_conn, self.interval, self.run)
+        end_time = t.end_time = datetime.datetime.now() - self.interval * 3.5
+        self.fire(t)
+        self.run.assert_called_once()
+        # It's still behind, so the next tick is still overdue.
+        self.assertEqual(t.end_time, end_time + self.interval)
+        self.timer_conn.schedule.assert_called_once_with(t)
+
+    def test_coalesce(self):
+        t = timer.RepeatingTimer(self.timer_conn, self.interval, self.run, coalesce=True)
+        end_time = t.end_time = datetime.datetime.now() - self.interval * 3.5
+        self.fire(t)
+        self.run.assert_called_once()
+        self.assertEqual(t.end_time, end_time + self.interval * 4)
+
+    def test_fixed_delay(self):
+        t = timer.RepeatingTimer(self.timer_conn, self.interval, self.run, mode='fixed_delay')
+        t.end_time = datetime.datetime.now() - self.interval * 3.5
+        t.fire()
+        self.timer_conn.schedule.assert_not_called()
+        self.timer_conn.on_event.call_args[0][0].run()
+        self.run.assert_called_once()
+        self.timer_conn.schedule.assert_called_once_with(t)
+        self.assertGreater(t.end_time, datetime.datetime.now())
+
+    def test_skip_if_running(self):
+        t = timer.RepeatingTimer(self.timer_conn, self.interval, self.run, skip_if_running=True)
+        t.fire()
+        t.fire()
+        self.timer_conn.on_event.assert_called_once()
+        self.timer_conn.on_event.call_args[0][0].run()
+        self.fire(t)
+        self.assertEqual(self.run.call_count, 2)
+
+
+class DurableTimerTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.timer_conn = timer.TimerConnection()
+
+    def tearDown(self):
+        self.timer_conn.data.clear_all()
+        super().tearDown()
+
+    def save(self, name: str, end_time: datetime.datetime,
+             interval: Optional[datetime.timedelta]) -> None:
+        # Save a timer the way a previous run of the bot would have.
+        t = timer.RepeatingTimer(self.timer_conn, interval, mock.Mock()) if interval else (
+            timer.SingleTimer(self.timer_conn, datetime.timedelta(0), mock.Mock()))
+        t.end_time = end_time
+        t.durable_name = name
+        self.timer_conn.save_durable(t)
+
+    def test_resume(self):
+        original = self.timer_conn.start_durable('once', datetime.timedelta(minutes=5), mock.Mock())
+        resumed = timer.TimerConnection().resume_durable('once', mock.Mock())
+        self.assertIsInstance(resumed, timer.SingleTimer)
+        self.assertEqual(resumed.end_time, original.end_time)
+        self.assertIsNone(timer.TimerConnection().resume_durable('nonexistent', mock.Mock()))
+
+    def test_resume_sees_latest_save(self):
+        timer_conn = timer.TimerConnection()
+        self.assertIsNone(timer_conn.resume_durable('other', mock.Mock()))
+        # Saved after this connection already resumed something, and then restarted and saved
+        # again: it still resumes the latest state.
+        timer_conn.start_durable('once', datetime.timedelta(minutes=5), mock.Mock())
+        self.assertIsNotNone(timer_conn.resume_durable('once', mock.Mock()))
+        latest = timer_conn.start_durable('once', datetime.timedelta(minutes=10), mock.Mock())
+        self.assertEqual(timer_conn.resume_durable('once', mock.Mock()).end_time, latest.end_time)
+
+    def test_extend_and_cancel(self):
+        original = self.timer_conn.start_durable('once', datetime.timedelta(minutes=5), mock.Mock())
+        original.extend(datetime.timedelta(minutes=2))
+        resumed = timer.TimerConnection().resume_durable('once', mock.Mock())
+        self.assertEqual(resumed.end_time, original.end_time)
+        original.cancel()
+        self.assertIsNone(timer.TimerConnection().resume_durable('once', mock.Mock()))
+
+    def test_single_overdue(self):
+        end_time = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        self.save('once', end_time, None)
+        self.assertEqual(
+            timer.TimerConnection().resume_durable('once', mock.Mock()).end_time, end_time)
+        self.assertIsNone(
+            timer.TimerConnection().resume_durable('once', mock.Mock(), catch_up='skip'))
+        self.assertIsNone(timer.TimerConnection().resume_durable('once', mock.Mock()))
+
+    def test_repeating_overdue(self):
+        interval = datetime.timedelta(minutes=10)
+        end_time = datetime.datetime.now() - interval * 3.5
+        self.save('repeating', end_time, interval)
+        expected = {'all': end_time, 'once': end_time + interval * 3,
+                    'skip': end_time + interval * 4}
+        for catch_up, expected_end_time in expected.items():
+            resumed = timer.TimerConnection().resume_durable('repeating', mock.Mock(), catch_up)
+            self.assertIsInstance(resumed, timer.RepeatingTimer)
+            self.assertEqual(resumed.interval, interval)
+            self.assertEqual(resumed.end_time, expected_end_time, catch_up)
+
+    def test_repeating_fires_missed_ticks(self):
+        interval = datetime.timedelta(seconds=10)
+        self.save('repeating', datetime.datetime.now() - interval * 2.5, interval)
+        events = queue.Queue()
+        run = mock.Mock()
+        self.timer_conn.resume_durable('repeating', run, catch_up='all')
+        thread = threading.Thread(target=self.timer_conn.run, args=(events.put,))
+        thread.start()
+        for _ in range(3):
+            events.get(timeout=5).run()
+        self.timer_conn.shutdown()
+        thread.join()
+        self.assertEqual(run.call_count, 3)
+        self.assertTrue(events.empty())
+        resumed = timer.TimerConnection().resume_durable('repeating', mock.Mock())
+        self.assertGreater(resumed.end_time, datetime.datetime.now())
@@ -0,0 +1,148 @@
+import unittest
+from unittest import mock
+
+from irc import client
+
+from impbot.connections import irc_conn, twitch
+
+
+def privmsg(tags: dict, text: str = 'hello', channel: str = '#streamer') -> client.Event:
+    return client.Event('pubmsg', client.NickMask('someone!someone@someone.tmi.twitch.tv'),
+                        channel, [text], [{'key': k, 'value': v} for k, v in tags.items()])
+
+
+class TwitchChatConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = twitch.TwitchChatConnection(
+            'bot', 'token', mock.Mock(streamer_username='Streamer'), admins=[],
+            other_channels=['Other'])
+
+    def test_message(self):
+        message = self.conn._message(privmsg({
+            'badges': 'moderator/1,subscriber/12', 'display-name': 'SomeOne', 'id': 'abc',
+            'user-id': '1234', 'emotes': '25:0-4,12-16/1902:6-10'}))
+        self.assertEqual(message.id, 'abc')
+        self.assertEqual(message.user_id, 1234)
+        self.assertEqual(str(message.user), 'SomeOne')
+        self.assertFalse(message.user.admin)
+        self.assertTrue(message.user.moderator)
+        self.assertTrue(message.user.is_subscriber)
+        self.assertEqual(message.user.badges, {'moderator', 'subscriber'})
+        self.assertEqual(message.emotes, [('25', 0, 4), ('25', 12, 16), ('1902', 6, 10)])
+        self.conn.twitch_util.users.update.assert_called_once_with(1234, 'someone', 'SomeOne')
+
+    def test_broadcaster(self):
+        message = self.conn._message(
+            privmsg({'badges': 'broadcaster/1', 'user-id': '1', 'emotes': ''}))
+        self.assertTrue(message.user.admin)
+        self.assertTrue(message.user.moderator)
+        self.assertFalse(message.user.is_subscriber)
+        self.assertEqual(message.emotes, [])
+
+    def test_no_badges(self):
+        message = self.conn._message(privmsg({'badges': '', 'user-id': '1'}))
+        self.assertFalse(message.user.admin)
+        self.assertFalse(message.user.moderator)
+        self.assertEqual(message.user.badges, set())
+
+    def test_other_channel(self):
+        primary = self.conn._message(privmsg({'user-id': '1'}))
+        self.assertIsNone(primary.channel)
+        self.assertIs(primary.reply_connection, self.conn)
+
+        other = self.conn._message(privmsg({'user-id': '1'}, channel='#other'))
+        self.assertEqual(other.channel, '#other')
+        self.assertIsInstance(other.reply_connection, twitch.TwitchChannelView)
+        self.assertIs(self.conn.for_channel('#other'), other.reply_connection)
+        other.reply_connection.say('hi')
+        other.reply_connection.say('/ban alice')
+        other.reply_connection.command('.delete abc')
+        self.assertEqual([self.conn.outbound.get() for _ in range(3)], [
+            irc_conn.OutgoingMessage('#other', '.delete abc', mock.ANY),
+            irc_conn.OutgoingMessage('#other', 'hi', mock.ANY),
+            irc_conn.OutgoingMessage('#other', ' /ban alice', mock.ANY),
+        ])
+        # It only sends: the connection itself is still the only one with any state.
+        self.assertIs(other.reply_connection.parent, self.conn)
+        self.assertEqual(self.conn.channel, '#streamer')
+
+    def test_other_channel_privileges(self):
+        for badges in ('broadcaster/1', 'moderator/1,subscriber/12'):
+            message = self.conn._message(
+                privmsg({'badges': badges, 'user-id': '1'}, channel='#other'))
+            self.assertFalse(message.user.admin)
+            self.assertFalse(message.user.moderator)
+            self.assertFalse(message.user.is_subscriber)
+
+        # Bot admins are admins everywhere, though.
+        self.conn.admins = ['someone']
+        message = self.conn._message(privmsg({'badges': '', 'user-id': '1'}, channel='#other'))
+        self.assertTrue(message.user.admin)
+
+    def test_rate_limit_needs_mod_everywhere(self):
+        self.conn.on_userstate(None, client.Event('userstate', 'tmi.twitch.tv', '#streamer', [],
+                                                  [{'key': 'mod', 'value': '1'}]))
+        self.assertFalse(self.conn.is_moderator)
+        self.conn.on_userstate(None, client.Event('userstate', 'tmi.twitch.tv', '#other', [],
+                                                  [{'key': 'mod', 'value': '1'}]))
+        self.assertTrue(self.conn.is_moderator)
+        self.assertIsNone(self.conn.outbound.duplicate_window)
+
+    def test_presence(self):
+        self.conn.on_namreply(None, client.Event('namreply', 'tmi.twitch.tv', 'bot',
+                                                 ['=', '#streamer', 'alice bob']))
+        self.conn.on_join(None, client.Event('join', client.NickMask('carol!carol@tmi'),
+                                             '#streamer'))
+        self.conn.on_join(None, client.Event('join', client.NickMask('dave!dave@tmi'), '#other'))
+        self.conn.on_part(None, client.Event('part', client.NickMask('bob!bob@tmi'), '#streamer'))
+        self.assertTrue(self.conn.is_present('Alice'))
+        self.assertFalse(self.conn.is_present('bob'))
+        self.assertFalse(self.conn.is_present('dave'))
+        self.assertEqual(set(self.conn.all_chatters()), {'alice', 'carol'})
+        self.assertEqual(set(self.conn.for_channel('#other').all_chatters()), {'dave'})
+
+
+class FetchChattersTest(unittest.TestCase):
+    @mock.patch.object(twitch.requests, 'get', side_effect=twitch.requests.Timeout())
+    def test_timeout(self, get):
+        conn = twitch.TwitchChatConnection(
+            'bot', 'token', mock.Mock(streamer_username='Streamer'), admins=[])
+        self.assertIsNone(conn._fetch_chatters('#streamer'))
+        self.assertIsNotNone(get.call_args.kwargs['timeout'])
+
+    def test_malformed(self):
+        conn = twitch.TwitchChatConnection(
+            'bot', 'token', mock.Mock(streamer_username='Streamer'), admins=[])
+        not_json = mock.Mock(**{'json.side_effect': ValueError('not JSON')})
+        no_chatters = mock.Mock(**{'json.return_value': {'error': 'oops'}})
+        wrong_shape = mock.Mock(**{'json.return_value': {'chatters': ['someone']}})
+        for response in (not_json, no_chatters, wrong_shape):
+            with mock.patch.object(twitch.requests, 'get', return_value=response):
+                self.assertIsNone(conn._fetch_chatters('#streamer'))
+
+    def test_reconcile_always_finishes(self):
+        conn = twitch.TwitchChatConnection(
+            'bot', 'token', mock.Mock(streamer_username='Streamer'), admins=[])
+        with mock.patch.object(conn, '_fetch_chatters', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, conn.reconcile_forever)
+        self.assertIsNone(conn.presence['#streamer'].changes)
+
+
+class PresenceTest(unittest.TestCase):
+    def test_reconcile(self):
+        presence = twitch.Presence()
+        presence.join('alice')
+        presence.join('bob')
+        presence.begin_reconcile()
+        # These happen while the chatter list is being fetched, so they're not in it.
+        presence.join('carol')
+        presence.part('bob')
+        presence.finish_reconcile(['alice', 'bob', 'erin'])
+        self.assertEqual(presence.snapshot(), {'alice', 'carol', 'erin'})
+
+    def test_reconcile_failed(self):
+        presence = twitch.Presence()
+        presence.join('alice')
+        presence.begin_reconcile()
+        presence.finish_reconcile(None)
+        self.assertEqual(presence.snapshot(), {'alice'})
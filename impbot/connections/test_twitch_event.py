@@ -0,0 +1,48 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from impbot.connections import twitch_event
+from impbot.util import user_cache
+
+
+def mod_action(action: str, *args: str) -> dict:
+    return {'type': 'MESSAGE', 'data': {
+        'topic': 'chat_moderator_actions.1234',
+        'message': json.dumps({'data': {
+            'moderation_action': action, 'created_by': 'mod', 'args': list(args)}}),
+    }}
+
+
+class HandleMessageTest(unittest.TestCase):
+    def setUp(self):
+        util = mock.Mock()
+        util.users.get.side_effect = lambda name: user_cache.UserIdentity(
+            1, name, name.upper(), 0)
+        self.conn = twitch_event.TwitchEventConnection(util)
+        self.on_event = mock.Mock()
+
+    def handle(self, body: dict) -> None:
+        asyncio.run(self.conn.handle_message(self.on_event, body))
+
+    def test_timeout(self):
+        self.handle(mod_action('timeout', 'spammer', '600', 'spam'))
+        event = self.on_event.call_args[0][0]
+        self.assertIsInstance(event, twitch_event.Timeout)
+        self.assertEqual(str(event.user), 'MOD')
+        self.assertTrue(event.user.moderator)
+        self.assertEqual(str(event.target), 'SPAMMER')
+        self.assertEqual(event.duration, datetime.timedelta(minutes=10))
+        self.assertEqual(event.reason, 'spam')
+
+    def test_delete(self):
+        self.handle(mod_action('delete', 'someone', 'bad words', 'abc'))
+        event = self.on_event.call_args[0][0]
+        self.assertIsInstance(event, twitch_event.Delete)
+        self.assertEqual(event.message_text, 'bad words')
+
+    def test_ignored(self):
+        self.handle(mod_action('slow', '30'))
+        self.on_event.assert_not_called()
@@ -0,0 +1,78 @@
+import hmac
+import json
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from impbot.connections import twitch_eventsub
+from impbot.core import web
+
+
+class MessageIdCacheTest(unittest.TestCase):
+    def test_duplicates(self):
+        cache = twitch_eventsub._MessageIdCache(timedelta(minutes=10), 100)
+        now = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        self.assertTrue(cache.add('a', now))
+        self.assertTrue(cache.add('b', now))
+        self.assertFalse(cache.add('a', now + timedelta(minutes=5)))
+        # Once it's old enough, it's forgotten.
+        self.assertTrue(cache.add('a', now + timedelta(minutes=11)))
+
+    def test_max_size(self):
+        cache = twitch_eventsub._MessageIdCache(timedelta(minutes=10), 2)
+        now = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        for id in 'abc':
+            self.assertTrue(cache.add(id, now))
+        self.assertEqual(list(cache.seen), ['b', 'c'])
+
+
+class CallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = twitch_eventsub.TwitchEventSubConnection(mock.Mock(), mock.Mock())
+        self.conn._secret = 'secret'
+        self.on_event = mock.Mock()
+        self.conn._on_event = self.on_event
+        self.conn._startup_event.set()
+        self.web_conn = web.WebServerConnection('127.0.0.1', 9999, '127.0.0.1:9999')
+        self.web_conn.init_routes([self.conn], [])
+        self.client = self.web_conn.flask.test_client()
+
+    def tearDown(self):
+        self.web_conn.flask_server.server_close()
+
+    def post(self, id: str, timestamp: datetime):
+        body = json.dumps({
+            'subscription': {'type': 'stream.online'},
+            'event': {},
+        }).encode()
+        timestamp_str = timestamp.isoformat()
+        signature = hmac.digest(b'secret', (id + timestamp_str).encode() + body, 'sha256').hex()
+        return self.client.post('/eventsub/callback', data=body, headers={
+            'Twitch-Eventsub-Message-Type': 'notification',
+            'Twitch-Eventsub-Message-Id': id,
+            'Twitch-Eventsub-Message-Timestamp': timestamp_str,
+            'Twitch-Eventsub-Message-Signature': f'sha256={signature}',
+        })
+
+    def test_duplicate(self):
+        now = datetime.now(timezone.utc)
+        self.assertEqual(self.post('id1', now).status_code, 200)
+        self.assertEqual(self.post('id1', now).status_code, 200)
+        self.on_event.assert_called_once()
+        self.assertEqual(self.post('id2', now).status_code, 200)
+        self.assertEqual(self.on_event.call_count, 2)
+
+    def test_updates_stream_data(self):
+        self.assertEqual(self.post('id1', datetime.now(timezone.utc)).status_code, 200)
+        self.conn.twitch_util.stream_changed.assert_called_once_with(online=True)
+
+    def test_stale(self):
+        old = datetime.now(timezone.utc) - timedelta(minutes=11)
+        self.assertEqual(self.post('id1', old).status_code, 200)
+        self.on_event.assert_not_called()
+
+    @mock.patch.object(twitch_eventsub, 'ACK_BUDGET_SECONDS', 0.01)
+    def test_not_started(self):
+        self.conn._startup_event.clear()
+        self.assertEqual(self.post('id1', datetime.now(timezone.utc)).status_code, 503)
+        self.on_event.assert_not_called()
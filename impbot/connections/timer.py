@@ -1,46 +1,232 @@
 import datetime
+import heapq
+import itertools
+import json
+import logging
 import threading
 from abc import ABCMeta, abstractmethod
-from typing import Callable, List, Optional
+from typing import Callable, List, Literal, Optional, Set, Tuple
 
-from impbot.core import base
+from impbot.core import base, data
 from impbot.core.base import EventCallback
 from impbot.handlers import lambda_event
+from impbot.util import metrics
+
+# What a durable timer does about the times it should have fired while the bot was down: fire once
+# right away, not at all, or once for every time it missed.
+CatchUp = Literal['once', 'skip', 'all']
+
+# How a repeating timer schedules its next tick: 'fixed_rate' keeps to the original schedule (every
+# interval after it started, no matter how long each run takes), and 'fixed_delay' waits a full
+# interval after each run finishes.
+RepeatMode = Literal['fixed_rate', 'fixed_delay']
+
+logger = logging.getLogger(__name__)
+
+# Once more than this many canceled timers are still sitting in the heap, and they're more than half
+# of it, the heap is rebuilt without them.
+MIN_COMPACTION = 64
 
 
 class TimerConnection(base.Connection):
+    """
+    Runs all the timers on a single scheduler thread, which keeps them in a heap ordered by end
+    time. When a timer comes due, its function is sent to the event thread as a LambdaEvent.
+
+    Canceling a timer doesn't take it out of the heap right away; the scheduler just skips it when
+    it comes up. Extending one works similarly: when the scheduler finds it hasn't actually come
+    due yet, it puts it back in with the new end time.
+    """
+
     def __init__(self):
         self.on_event: Optional[EventCallback] = None
-        self.timers: List[Timer] = []
+        self.timers: Set[Timer] = set()
         self.shutdown_event = threading.Event()
+        self.cond = threading.Condition()
+        self.heap: List[Tuple[datetime.datetime, int, Timer]] = []
+        # Breaks ties in the heap, so that timers with the same end time fire in the order they
+        # were scheduled (and Timers themselves never get compared).
+        self.counter = itertools.count()
+        self.canceled_in_heap = 0
+        self.data = data.Namespace('impbot.connections.timer.TimerConnection')
 
     def run(self, on_event: EventCallback) -> None:
         self.on_event = on_event
-        self.shutdown_event.wait()
+        while True:
+            with self.cond:
+                timer = self._next_due()
+            if timer is None:
+                return
+            timer.fire()
+
+    def _next_due(self) -> Optional['Timer']:
+        # Waits until a timer comes due and returns it, or returns None when we're shutting down.
+        # Call this with self.cond held.
+        while not self.shutdown_event.is_set():
+            if not self.heap:
+                self.cond.wait()
+                continue
+            end_time, _, timer = self.heap[0]
+            if timer.cancelled.is_set():
+                heapq.heappop(self.heap)
+                timer.in_heap = False
+                if timer not in self.timers:
+                    # remove() already ran, and counted it. (Otherwise it will find it's no longer
+                    # in the heap, and won't.)
+                    self.canceled_in_heap -= 1
+                continue
+            now = datetime.datetime.now()
+            if end_time > now:
+                self.cond.wait((end_time - now).total_seconds())
+                continue
+            heapq.heappop(self.heap)
+            timer.in_heap = False
+            if timer.end_time > end_time:
+                # It was extended since it went into the heap.
+                self._push(timer)
+                continue
+            return timer
+        return None
 
     def shutdown(self) -> None:
+        # The timers aren't canceled, just abandoned: that way, durable timers stay saved.
         self.shutdown_event.set()
-        for timer in self.timers:
-            timer.cancel()
+        with self.cond:
+            self.cond.notify()
 
     def start_once(self, interval: datetime.timedelta, run: Callable[[], None]) -> 'SingleTimer':
         timer = SingleTimer(self, interval, run)
-        self.timers.append(timer)
+        self.schedule(timer)
         return timer
 
-    def start_repeating(
-            self, interval: datetime.timedelta, run: Callable[[], None]) -> 'RepeatingTimer':
-        timer = RepeatingTimer(self, interval, run)
-        self.timers.append(timer)
+    def start_repeating(self, interval: datetime.timedelta, run: Callable[[], None],
+                        mode: RepeatMode = 'fixed_rate', coalesce: bool = False,
+                        skip_if_running: bool = False) -> 'RepeatingTimer':
+        """
+        Runs the function every interval. If coalesce is set, ticks that were missed entirely (e.g.
+        because the machine was asleep) are dropped, rather than all firing back to back. If
+        skip_if_running is set, a tick is dropped if the previous one is still waiting for (or
+        running on) the event thread.
+        """
+        timer = RepeatingTimer(self, interval, run, mode, coalesce, skip_if_running)
+        self.schedule(timer)
         return timer
 
-    def remove(self, timer: 'Timer') -> None:
+    def start_durable(self, name: str, interval: datetime.timedelta, run: Callable[[], None],
+                      repeating: bool = False,
+                      first_interval: Optional[datetime.timedelta] = None) -> 'Timer':
+        """
+        Like start_once() or start_repeating(), but the timer is saved in the database, so that
+        after the bot restarts, resume_durable() can pick it up where it left off. The name must be
+        unique across the bot (prefixing it with the handler's class name is a good idea). Starting
+        a timer with the same name as an existing one replaces the saved one, but doesn't cancel it.
+        A repeating timer can wait first_interval, instead of interval, before its first tick.
+        """
+        timer: Timer
+        if repeating:
+            timer = RepeatingTimer(self, interval, run)
+            if first_interval is not None:
+                timer.end_time = datetime.datetime.now() + first_interval
+        else:
+            timer = SingleTimer(self, interval, run)
+        timer.durable_name = name
+        self.save_durable(timer)
+        self.schedule(timer)
+        return timer
+
+    def resume_durable(self, name: str, run: Callable[[], None],
+                       catch_up: CatchUp = 'once') -> Optional['Timer']:
+        """
+        Restarts a timer saved by start_durable() before the bot restarted, if it's still active,
+        and returns it. (Otherwise, returns None.) Call this from Handler.startup(), with the same
+        function the timer originally had.
+
+        For a one-shot timer that came due while the bot was down, 'skip' drops it; otherwise it
+        fires right away. A repeating timer fires right away either once or once per missed tick,
+        or skips to its next tick, and continues on its original schedule.
+        """
+        # Read straight from the database, so it's always what was saved last. This only happens at
+        # startup, so it doesn't need to be fast.
         try:
+            saved_json = self.data.get('durable', name)
+        except KeyError:
+            return None
+        saved = json.loads(saved_json)
+        end_time = datetime.datetime.fromisoformat(saved['end_time']).astimezone().replace(
+            tzinfo=None)
+        now = datetime.datetime.now()
+        timer: Timer
+        if saved['interval'] is None:
+            if end_time <= now and catch_up == 'skip':
+                self.data.unset('durable', name)
+                return None
+            timer = SingleTimer(self, datetime.timedelta(0), run)
+        else:
+            interval = datetime.timedelta(seconds=saved['interval'])
+            timer = RepeatingTimer(self, interval, run)
+            if end_time <= now:
+                missed = (now - end_time) // interval + 1
+                if catch_up == 'once':
+                    end_time += interval * (missed - 1)
+                elif catch_up == 'skip':
+                    end_time += interval * missed
+                # For 'all', the scheduler will find it overdue and fire it once per missed tick.
+        timer.end_time = end_time
+        timer.durable_name = name
+        self.schedule(timer)
+        return timer
+
+    def save_durable(self, timer: 'Timer') -> None:
+        if timer.durable_name is None:
+            return
+        interval = timer.interval.total_seconds() if isinstance(timer, RepeatingTimer) else None
+        self.data.set_subkey('durable', timer.durable_name, json.dumps({
+            'end_time': timer.end_time.astimezone(datetime.timezone.utc).isoformat(),
+            'interval': interval,
+        }))
+
+    def forget_durable(self, timer: 'Timer') -> None:
+        if timer.durable_name is not None:
+            self.data.unset('durable', timer.durable_name)
+
+    def schedule(self, timer: 'Timer') -> None:
+        """(Re)schedules the timer for its current end time."""
+        with self.cond:
+            if timer.cancelled.is_set():
+                return
+            self.timers.add(timer)
+            self._push(timer)
+
+    def _push(self, timer: 'Timer') -> None:
+        # Call this with self.cond held.
+        heapq.heappush(self.heap, (timer.end_time, next(self.counter), timer))
+        timer.in_heap = True
+        if self.heap[0][2] is timer:
+            # It's the new earliest, so the scheduler needs to wait less time than it thought.
+            self.cond.notify()
+
+    def remove(self, timer: 'Timer') -> None:
+        with self.cond:
+            if timer not in self.timers:
+                # Very occasionally, a timer gets double-removed due to a race condition. That's
+                # actually fine, so ignoring it here makes remove() idempotent.
+                return
             self.timers.remove(timer)
-        except ValueError:
-            # Very occasionally, a timer gets double-removed due to a race condition. That's
-            # actually fine, so eating the ValueError here makes remove() idempotent.
-            pass
+            # A timer that already came due (e.g. one whose run is still queued on the event
+            # thread) has nothing left in the heap to clean up.
+            if timer.cancelled.is_set() and timer.in_heap:
+                self.canceled_in_heap += 1
+                if (self.canceled_in_heap > MIN_COMPACTION and
+                        self.canceled_in_heap > len(self.heap) // 2):
+                    heap = []
+                    for entry in self.heap:
+                        if entry[2].cancelled.is_set():
+                            entry[2].in_heap = False
+                        else:
+                            heap.append(entry)
+                    self.heap = heap
+                    heapq.heapify(self.heap)
+                    self.canceled_in_heap = 0
 
 
 class Timer(metaclass=ABCMeta):
@@ -50,21 +236,22 @@ class Timer(metaclass=ABCMeta):
         self.run = run
         self.timer_conn = timer_conn
         self.end_time = datetime.datetime.now() + interval
-        self.timer: Optional[threading.Timer] = None
         self.cancelled = threading.Event()
-
-    def start_timer(self) -> None:
-        interval = (self.end_time - datetime.datetime.now()).total_seconds()
-        self.timer = threading.Timer(interval, self.run_as_lambda)
-        self.timer.start()
+        self.durable_name: Optional[str] = None  # See TimerConnection.start_durable().
+        # Whether the scheduler's heap has an entry for this. Only touched with timer_conn.cond
+        # held.
+        self.in_heap = False
 
     def cancel(self) -> None:
-        self.timer.cancel()
-        self.timer_conn.remove(self)
+        if self.cancelled.is_set():
+            return
         self.cancelled.set()
+        self.timer_conn.remove(self)
+        self.timer_conn.forget_durable(self)
 
     @abstractmethod
-    def run_as_lambda(self):
+    def fire(self) -> None:
+        """Called on the scheduler thread when the timer comes due."""
         pass
 
     @abstractmethod
@@ -78,9 +265,8 @@ class SingleTimer(Timer):
                  run: Callable[[], None]):
         super().__init__(timer_conn, interval, run)
         self.finished = threading.Event()
-        self.start_timer()
 
-    def run_as_lambda(self) -> None:
+    def fire(self) -> None:
         def run() -> None:
             # This runs on the event thread. Double-check the cancel flag, in case we got canceled
             # while this was queued.
@@ -88,18 +274,20 @@ class SingleTimer(Timer):
                 return
             if self.end_time > datetime.datetime.now():
                 # The time has been extended, so wait again.
-                self.start_timer()
+                self.timer_conn.schedule(self)
                 return
             self.timer_conn.remove(self)
             try:
                 self.run()
             finally:
                 self.finished.set()
+                self.timer_conn.forget_durable(self)
 
         self.timer_conn.on_event(lambda_event.LambdaEvent(run))
 
     def extend(self, extend_interval: datetime.timedelta) -> None:
         self.end_time += extend_interval
+        self.timer_conn.save_durable(self)
 
     def active(self) -> bool:
         return not self.cancelled.is_set() and not self.finished.is_set()
@@ -107,25 +295,54 @@ class SingleTimer(Timer):
 
 class RepeatingTimer(Timer):
     def __init__(self, timer_conn: TimerConnection, interval: datetime.timedelta,
-                 run: Callable[[], None]):
+                 run: Callable[[], None], mode: RepeatMode = 'fixed_rate', coalesce: bool = False,
+                 skip_if_running: bool = False):
         super().__init__(timer_conn, interval, run)
         self.interval = interval
-        self.start_timer()
+        self.mode = mode
+        self.coalesce = coalesce
+        self.skip_if_running = skip_if_running
+        # Set from when a tick is enqueued until it's done running.
+        self.pending = threading.Event()
 
-    def run_as_lambda(self) -> None:
-        def run() -> None:
-            # This runs on the event thread. Double-check the cancel flag, in case we got canceled
-            # while this was queued.
-            if self.cancelled.is_set():
+    def fire(self) -> None:
+        # This runs on the scheduler thread, so it isn't delayed by running the actual lambda.
+        due = self.end_time
+        now = datetime.datetime.now()
+        if self.skip_if_running and self.pending.is_set():
+            logger.debug('Skipping a tick of %s: the last one is still pending.', self.run)
+            metrics.counter('timer.skipped_ticks').inc()
+        else:
+            self.pending.set()
+            self.timer_conn.on_event(lambda_event.LambdaEvent(lambda: self._run_tick(due)))
+            if self.mode == 'fixed_delay':
+                # _run_tick() reschedules it once it's done.
                 return
-            self.run()
 
-        # This runs on the timer thread, so it isn't delayed by running the actual lambda. Enqueue
-        # the lambda, then immediately repeat if appropriate.
-        self.timer_conn.on_event(lambda_event.LambdaEvent(run))
-        if not self.cancelled.is_set():
-            self.end_time += self.interval
-            self.start_timer()
+        self.end_time += self.interval
+        if self.coalesce and self.end_time <= now:
+            missed = (now - self.end_time) // self.interval + 1
+            self.end_time += self.interval * missed
+            metrics.counter('timer.skipped_ticks').inc(missed)
+        self.timer_conn.schedule(self)
+
+    def _run_tick(self, due: datetime.datetime) -> None:
+        # This runs on the event thread. Double-check the cancel flag, in case we got canceled
+        # while this was queued.
+        if self.cancelled.is_set():
+            self.pending.clear()
+            return
+        metrics.timing('timer.lateness').observe((datetime.datetime.now() - due).total_seconds())
+        try:
+            self.run()
+        finally:
+            self.pending.clear()
+            if self.mode == 'fixed_delay':
+                self.end_time = datetime.datetime.now() + self.interval
+                self.timer_conn.schedule(self)
+            # For 'fixed_rate', the scheduler has already moved end_time on to the next tick.
+            if not self.cancelled.is_set():
+                self.timer_conn.save_durable(self)
 
     def active(self) -> bool:
         return not self.cancelled.is_set()
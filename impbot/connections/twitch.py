@@ -1,7 +1,9 @@
 import datetime
 import itertools
 import logging
-from typing import Iterable, List, Optional, Set, Tuple, cast
+import threading
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, TypeVar,
+                    cast)
 
 import attr
 import requests
@@ -9,19 +11,75 @@ from irc import client
 
 from impbot.connections import irc_conn
 from impbot.core import base
-from impbot.util import twitch_util
+from impbot.util import metrics, ratelimit, resilience, twitch_util
 
 logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+# Twitch allows 20 messages per 30 seconds, or 100 in channels where the bot is a moderator, and
+# locks the bot out of chat for a while if it goes over. The buckets here keep
+# capacity + rate * 30 at 20 and 100 respectively (https://dev.twitch.tv/docs/irc/guide#rate-limits).
+USER_RATE_LIMIT = (5, 0.5)
+MOD_RATE_LIMIT = (25, 2.5)
+# Non-moderators can't send the same message twice within 30 seconds.
+USER_DUPLICATE_WINDOW = 30.0
+# Twitch allows 20 JOINs per 10 seconds: capacity + rate * 10 = 20.
+JOIN_RATE_LIMIT = (10, 1.0)
+# How often to check presence (from JOIN and PART) against the full chatter list.
+RECONCILE_INTERVAL = datetime.timedelta(minutes=5)
+
+
+class _lazy:
+    """
+    Like functools.cached_property, but without its per-property lock, which costs more than
+    parsing a tag does. Losing the race and parsing the same tag twice is harmless.
+    """
+
+    def __init__(self, func: Callable[[Any], T]) -> None:
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance: Any, owner: type) -> T:
+        if instance is None:
+            return cast(T, self)
+        # Writing to __dict__ directly works even for frozen attrs classes, and from then on the
+        # instance attribute shadows this (non-data) descriptor.
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
 
 
 @attr.s(frozen=True)
 class TwitchUser(base.User):
     display_name: Optional[str] = attr.ib(cmp=False, default=None)
-    # The streamer doesn't have a mod badge, but they have a superset of mod privileges, so this is
-    # true for them too.
-    is_moderator: Optional[bool] = attr.ib(cmp=False, default=None)
-    is_subscriber: Optional[bool] = attr.ib(cmp=False, default=None)
-    badges: Optional[Set[str]] = attr.ib(cmp=False, default=None)
+    # The fields below can be passed explicitly, or derived on first use from badges_tag, the raw
+    # IRC tag (e.g. "moderator/1,subscriber/12"). Most messages never need them, so chat lines only
+    # set badges_tag.
+    _is_moderator: Optional[bool] = attr.ib(cmp=False, default=None)
+    _is_subscriber: Optional[bool] = attr.ib(cmp=False, default=None)
+    _badges: Optional[Set[str]] = attr.ib(cmp=False, default=None)
+    badges_tag: Optional[str] = attr.ib(cmp=False, default=None, kw_only=True,
+                                        metadata={'json': False})
+
+    @_lazy
+    def badges(self) -> Optional[Set[str]]:
+        if self._badges is not None or self.badges_tag is None:
+            return self._badges
+        return parse_badges(self.badges_tag)
+
+    @_lazy
+    def is_moderator(self) -> Optional[bool]:
+        # The streamer doesn't have a mod badge, but they have a superset of mod privileges, so this
+        # is true for them too.
+        if self._is_moderator is not None or self.badges is None:
+            return self._is_moderator
+        return 'broadcaster' in self.badges or 'moderator' in self.badges
+
+    @_lazy
+    def is_subscriber(self) -> Optional[bool]:
+        if self._is_subscriber is not None or self.badges is None:
+            return self._is_subscriber
+        return 'subscriber' in self.badges
 
     @property
     def moderator(self) -> Optional[bool]:
@@ -37,50 +95,103 @@ class TwitchMessage(base.Message):
     msg_id: Optional[str]  # Twitch's msg-id tag for NOTICE. (https://dev.twitch.tv/docs/irc/msg-id)
     user_id: int
     action: bool  # True if the message was a CTCP ACTION (/me).
-    emotes: List[Tuple[str, int, int]]  # Emote ID, start index, end index
+    # Like TwitchUser's badges, emotes can be passed explicitly or parsed on first use from the raw
+    # IRC tag (e.g. "25:0-4,12-16/1902:6-10").
+    _emotes: Optional[List[Tuple[str, int, int]]] = None
+    emotes_tag: str = attr.ib(default='', kw_only=True)
 
+    @_lazy
+    def emotes(self) -> List[Tuple[str, int, int]]:
+        """Emote ID, start index, end index."""
+        if self._emotes is not None:
+            return self._emotes
+        return parse_emotes(self.emotes_tag)
 
-class TwitchChatConnection(irc_conn.IrcConnection):
-    def __init__(self, bot_username: str, oauth_token: str, util: twitch_util.TwitchUtil,
-                 admins: List[str]) -> None:
-        if not oauth_token.startswith('oauth:'):
-            oauth_token = 'oauth:' + oauth_token
-        super().__init__('irc.chat.twitch.tv', 6667, bot_username.lower(),
-                         '#' + util.streamer_username.lower(), password=oauth_token,
-                         capabilities=['twitch.tv/tags', 'twitch.tv/commands'])
-        self.twitch_util = util
-        self.admins = admins
-        self.reactor.add_global_handler('reconnect', self.on_reconnect)
 
-    def _message(self, event: client.Event) -> base.Message:
-        tags = {i['key']: i['value'] for i in event.tags}
-        if 'badges' in tags and tags['badges']:
-            # Each badge is in the form <name>/<number> (e.g. number of months subscribed) and we
-            # don't need the numbers for anything.
-            badges = set(badge.split('/', 1)[0] for badge in tags['badges'].split(','))
-        else:
-            badges = set()
-        display_name = tags.get('display-name', event.source.nick)
-        admin = 'broadcaster' in badges or event.source.nick in self.admins
-        moderator = 'broadcaster' in badges or 'moderator' in badges
-        subscriber = 'subscriber' in badges
-        user = TwitchUser(event.source.nick, admin, display_name, moderator, subscriber)
-        emotes = []
-        emotes_tag = tags.get('emotes', '')
-        if emotes_tag:
-            for entry in emotes_tag.split('/'):
-                emote_id, positions = entry.split(':')
-                for position in positions.split(','):
-                    start, end = position.split('-')
-                    emotes.append((emote_id, int(start), int(end)))
-
-        return TwitchMessage(self, user, event.arguments[0], tags.get('id', ''), tags.get('msg-id'),
-                             int(tags['user-id']), False, emotes)
+def parse_badges(tag: str) -> Set[str]:
+    # Each badge is in the form <name>/<number> (e.g. number of months subscribed) and we don't need
+    # the numbers for anything.
+    return set(badge.split('/', 1)[0] for badge in tag.split(',')) if tag else set()
 
-    def _action(self, event: client.Event) -> base.Message:
-        message = cast(TwitchMessage, self._message(event))
-        message.action = True
-        return message
+
+def parse_emotes(tag: str) -> List[Tuple[str, int, int]]:
+    emotes = []
+    if tag:
+        for entry in tag.split('/'):
+            emote_id, positions = entry.split(':')
+            for position in positions.split(','):
+                start, end = position.split('-')
+                emotes.append((emote_id, int(start), int(end)))
+    return emotes
+
+
+def _has_badge(tag: str, badge: str) -> bool:
+    # Cheaper than parse_badges() when we only need one.
+    return tag.startswith(f'{badge}/') or f',{badge}/' in tag
+
+
+class Presence:
+    """
+    The usernames currently in one channel's chat. IRC JOIN and PART messages keep it up to date,
+    but Twitch batches those, and stops sending them at all once a channel has 1,000 chatters, so
+    it's also replaced now and then with the full chatter list (see reconcile_forever()).
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.names: Set[str] = set()
+        # While a chatter list is being fetched, the JOINs and PARTs that come in meanwhile, so
+        # that they can be applied on top of it. Each is (True for JOIN or False for PART, name).
+        self.changes: Optional[List[Tuple[bool, str]]] = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def snapshot(self) -> Set[str]:
+        with self.lock:
+            return set(self.names)
+
+    def join(self, name: str) -> None:
+        with self.lock:
+            self.names.add(name)
+            if self.changes is not None:
+                self.changes.append((True, name))
+
+    def part(self, name: str) -> None:
+        with self.lock:
+            self.names.discard(name)
+            if self.changes is not None:
+                self.changes.append((False, name))
+
+    def begin_reconcile(self) -> None:
+        with self.lock:
+            self.changes = []
+
+    def finish_reconcile(self, names: Optional[Iterable[str]]) -> None:
+        """Pass the chatter list fetched since begin_reconcile(), or None if that failed."""
+        with self.lock:
+            if names is not None:
+                new_names = set(names)
+                for joined, name in self.changes or []:
+                    if joined:
+                        new_names.add(name)
+                    else:
+                        new_names.discard(name)
+                self.names = new_names
+            self.changes = None
+
+
+class TwitchChat:
+    """
+    Sending to a Twitch channel, for both TwitchChatConnection (its primary channel) and
+    TwitchChannelView (one of the others).
+    """
+    channel: str
+    presence: Dict[str, 'Presence']
+    send: Callable[[str, str, int], None]
 
     def say(self, text: str) -> None:
         # Twitch commands are sent as PRIVMSGs that start with '/' or '.' We avoid triggering them
@@ -89,16 +200,12 @@ class TwitchChatConnection(irc_conn.IrcConnection):
         # lets them control the beginning of the output.
         if text.startswith('/') or text.startswith('.'):
             text = ' ' + text
-        super().say(text)
+        self.send(self.channel, text, irc_conn.PRIORITY_NORMAL)
 
     def command(self, text: str) -> None:
-        # Like say(), but without nerfing commands.
-        super().say(text)
-
-    def on_reconnect(self, _conn: client.ServerConnection, _event: client.Event) -> None:
-        logger.info('Got a RECONNECT command from Twitch.')
-        # Superclass automatically reconnects, since shutdown() wasn't called.
-        self.disconnect()
+        # Like say(), but without nerfing commands, and ahead of any regular chat messages waiting
+        # to go out.
+        self.send(self.channel, text, irc_conn.PRIORITY_HIGH)
 
     # TODO: Add a more general moderation API to ChatConnection.
     def timeout(self, target: base.User, duration: datetime.timedelta,
@@ -119,17 +226,154 @@ class TwitchChatConnection(irc_conn.IrcConnection):
         if reply:
             self.say(reply)
 
+    def is_present(self, username: str) -> bool:
+        """Whether the user is in this channel's chat. Never blocks."""
+        return username.lower() in self.presence[self.channel]
+
     def all_chatters(self) -> Iterable[str]:
-        # TODO: Cache this with a short TTL.
-        name = self.twitch_util.streamer_username.lower()
+        """The usernames of everyone in this channel's chat. Never blocks."""
+        return self.presence[self.channel].snapshot()
+
+
+class TwitchChatConnection(TwitchChat, irc_conn.IrcConnection):
+    def __init__(self, bot_username: str, oauth_token: str, util: twitch_util.TwitchUtil,
+                 admins: List[str], other_channels: Sequence[str] = (),
+                 send_pool_size: int = 0) -> None:
+        """
+        Joins the streamer's channel, plus any other_channels (usernames, without the '#'). See
+        IrcConnection for how messages from other channels are handled, and for send_pool_size.
+        (The pool spreads the sending work, but Twitch's rate limits are per account, so it
+        doesn't raise them.)
+        """
+        if not oauth_token.startswith('oauth:'):
+            oauth_token = 'oauth:' + oauth_token
+        channels = ['#' + name.lower() for name in [util.streamer_username, *other_channels]]
+        # Assume the bot isn't a moderator until USERSTATE says otherwise.
+        super().__init__('irc.chat.twitch.tv', 6667, bot_username.lower(), channels,
+                         password=oauth_token,
+                         capabilities=['twitch.tv/tags', 'twitch.tv/commands',
+                                       'twitch.tv/membership'],
+                         rate_limit=ratelimit.TokenBucket(*USER_RATE_LIMIT),
+                         join_rate_limit=ratelimit.TokenBucket(*JOIN_RATE_LIMIT),
+                         send_pool_size=send_pool_size)
+        self.outbound.duplicate_window = USER_DUPLICATE_WINDOW
+        self.twitch_util = util
+        self.admins = admins
+        self.is_moderator = False
+        self.moderator_channels: Set[str] = set()
+        self.presence = {channel: Presence() for channel in self.channels}
+        self.reactor.add_global_handler('reconnect', self.on_reconnect)
+        self.reactor.add_global_handler('userstate', self.on_userstate)
+        self.reactor.add_global_handler('join', self.on_join)
+        self.reactor.add_global_handler('part', self.on_part)
+        self.reactor.add_global_handler('namreply', self.on_namreply)
+
+    def run(self, on_event: base.EventCallback) -> None:
+        threading.Thread(name='TwitchChatConnection presence', target=self.reconcile_forever,
+                         daemon=True).start()
+        super().run(on_event)
+
+    def _message(self, event: client.Event) -> base.Message:
+        tags = {i['key']: i['value'] for i in event.tags}
+        badges_tag = tags.get('badges') or ''
+        display_name = tags.get('display-name', event.source.nick)
+        channel = self._channel(event)
+        if channel is None:
+            admin = _has_badge(badges_tag, 'broadcaster') or event.source.nick in self.admins
+            user = TwitchUser(event.source.nick, admin, display_name, badges_tag=badges_tag)
+        else:
+            # Handlers act on the primary channel, so being the broadcaster or a mod (or a
+            # subscriber) somewhere else doesn't count.
+            user = TwitchUser(event.source.nick, event.source.nick in self.admins, display_name,
+                              False, False, badges_tag=badges_tag)
+        user_id = int(tags['user-id'])
+        # Free to keep up to date, so that TwitchUtil rarely has to look up anyone who chats.
+        self.twitch_util.users.update(user_id, event.source.nick, display_name)
+        return TwitchMessage(self.for_channel(channel), user, event.arguments[0], tags.get('id', ''),
+                             tags.get('msg-id'), user_id, False,
+                             emotes_tag=tags.get('emotes') or '', channel=channel)
+
+    def _action(self, event: client.Event) -> base.Message:
+        message = cast(TwitchMessage, self._message(event))
+        message.action = True
+        return message
+
+    def for_channel(self, channel: Optional[str]) -> TwitchChat:
+        return cast(TwitchChat, super().for_channel(channel))
+
+    def _channel_view(self, channel: str) -> 'TwitchChannelView':
+        return TwitchChannelView(self, channel)
+
+    def on_reconnect(self, _conn: client.ServerConnection, _event: client.Event) -> None:
+        logger.info('Got a RECONNECT command from Twitch.')
+        # Superclass automatically reconnects, since shutdown() wasn't called.
+        self.disconnect()
+
+    def on_userstate(self, _conn: client.ServerConnection, event: client.Event) -> None:
+        # Twitch sends USERSTATE when the bot joins a channel and after each message it sends. The
+        # higher limits only apply to channels where the bot is a moderator, but the queue is shared
+        # by all of them, so only use them if that's every channel.
+        tags = {i['key']: i['value'] for i in event.tags}
+        if tags.get('mod') == '1' or _has_badge(tags.get('badges') or '', 'broadcaster'):
+            self.moderator_channels.add(event.target)
+        else:
+            self.moderator_channels.discard(event.target)
+        is_moderator = self.moderator_channels.issuperset(self.channels)
+        if is_moderator == self.is_moderator:
+            return
+        logger.info(f'Bot is {"now" if is_moderator else "no longer"} a moderator, adjusting rate '
+                    f'limit.')
+        self.is_moderator = is_moderator
+        self.outbound.rate_limit.set_rate(*(MOD_RATE_LIMIT if is_moderator else USER_RATE_LIMIT))
+        self.outbound.duplicate_window = None if is_moderator else USER_DUPLICATE_WINDOW
+
+    def on_join(self, _conn: client.ServerConnection, event: client.Event) -> None:
+        if event.target in self.presence:
+            self.presence[event.target].join(event.source.nick)
+
+    def on_part(self, _conn: client.ServerConnection, event: client.Event) -> None:
+        if event.target in self.presence:
+            self.presence[event.target].part(event.source.nick)
+
+    def on_namreply(self, _conn: client.ServerConnection, event: client.Event) -> None:
+        # The list of who's already there, which Twitch sends after we join.
+        _, channel, names = event.arguments
+        if channel in self.presence:
+            for name in names.split():
+                self.presence[channel].join(name)
+
+    def reconcile_forever(self) -> None:
+        while not self.shutdown_event.is_set():
+            for channel, presence in self.presence.items():
+                presence.begin_reconcile()
+                names = None
+                try:
+                    names = self._fetch_chatters(channel)
+                finally:
+                    # Even if that blew up, so that the Presence stops collecting changes.
+                    presence.finish_reconcile(names)
+                metrics.gauge(f'twitch.chatters.{channel}').set(len(presence))
+            self.shutdown_event.wait(RECONCILE_INTERVAL.total_seconds())
+
+    def _fetch_chatters(self, channel: str) -> Optional[Iterable[str]]:
         try:
-            response = requests.get(f'https://tmi.twitch.tv/group/user/{name}/chatters')
+            # With a timeout, so that a hung request can't stall reconciling (and leave the
+            # Presence collecting changes) forever.
+            response = requests.get(f'https://tmi.twitch.tv/group/user/{channel[1:]}/chatters',
+                                    timeout=resilience.DEFAULT_TIMEOUT)
             response.raise_for_status()
-        except requests.RequestException as e:
-            # Log this and bail, but don't raise ServerError, so that we try again the next time the
-            # timer fires.
-            # TODO: Retry, once we're properly doing this off the event thread.
+            # Read it all now, so that a malformed response fails here, not in the Presence.
+            return list(itertools.chain.from_iterable(response.json()['chatters'].values()))
+        except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError):
+            # Log this and bail. Until the next try, JOIN and PART will have to do.
             logger.exception('Failed to get chatter list from TMI')
-            return []
-        data = response.json()
-        return itertools.chain.from_iterable(data['chatters'].values())
+            return None
+
+
+class TwitchChannelView(TwitchChat, irc_conn.ChannelView):
+    """A TwitchChatConnection's way of sending to one of its other channels."""
+    parent: TwitchChatConnection
+
+    @property
+    def presence(self) -> Dict[str, Presence]:  # type: ignore[override]
+        return self.parent.presence
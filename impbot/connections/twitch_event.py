@@ -59,6 +59,8 @@ class TwitchEventConnection(base.Connection):
         self.event_loop = asyncio.new_event_loop()
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.twitch_util = util
+        # For Helix calls from the event loop, so that they don't hold up the websocket.
+        self.async_util = twitch_util.AsyncTwitchUtil(util)
         # threading.Event, not asyncio.Event: We need it for communicating between threads, not
         # between coroutines.
         self.shutdown_event = threading.Event()
@@ -77,7 +79,7 @@ class TwitchEventConnection(base.Connection):
                     'wss://pubsub-edge.twitch.tv', close_timeout=1) as self.websocket:
                 response = await self.subscribe(self.websocket)
                 if response['error'] == 'ERR_BADAUTH':
-                    self.twitch_util.oauth.refresh()
+                    await self.async_util.call(self.twitch_util.oauth.refresh)
                     response = await self.subscribe(self.websocket)
                     if response['error'] == 'ERR_BADAUTH':
                         raise base.ServerError('Two BADAUTH errors, giving up.')
@@ -91,15 +93,14 @@ class TwitchEventConnection(base.Connection):
                         if body['type'] == 'RECONNECT':
                             logger.info('Reconnecting by request...')
                             break
-                        self.handle_message(on_event, body)
+                        await self.handle_message(on_event, body)
                 except websockets.ConnectionClosed:
                     pass
 
                 ping_task.cancel()
 
     async def subscribe(self, websocket: websockets.WebSocketClientProtocol) -> Dict[str, str]:
-        channel_id = self.twitch_util.get_channel_id(
-            self.twitch_util.streamer_username)
+        channel_id = await self.async_util.get_channel_id(self.twitch_util.streamer_username)
         nonce = twitch_util.nonce()
 
         await websocket.send(json.dumps({
@@ -132,7 +133,7 @@ class TwitchEventConnection(base.Connection):
         if self.websocket:
             asyncio.run_coroutine_threadsafe(self.websocket.close(), self.event_loop)
 
-    def handle_message(self, on_event: base.EventCallback, body: Dict[str, Any]) -> None:
+    async def handle_message(self, on_event: base.EventCallback, body: Dict[str, Any]) -> None:
         if body['type'] == 'PONG':
             return
         if body['type'] != 'MESSAGE':
@@ -145,29 +146,29 @@ class TwitchEventConnection(base.Connection):
         if mdata['moderation_action'] not in {'ban', 'unban', 'timeout', 'untimeout', 'delete'}:
             logger.info(f'Ignoring mod action {mdata["moderation_action"]}')
             return
-        user = self.twitch_user(mdata['created_by'], is_moderator=True)
+        # Look up the moderator and the target at the same time.
+        user, target = await asyncio.gather(
+            self.twitch_user(mdata['created_by'], is_moderator=True),
+            self.twitch_user(mdata['args'][0]))
         if mdata['moderation_action'] == 'ban':
-            [target_username, reason] = mdata['args']
-            on_event(Ban(self.reply_conn, user, self.twitch_user(target_username), reason))
+            [_, reason] = mdata['args']
+            on_event(Ban(self.reply_conn, user, target, reason))
         elif mdata['moderation_action'] == 'unban':
-            [target_username] = mdata['args']
-            on_event(Unban(self.reply_conn, user, self.twitch_user(target_username)))
+            on_event(Unban(self.reply_conn, user, target))
         elif mdata['moderation_action'] == 'timeout':
-            [target_username, duration_sec, reason] = mdata['args']
-            on_event(Timeout(
-                self.reply_conn, user, self.twitch_user(target_username),
-                datetime.timedelta(seconds=int(duration_sec)), reason))
+            [_, duration_sec, reason] = mdata['args']
+            on_event(Timeout(self.reply_conn, user, target,
+                             datetime.timedelta(seconds=int(duration_sec)), reason))
         elif mdata['moderation_action'] == 'untimeout':
-            [target_username] = mdata['args']
-            on_event(Untimeout(self.reply_conn, user, self.twitch_user(target_username)))
+            on_event(Untimeout(self.reply_conn, user, target))
         elif mdata['moderation_action'] == 'delete':
-            [target_username, message_text, message_id] = mdata['args']
-            on_event(
-                Delete(self.reply_conn, user, self.twitch_user(target_username), message_text))
+            [_, message_text, message_id] = mdata['args']
+            on_event(Delete(self.reply_conn, user, target, message_text))
 
-    def twitch_user(self, username, is_moderator: Optional[bool] = None) -> twitch.TwitchUser:
+    async def twitch_user(
+            self, username: str, is_moderator: Optional[bool] = None) -> twitch.TwitchUser:
         return twitch.TwitchUser(
-            name=username, display_name=self.twitch_util.get_display_name(username),
+            name=username, display_name=await self.async_util.get_display_name(username),
             is_moderator=is_moderator)
 
 
@@ -1,10 +1,11 @@
+import collections
 import hmac
 import json
 import logging
 import random
 import string
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, Iterable, Literal, Optional, Tuple, cast
 
 import attr
@@ -19,6 +20,15 @@ from impbot.util import twitch_util
 
 logger = logging.getLogger(__name__)
 
+# Twitch says to ignore any message older than this, so it's also how long we need to remember a
+# message ID in order to recognize a retry.
+MESSAGE_MAX_AGE = timedelta(minutes=10)
+# A bound on memory use, just in case. This is far more than we'd normally see in MESSAGE_MAX_AGE.
+MAX_REMEMBERED_IDS = 10_000
+# Twitch retries a notification if we take more than a few seconds to respond, so never keep it
+# waiting longer than this.
+ACK_BUDGET_SECONDS = 2.0
+
 
 class TwitchEventSubEvent(base.Event):
     pass
@@ -105,6 +115,7 @@ class TwitchEventSubConnection(base.Connection):
         self._shutdown_event = threading.Event()
         self._on_event: Optional[base.EventCallback] = None  # Set in run().
         self._secret = ''
+        self._seen_ids = _MessageIdCache(MESSAGE_MAX_AGE, MAX_REMEMBERED_IDS)
 
     def run(self, on_event: EventCallback) -> None:
         db = data.Namespace('impbot.connections.twitch_eventsub.TwitchEventSubConnection')
@@ -129,9 +140,11 @@ class TwitchEventSubConnection(base.Connection):
         self._shutdown_event.set()
 
     def _ensure_subscribed(self, subs: Iterable[Tuple[str, dict]]) -> None:
-        body = self.twitch_util.helix_get('eventsub/subscriptions', token_type='app')
+        # This endpoint doesn't take a page size.
+        existing = list(self.twitch_util.helix_paginate(
+            'eventsub/subscriptions', token_type='app', page_size=None))
         for type, condition in subs:
-            for sub in body['data']:
+            for sub in existing:
                 if not (sub['type'] == type and _condition_matches(sub['condition'], condition)):
                     continue
                 if sub['status'] != 'enabled':
@@ -163,8 +176,12 @@ class TwitchEventSubConnection(base.Connection):
     @web.url('/eventsub/callback', methods=['POST'])
     def callback(self):
         # If we just started up (but the subscriptions are still enabled from a previous run) the
-        # event callback and secret might not be populated yet, so wait until they are.
-        self._startup_event.wait()
+        # event callback and secret might not be populated yet, so wait until they are -- but only
+        # briefly. If we're still not ready, it's better to tell Twitch to try again than to leave it
+        # hanging.
+        if not self._startup_event.wait(timeout=ACK_BUDGET_SECONDS):
+            logger.warning('Not started up yet, asking Twitch to retry later.')
+            raise werkzeug.exceptions.ServiceUnavailable
 
         # We need the verbatim request body, with original whitespace, to check the message
         # signature. So instead of going straight to request.json() we pull the body data ourselves
@@ -184,7 +201,31 @@ class TwitchEventSubConnection(base.Connection):
             return ''
 
         if message_type == 'notification':
-            self._on_event(self._parse_notification(body['subscription']['type'], body['event']))
+            id = flask.request.headers['Twitch-Eventsub-Message-Id']
+            timestamp = parse(flask.request.headers['Twitch-Eventsub-Message-Timestamp'])
+            now = datetime.now(timezone.utc)
+            if now - timestamp > MESSAGE_MAX_AGE:
+                logger.warning('Ignoring stale notification %s from %s', id, timestamp)
+                return ''
+            event = self._parse_notification(body['subscription']['type'], body['event'])
+            user = body['event']
+            if user.get('user_id') and user.get('user_login'):  # They're null if anonymous.
+                self.twitch_util.users.update(int(user['user_id']), user['user_login'],
+                                              user.get('user_name') or user['user_login'])
+            # Twitch resends a notification (with the same ID) if it thinks we didn't get it the
+            # first time. Acknowledge the duplicate, but don't handle it twice.
+            if not self._seen_ids.add(id, now):
+                logger.info('Ignoring duplicate notification %s', id)
+                return ''
+            if isinstance(event, StreamStartedEvent):
+                self.twitch_util.stream_changed(online=True)
+            elif isinstance(event, StreamEndedEvent):
+                self.twitch_util.stream_changed(online=False)
+            elif isinstance(event, StreamChangedEvent):
+                self.twitch_util.stream_changed()
+            # This only puts the event on the queue, so it returns right away no matter how backed
+            # up the event thread is.
+            self._on_event(event)
             return ''
 
         logger.error('Unexpected message_type %s, body %s', message_type, body)
@@ -257,6 +298,34 @@ class TwitchEventSubConnection(base.Connection):
         raise werkzeug.exceptions.BadRequest
 
 
+class _MessageIdCache:
+    """
+    Remembers recently seen message IDs, for up to `max_age` (and at most `max_size` of them).
+
+    Thread-safe, since callbacks can arrive concurrently.
+    """
+
+    def __init__(self, max_age: timedelta, max_size: int) -> None:
+        self.max_age = max_age
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Message ID -> when we saw it. Insertion order is chronological, so the oldest are first.
+        self.seen: collections.OrderedDict[str, datetime] = collections.OrderedDict()
+
+    def add(self, id: str, now: datetime) -> bool:
+        """Records the ID, and returns True if it's new or False if we've already seen it."""
+        with self.lock:
+            while self.seen:
+                oldest_id, oldest_time = next(iter(self.seen.items()))
+                if now - oldest_time <= self.max_age and len(self.seen) < self.max_size:
+                    break
+                del self.seen[oldest_id]
+            if id in self.seen:
+                return False
+            self.seen[id] = now
+            return True
+
+
 def _event_user(event: Dict[str, Any]) -> Optional[twitch.TwitchUser]:
     if event.get('is_anonymous', False):
         return None
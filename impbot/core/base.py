@@ -53,6 +53,10 @@ class Event:
 class Message(Event):
     user: User
     text: str
+    # For connections that serve more than one chat channel: the channel the message came from, if
+    # it's not the connection's primary channel. (So it's always None for single-channel
+    # connections, and Namespace.for_channel(message.channel) finds the right data either way.)
+    channel: Optional[str] = attr.ib(default=None, kw_only=True)
 
 
 class UserError(Exception):
@@ -100,6 +100,8 @@ class Bot:
         if ws:
             self.web: Optional[web.WebServerConnection] = ws[0]
             self.web.init_routes(self.connections, self.handlers)
+            if self.web.stream_events:
+                self.observers.append(web.EventStreamObserver(self.web))
         else:
             self.web = None
 
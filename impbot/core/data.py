@@ -1,14 +1,23 @@
+import contextlib
 import itertools
 import logging
 import sqlite3
 import sys
 import threading
-from typing import Dict, Iterable, List, Optional, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 _db: Optional[str] = None
 SCHEMA_VERSION = 2
 
+# Each namespace's version counter goes up every time something in the namespace changes, so callers
+# can cheaply tell whether anything they derived from it is still current (see Namespace.version).
+# Versions only live in memory: they start over at 0 whenever the bot restarts. Stable versions
+# are the same, except that they skip changes marked volatile (see Namespace.stable_version).
+_versions: Dict[str, int] = {}
+_stable_versions: Dict[str, int] = {}
+_versions_lock = threading.Lock()
+
 
 def startup(db: str) -> None:
     global _db
@@ -16,13 +25,17 @@ def startup(db: str) -> None:
     _db = db
 
     conn = sqlite3.connect(db, uri=True)
+    if not _in_memory(db):
+        # In WAL mode, readers (like read-only web views, see Namespace.snapshot()) don't block the
+        # event thread's writes, and vice versa. The setting is persistent in the database file.
+        conn.execute('PRAGMA journal_mode = WAL')
     with conn:
         conn.execute('PRAGMA FOREIGN_KEYS = on')
         if not _table_exists(conn, 'keys'):
             if _table_exists(conn, 'impbot'):
                 logger.critical(f'{db} is in the old incompatible format!')
                 sys.exit(1)
-            if ':memory:' not in _db and 'mode=memory' not in _db:
+            if not _in_memory(db):
                 logger.warning("Database doesn't exist -- creating a new one. Welcome! :)")
 
             conn.executescript(f"""
@@ -54,6 +67,10 @@ def startup(db: str) -> None:
     conn.close()
 
 
+def _in_memory(db: str) -> bool:
+    return ':memory:' in db or 'mode=memory' in db
+
+
 def _table_exists(conn, table) -> bool:
     c = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
     return bool(c.fetchone())
@@ -68,6 +85,20 @@ class Namespace(object):
     def __init__(self, namespace: str) -> None:
         self.namespace = namespace
         self.thread_local = threading.local()
+        self.channels: Dict[str, Namespace] = {}
+        self.channels_lock = threading.Lock()
+
+    def for_channel(self, channel: Optional[str]) -> 'Namespace':
+        """
+        A separate namespace for the data that belongs to one chat channel (see Message.channel).
+        None means the primary channel, whose data lives in this namespace itself.
+        """
+        if channel is None:
+            return self
+        with self.channels_lock:
+            if channel not in self.channels:
+                self.channels[channel] = Namespace(f'{self.namespace}[{channel}]')
+            return self.channels[channel]
 
     @property
     def conn(self) -> sqlite3.Connection:
@@ -78,6 +109,48 @@ class Namespace(object):
             self.thread_local.conn.execute('PRAGMA FOREIGN_KEYS = on')
         return self.thread_local.conn
 
+    @property
+    def version(self) -> int:
+        """
+        A counter that increases every time a change to this namespace is committed, from any thread
+        and via any Namespace object for the same namespace.
+        """
+        return _versions.get(self.namespace, 0)
+
+    @property
+    def stable_version(self) -> int:
+        """
+        Like version, but it ignores writes made with volatile=True: things like usage counters that
+        change all the time, which a view that doesn't show them can safely ignore.
+        """
+        return _stable_versions.get(self.namespace, 0)
+
+    def _changed(self, volatile: bool = False) -> None:
+        # Call this only after the change is committed, so that anyone who sees the new version can
+        # also see the new data.
+        with _versions_lock:
+            _versions[self.namespace] = _versions.get(self.namespace, 0) + 1
+            if not volatile:
+                _stable_versions[self.namespace] = _stable_versions.get(self.namespace, 0) + 1
+
+    @contextlib.contextmanager
+    def snapshot(self) -> Iterator[None]:
+        """
+        Context manager that holds a read transaction open on this thread's connection, so that all
+        the reads inside it see the same consistent state of the database. Nothing inside it should
+        write to this namespace.
+        """
+        conn = self.conn
+        if conn.in_transaction:
+            # Already inside one, so it's already consistent.
+            yield
+            return
+        conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            conn.rollback()
+
     def get(self, key: str, subkey: Optional[str] = None, default: Optional[str] = None) -> str:
         try:
             if subkey is not None:
@@ -105,11 +178,25 @@ class Namespace(object):
             'SELECT subkey, value FROM key_subkey_values WHERE key_id=?', (key_id,))
         return {row[0]: row[1] for row in c}
 
-    def set_subkey(self, key: str, subkey: str, value: str) -> None:
+    def set_subkey(self, key: str, subkey: str, value: str, volatile: bool = False) -> None:
         with self.conn:
             key_id = self._find_key(self.conn, key, subkeys=True, create=True)
             self.conn.execute(
                 'REPLACE INTO key_subkey_values VALUES (?,?,?)', (key_id, subkey, value))
+        self._changed(volatile)
+
+    def set_subkeys(self, key: str, values: Dict[str, str], unset: Iterable[str] = ()) -> None:
+        """Sets (and unsets) any number of subkeys at once, in a single transaction."""
+        unset = list(unset)
+        if not values and not unset:
+            return
+        with self.conn:
+            key_id = self._find_key(self.conn, key, subkeys=True, create=True)
+            self.conn.executemany('REPLACE INTO key_subkey_values VALUES (?,?,?)',
+                                  ((key_id, subkey, value) for subkey, value in values.items()))
+            self.conn.executemany('DELETE FROM key_subkey_values WHERE key_id=? AND subkey=?',
+                                  ((key_id, subkey) for subkey in unset))
+        self._changed()
 
     def set(self, key: str, value: Union[str, Dict[str, str]]) -> None:
         if isinstance(value, str):
@@ -123,6 +210,7 @@ class Namespace(object):
                 for subkey, subvalue in value.items():
                     self.conn.execute(
                         'INSERT INTO key_subkey_values VALUES (?,?,?)', (key_id, subkey, subvalue))
+        self._changed()
 
     def increment_subkeys(self, key: str, subkeys: Iterable[str], delta: int = 1) -> None:
         if not subkeys:
@@ -142,6 +230,7 @@ class Namespace(object):
             self.conn.execute(f'UPDATE key_subkey_values SET value = value + ? '
                               f'WHERE key_id=? AND subkey IN ({qmarks})',
                               (delta, key_id) + tuple(subkeys))
+        self._changed()
 
     def _find_key(self, conn: sqlite3.Connection, key: str, subkeys: bool, create: bool) -> int:
         c = conn.execute(
@@ -175,6 +264,7 @@ class Namespace(object):
             with self.conn:
                 self.conn.execute(
                     'DELETE FROM keys WHERE namespace=? AND key=?', (self.namespace, key))
+        self._changed()
 
     def exists(self, key: str, subkey: Optional[str] = None) -> bool:
         if subkey is not None:
@@ -198,6 +288,7 @@ class Namespace(object):
                                   (self.namespace,) + tuple(except_keys))
             else:
                 self.conn.execute('DELETE FROM keys WHERE namespace=?', (self.namespace,))
+        self._changed()
 
     def get_all_values(self) -> Dict[str, str]:
         c = self.conn.execute(
@@ -218,3 +309,53 @@ class Namespace(object):
                 continue
             result[key][subkey] = value
         return result
+
+    # The iter_* methods stream their results in a stable order, a page at a time if you like: each
+    # takes the position of the last item of the previous page as `after`, and picks up from there.
+    # Rows are read from the database lazily, as the returned iterator is consumed.
+
+    def iter_all_values(self, after: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """Like get_all_values(), but iterates over (key, value) pairs in key order."""
+        c = self.conn.execute(
+            'SELECT key, value FROM keys INNER JOIN key_values ON keys.key_id = key_values.key_id '
+            'WHERE namespace=? AND key > ? ORDER BY key',
+            (self.namespace, after if after is not None else ''))
+        return iter(c)
+
+    def iter_all_dicts(self, after: Optional[str] = None) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """Like get_all_dicts(), but iterates over (key, dict) pairs in key order."""
+        c = self.conn.execute(
+            "SELECT key, subkey, value "
+            "FROM keys LEFT JOIN key_subkey_values ON keys.key_id = key_subkey_values.key_id "
+            "WHERE namespace=? AND type='KKV' AND key > ? ORDER BY key",
+            (self.namespace, after if after is not None else ''))
+        return ((key, {subkey: value for _, subkey, value in rows if value is not None})
+                for key, rows in itertools.groupby(c, lambda row: row[0]))
+
+    def iter_dict(self, key: str, after: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """Like get_dict(), but iterates over (subkey, value) pairs in subkey order."""
+        key_id = self._find_key(self.conn, key, subkeys=True, create=False)
+        c = self.conn.execute(
+            'SELECT subkey, value FROM key_subkey_values WHERE key_id=? AND subkey > ? '
+            'ORDER BY subkey',
+            (key_id, after if after is not None else ''))
+        return iter(c)
+
+    def iter_dict_by_int_value(
+            self, key: str, after: Optional[Tuple[int, str]] = None) -> Iterator[Tuple[str, int]]:
+        """
+        Iterates over the (subkey, value) pairs of a dict of integers, largest value first, with
+        ties in subkey order. `after` is the (value, subkey) of the last pair already seen.
+        """
+        key_id = self._find_key(self.conn, key, subkeys=True, create=False)
+        if after is None:
+            c = self.conn.execute(
+                'SELECT subkey, CAST(value AS INTEGER) AS n FROM key_subkey_values WHERE key_id=? '
+                'ORDER BY n DESC, subkey', (key_id,))
+        else:
+            value, subkey = after
+            c = self.conn.execute(
+                'SELECT subkey, CAST(value AS INTEGER) AS n FROM key_subkey_values '
+                'WHERE key_id=? AND (n < ? OR (n = ? AND subkey > ?)) ORDER BY n DESC, subkey',
+                (key_id, value, value, subkey))
+        return iter(c)
@@ -42,6 +42,18 @@ class DataTest(tests_util.DataHandlerTest):
         self.assertRaises(KeyError, foo.data.get, 'key')
         self.assertFalse(foo2.data.exists('key'))
 
+    def test_for_channel(self):
+        data = FooHandler().data
+        self.assertIs(data.for_channel(None), data)
+        other = data.for_channel('#other')
+        self.assertIs(data.for_channel('#other'), other)
+        data.set('key', 'primary')
+        other.set('key', 'other')
+        self.assertEqual(data.get('key'), 'primary')
+        self.assertEqual(FooHandler().data.for_channel('#other').get('key'), 'other')
+        data.unset('key')
+        other.unset('key')
+
     def test_subkeys(self):
         data = FooHandler().data
         self.assertFalse(data.exists('key'))
@@ -69,6 +81,13 @@ class DataTest(tests_util.DataHandlerTest):
         data.unset('key', 'e')
         self.assertFalse(data.exists('key', 'e'))
 
+    def test_set_subkeys(self):
+        data = FooHandler().data
+        data.set_subkeys('batch', {'a': 'alpha', 'b': 'bravo'})
+        self.assertEqual(data.get_dict('batch'), {'a': 'alpha', 'b': 'bravo'})
+        data.set_subkeys('batch', {'b': 'baker', 'c': 'charlie'}, unset=['a'])
+        self.assertEqual(data.get_dict('batch'), {'b': 'baker', 'c': 'charlie'})
+
     def test_increment(self):
         data = FooHandler().data
         data.set_subkey('key', 'a', '10')
@@ -110,3 +129,54 @@ class DataTest(tests_util.DataHandlerTest):
         self.assertRaises(TypeError, data.set, 'no_subkeys', {})
         self.assertRaises(TypeError, data.set, 'subkeys', 'value')
         self.assertRaises(TypeError, data.exists, 'no_subkeys', 'subkey')
+
+    def test_version(self):
+        data = FooHandler().data
+        other = FooHandler().data
+        version = data.version
+        data.set('key', 'value')
+        self.assertGreater(data.version, version)
+        # Another Namespace object for the same namespace sees the same counter...
+        self.assertEqual(other.version, data.version)
+        # ... but a different namespace doesn't.
+        bar_version = BarHandler().data.version
+        data.unset('key')
+        self.assertEqual(BarHandler().data.version, bar_version)
+
+    def test_stable_version(self):
+        data = FooHandler().data
+        version = data.version
+        stable_version = data.stable_version
+        data.set_subkey('command', 'count', '1', volatile=True)
+        self.assertGreater(data.version, version)
+        self.assertEqual(data.stable_version, stable_version)
+        data.set_subkey('command', 'response', 'hi')
+        self.assertGreater(data.stable_version, stable_version)
+
+    def test_iter(self):
+        data = FooHandler().data
+        data.set('b', 'bravo')
+        data.set('a', 'alpha')
+        data.set('c', 'charlie')
+        self.assertEqual(list(data.iter_all_values()), [('a', 'alpha'), ('b', 'bravo'),
+                                                        ('c', 'charlie')])
+        self.assertEqual(list(data.iter_all_values(after='a')), [('b', 'bravo'), ('c', 'charlie')])
+        data.clear_all()
+
+        data.set('x', {'1': 'one', '2': 'two'})
+        data.set('y', {})
+        data.set('z', {'3': 'three'})
+        self.assertEqual(list(data.iter_all_dicts()),
+                         [('x', {'1': 'one', '2': 'two'}), ('y', {}), ('z', {'3': 'three'})])
+        self.assertEqual(list(data.iter_all_dicts(after='x')), [('y', {}), ('z', {'3': 'three'})])
+        self.assertEqual(list(data.iter_dict('x', after='1')), [('2', 'two')])
+        self.assertRaises(KeyError, data.iter_dict, 'nope')
+        data.clear_all()
+
+    def test_iter_by_int_value(self):
+        data = FooHandler().data
+        data.set('key', {'a': '10', 'b': '300', 'c': '20', 'd': '20'})
+        ranked = [('b', 300), ('c', 20), ('d', 20), ('a', 10)]
+        self.assertEqual(list(data.iter_dict_by_int_value('key')), ranked)
+        self.assertEqual(list(data.iter_dict_by_int_value('key', after=(20, 'c'))), ranked[2:])
+        data.clear_all()
@@ -1,8 +1,13 @@
+import json
+import threading
 import unittest
 from typing import Dict
 
-from impbot.handlers import hello
+from impbot.connections import twitch, twitch_eventsub
 from impbot.core import web
+from impbot.handlers import command
+from impbot.handlers import hello
+from impbot.util import tests_util
 
 
 class WebTest(unittest.TestCase):
@@ -20,4 +25,141 @@ class WebTest(unittest.TestCase):
         self.assertEqual(actual_map, {
             '/static/<path:filename>': 'static',
             '/hello': 'HelloHandler.web',
+            '/metrics': 'WebServerConnection.metrics',
         })
+
+
+class ReadOnlyHandler(command.CommandHandler):
+    @web.url('/read_only', read_only=True)
+    def web(self) -> str:
+        return f"{self.data.get('key', default='none')} {threading.current_thread().name}"
+
+
+class ReadOnlyWebTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.web_conn = web.WebServerConnection('127.0.0.1', 9999, '127.0.0.1:9999')
+        self.handler = ReadOnlyHandler()
+        self.web_conn.init_routes([], [self.handler])
+
+    def tearDown(self):
+        self.web_conn.flask_server.server_close()
+        self.handler.data.clear_all()
+        super().tearDown()
+
+    def testRunsOnWebThread(self):
+        # There's no event thread at all here (on_event is still None) so if the view were delegated
+        # to it, this would fail.
+        self.handler.data.set('key', 'value')
+        response = self.web_conn.flask.test_client().get('/read_only')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True),
+                         f'value {threading.current_thread().name}')
+
+
+class CachedHandler(command.CommandHandler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.renders = 0
+
+    @web.url('/stable', read_only=True, cached=True, ignore_volatile=True)
+    def stable(self) -> str:
+        self.renders += 1
+        return self.data.get('key', 'shown', default='none')
+
+    @web.url('/cached', read_only=True, cached=True)
+    def web(self) -> str:
+        self.renders += 1
+        return self.data.get('key', default='none')
+
+
+class CachedWebTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.web_conn = web.WebServerConnection('127.0.0.1', 9999, '127.0.0.1:9999')
+        self.handler = CachedHandler()
+        self.web_conn.init_routes([], [self.handler])
+        self.client = self.web_conn.flask.test_client()
+
+    def tearDown(self):
+        self.web_conn.flask_server.server_close()
+        self.handler.data.clear_all()
+        super().tearDown()
+
+    def testCache(self):
+        first = self.client.get('/cached')
+        self.assertEqual(first.get_data(as_text=True), 'none')
+        etag = first.headers['ETag']
+        second = self.client.get('/cached')
+        self.assertEqual(second.get_data(as_text=True), 'none')
+        self.assertEqual(second.headers['ETag'], etag)
+        self.assertEqual(self.handler.renders, 1)
+
+        not_modified = self.client.get('/cached', headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(self.handler.renders, 1)
+
+        self.handler.data.set('key', 'value')
+        modified = self.client.get('/cached', headers={'If-None-Match': etag})
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(modified.get_data(as_text=True), 'value')
+        self.assertNotEqual(modified.headers['ETag'], etag)
+        self.assertEqual(self.handler.renders, 2)
+
+    def testIgnoreVolatile(self):
+        etag = self.client.get('/stable').headers['ETag']
+        self.handler.data.set_subkey('key', 'count', '1', volatile=True)
+        not_modified = self.client.get('/stable', headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(self.handler.renders, 1)
+
+        self.handler.data.set_subkey('key', 'shown', 'value')
+        modified = self.client.get('/stable', headers={'If-None-Match': etag})
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(modified.get_data(as_text=True), 'value')
+        self.assertEqual(self.handler.renders, 2)
+
+    def testOnlyReadOnly(self):
+        self.assertRaises(ValueError, web.url, '/foo', cached=True)
+        self.assertRaises(ValueError, web.url, '/foo', read_only=True, ignore_volatile=True)
+
+
+class EventStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = web.WebServerConnection(
+            '127.0.0.1', 9999, '127.0.0.1:9999',
+            stream_events=[twitch_eventsub.StreamChangedEvent])
+        self.observer = web.EventStreamObserver(self.conn)
+
+    def tearDown(self):
+        self.conn.flask_server.server_close()
+
+    def testPublish(self):
+        everything = self.conn.subscribe()
+        nothing = self.conn.subscribe({'Bits'})
+        self.observer.observe(twitch_eventsub.StreamChangedEvent(None, 'Hello world!', 'Art'))
+        self.observer.observe(twitch_eventsub.StreamStartedEvent(None))  # Not streamed.
+        name, payload = everything.queue.get_nowait()
+        self.assertEqual(name, 'StreamChangedEvent')
+        self.assertEqual(json.loads(payload),
+                         {'type': 'StreamChangedEvent', 'title': 'Hello world!', 'category': 'Art'})
+        self.assertTrue(everything.queue.empty())
+        self.assertTrue(nothing.queue.empty())
+
+    def testUserFields(self):
+        user = twitch.TwitchUser('user', admin=False, display_name='User',
+                                 badges_tag='moderator/1,subscriber/12')
+        self.assertEqual(web._jsonable(user), {'name': 'user', 'admin': False,
+                                               'display_name': 'User', 'moderator': True})
+
+    def testSlowSubscriber(self):
+        subscriber = self.conn.subscribe()
+        for i in range(web.STREAM_BUFFER_SIZE + 10):
+            self.conn.publish(twitch_eventsub.StreamChangedEvent(None, str(i), None))
+        self.assertEqual(subscriber.dropped, 10)
+        # The oldest ones are the ones that got dropped.
+        _, payload = subscriber.queue.get_nowait()
+        self.assertEqual(json.loads(payload)['title'], '10')
+        self.conn.unsubscribe(subscriber)
+        self.conn.publish(twitch_eventsub.StreamChangedEvent(None, 'more', None))
+        self.assertEqual(subscriber.queue.qsize(), web.STREAM_BUFFER_SIZE - 1)
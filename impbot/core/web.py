@@ -1,22 +1,44 @@
+import base64
+import collections
+import datetime
 import functools
+import json
 import logging
 import queue
+import secrets
 import sys
+import threading
 from os import path
-from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Type, Union, cast
+from typing import (Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple, Type,
+                    Union, cast)
 
+import attr
 import flask
+import werkzeug.exceptions
 from flask import views
 from werkzeug import serving
 
 from impbot.core import base
+from impbot.core import data
 from impbot.handlers import lambda_event
+from impbot.util import metrics
 
 logger = logging.getLogger(__name__)
 
+# Each cached view keeps at most this many renders (one per distinct path and query string).
+MAX_CACHED_RESPONSES = 64
+# Each /events/stream client can fall this many events behind before we start dropping the oldest.
+STREAM_BUFFER_SIZE = 100
+# If there's nothing to send for this long, send a comment line, to keep proxies from hanging up.
+STREAM_KEEPALIVE_SECONDS = 15
+# Page sizes for paginated JSON APIs (see page_request()).
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
 
 class WebServerConnection(base.Connection):
-    def __init__(self, bind_host: str, bind_port: int, url_host: str) -> None:
+    def __init__(self, bind_host: str, bind_port: int, url_host: str,
+                 stream_events: Sequence[Type[base.Event]] = ()) -> None:
         """
         `bind_host` and `bind_port` are the address to actually bind a network socket to, while
         `url_host` is the user-facing host used in URLs.
@@ -24,33 +46,55 @@ class WebServerConnection(base.Connection):
         For example, if running behind a local proxy, bind_host might be 127.0.0.1 and bind_port
         might be a high-numbered port, whereas url_host would be the user-facing domain name (and
         implicit port 80/443, served by the proxy).
+
+        If `stream_events` is nonempty, events of those types (and their subtypes) are published as
+        JSON to any number of clients at /events/stream, as server-sent events. Clients can narrow
+        that down further with a comma-separated list of event type names, like
+        /events/stream?types=Bits,NewFollowerEvent.
         """
         self.on_event: Optional[base.EventCallback] = None
+        self.stream_events = tuple(stream_events)
+        self._subscribers: Set[_Subscriber] = set()
+        self._subscribers_lock = threading.Lock()
+        self._shutdown_event = threading.Event()
         templates = path.join(sys.path[0], 'templates')
         self.flask = flask.Flask(__name__, template_folder=templates)
         self.flask.config['SERVER_NAME'] = url_host
-        self.flask_server = serving.make_server(bind_host, bind_port, self.flask)
+        # Serve each request on its own thread, so that long-lived event streams (and slow clients
+        # in general) don't hold up everyone else.
+        self.flask_server = serving.make_server(bind_host, bind_port, self.flask, threaded=True)
 
     def init_routes(self, connections: Sequence[base.Connection],
                     handlers: Sequence[base.Handler[Any]]) -> None:
         for connection in connections:
-            for url, view_func, options in connection.url_rules:
-                endpoint = f'{type(connection).__name__}.{view_func.__name__}'
+            for rule in connection.url_rules:
+                endpoint = f'{type(connection).__name__}.{rule.view_func.__name__}'
                 # The class's url_rules stores the unbound method (because the @url decorator kicks
                 # in before the instance is created) so bind it to the instance now.
-                view_func = functools.partial(view_func, connection)
-                self.flask.add_url_rule(url, endpoint, view_func, **options)
+                view_func = functools.partial(rule.view_func, connection)
+                self.flask.add_url_rule(rule.url, endpoint, view_func, **rule.options)
 
         # For Handlers, arrange to call the view function on the Handler thread (in order to make it
         # easy to share data with other Handler methods). In order to do that, wrap the supplied
         # view in a view class that bundles it into a LambdaEvent, then blocks waiting for the
-        # result.
+        # result. Read-only views are the exception: they only need a consistent view of the
+        # Handler's data, so they run right here on the web server thread instead.
         for handler in handlers:
-            for url, view_func, options in handler.url_rules:
-                endpoint = f'{type(handler).__name__}.{view_func.__name__}'
-                view_func = functools.partial(view_func, handler)
-                view_func = _DelegatingView.as_view(endpoint, self, view_func)
-                self.flask.add_url_rule(url, view_func=view_func, **options)
+            for rule in handler.url_rules:
+                endpoint = f'{type(handler).__name__}.{rule.view_func.__name__}'
+                view_func = functools.partial(rule.view_func, handler)
+                if rule.read_only:
+                    cache = _ResponseCache() if rule.cached else None
+                    view_func = _SnapshotView.as_view(endpoint, handler.data, view_func, cache,
+                                                      rule.ignore_volatile)
+                else:
+                    view_func = _DelegatingView.as_view(endpoint, self, view_func)
+                self.flask.add_url_rule(rule.url, view_func=view_func, **rule.options)
+
+        self.flask.add_url_rule('/metrics', 'WebServerConnection.metrics', self.metrics)
+        if self.stream_events:
+            self.flask.add_url_rule(
+                '/events/stream', 'WebServerConnection.event_stream', self.event_stream)
 
     def run(self, on_event: base.EventCallback) -> None:
         self.on_event = on_event
@@ -58,8 +102,128 @@ class WebServerConnection(base.Connection):
         self.flask_server.serve_forever()
 
     def shutdown(self) -> None:
+        self._shutdown_event.set()
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.put(None)  # Wake up the stream so it notices the shutdown.
         self.flask_server.shutdown()
 
+    def metrics(self) -> flask.Response:
+        return flask.jsonify(metrics.snapshot())
+
+    def publish(self, event: base.Event) -> None:
+        """
+        Sends an event to every /events/stream client that wants it. This never blocks: if a client
+        isn't keeping up, it misses its oldest events instead.
+        """
+        name = type(event).__name__
+        payload = json.dumps({'type': name, **_jsonable(event)})
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if subscriber.types is None or name in subscriber.types:
+                subscriber.put((name, payload))
+
+    def subscribe(self, types: Optional[Set[str]] = None) -> '_Subscriber':
+        subscriber = _Subscriber(types)
+        with self._subscribers_lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: '_Subscriber') -> None:
+        with self._subscribers_lock:
+            self._subscribers.discard(subscriber)
+        if subscriber.dropped:
+            logger.info('Event stream client fell behind and missed %d events.', subscriber.dropped)
+
+    def event_stream(self) -> flask.Response:
+        types_arg = flask.request.args.get('types')
+        types = set(types_arg.split(',')) if types_arg else None
+        subscriber = self.subscribe(types)
+
+        def stream() -> Iterator[str]:
+            try:
+                while not self._shutdown_event.is_set():
+                    try:
+                        item = subscriber.queue.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    if item is None:
+                        break
+                    name, payload = item
+                    yield f'event: {name}\ndata: {payload}\n\n'
+            finally:
+                # This also runs when the client hangs up, since the server closes the generator.
+                self.unsubscribe(subscriber)
+
+        return flask.Response(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+class _Subscriber:
+    """One /events/stream client, with its own bounded buffer of events waiting to be sent."""
+
+    def __init__(self, types: Optional[Set[str]]) -> None:
+        self.types = types  # None for all the streamed event types.
+        self.queue: queue.Queue[Optional[Tuple[str, str]]] = queue.Queue(
+            maxsize=STREAM_BUFFER_SIZE)
+        self.dropped = 0
+
+    def put(self, item: Optional[Tuple[str, str]]) -> None:
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            # Make room by dropping the oldest event. (The stream thread might beat us to it, in
+            # which case there's room now anyway.)
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+
+class EventStreamObserver(base.Observer[base.Event]):
+    """
+    Taps every event the bot handles, and publishes the ones the WebServerConnection is configured
+    to stream. The Bot installs this automatically when there are any stream_events.
+    """
+
+    def __init__(self, web: WebServerConnection) -> None:
+        super().__init__()
+        self.web = web
+
+    def observe(self, event: base.Event) -> None:
+        if isinstance(event, self.web.stream_events):
+            self.web.publish(event)
+
+
+def _jsonable(value: Any) -> Any:
+    if attr.has(type(value)):
+        # The reply connection is an implementation detail, and not serializable anyway. So are
+        # private fields, and any marked with metadata={'json': False}.
+        result = {field.name: _jsonable(getattr(value, field.name))
+                  for field in attr.fields(type(value))
+                  if field.name != 'reply_connection' and not field.name.startswith('_')
+                  and field.metadata.get('json', True)}
+        if isinstance(value, base.User):
+            result['moderator'] = value.moderator
+        return result
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_jsonable(i) for i in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return str(value)
+
 
 # ViewResponse is the union of allowed return types from a view function, according to Flask docs.
 # (Returning a WSGI application is also allowed, omitted here.)
@@ -69,7 +233,16 @@ ViewResponse = Union[SimpleViewResponse,
                      Tuple[SimpleViewResponse, int],
                      Tuple[SimpleViewResponse, Dict[str, str]]]
 ViewFunc = Callable[..., ViewResponse]
-UrlRule = Tuple[str, ViewFunc, Dict[str, Any]]
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class UrlRule:
+    url: str
+    view_func: ViewFunc
+    options: Dict[str, Any]  # Passed through to Flask's add_url_rule.
+    read_only: bool = False
+    cached: bool = False
+    ignore_volatile: bool = False
 
 
 class _DelegatingView(views.View):
@@ -111,24 +284,193 @@ class _DelegatingView(views.View):
         return result
 
 
-def url(url: str, **options):
+class _SnapshotView(views.View):
+    """
+    A Flask View that wraps a read-only Handler view and runs it directly on the web server thread.
+
+    The subview runs inside a read transaction on the Handler's data namespace, so every query it
+    makes sees the same consistent state of the database, even if the event thread is writing to it
+    at the same time. Since it doesn't wait for the event thread, slow page loads and busy chat
+    don't hold each other up.
+
+    If the view is cached, responses are tagged with an ETag derived from the namespace's version
+    counter. A request whose If-None-Match already has the current ETag gets a bare 304, and
+    otherwise a render from the cache is reused as long as the namespace hasn't changed since.
+    With ignore_volatile, the namespace's stable version is used instead, so volatile writes don't
+    count as changes.
+    """
+
+    def __init__(self, namespace: data.Namespace, subview: ViewFunc,
+                 cache: Optional['_ResponseCache'], ignore_volatile: bool = False) -> None:
+        self.namespace = namespace
+        self.subview = subview
+        self.cache = cache
+        self.ignore_volatile = ignore_volatile
+
+    def dispatch_request(self, *args: Any, **kwargs: Any) -> ViewResponse:
+        if self.cache is None:
+            with self.namespace.snapshot():
+                return self.subview(*args, **kwargs)
+
+        # Read the version *before* rendering. If the namespace changes mid-render, the worst case
+        # is that a newer render gets filed under the older version, and is thrown away next time.
+        if self.ignore_volatile:
+            version = self.namespace.stable_version
+        else:
+            version = self.namespace.version
+        etag = f'{_BOOT_ID}-{version}'
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            key = flask.request.full_path
+            response = self.cache.get(key, version)
+            if response is None:
+                with self.namespace.snapshot():
+                    response = flask.make_response(self.subview(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.cache.put(key, version, response)
+        response.set_etag(etag)
+        # Let clients keep a copy, but make them check back with the ETag every time.
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+# Distinguishes ETags from different runs of the bot, since namespace versions restart at zero.
+_BOOT_ID = secrets.token_hex(4)
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class _CachedResponse:
+    version: int
+    body: bytes
+    headers: Sequence[Tuple[str, str]]
+
+
+class _ResponseCache:
+    """A small LRU cache of rendered responses for one view, keyed on path and query string."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict[str, _CachedResponse] = collections.OrderedDict()
+
+    def get(self, key: str, version: int) -> Optional[flask.Response]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+            self.entries.move_to_end(key)
+        return flask.Response(entry.body, 200, list(entry.headers))
+
+    def put(self, key: str, version: int, response: flask.Response) -> None:
+        entry = _CachedResponse(version, response.get_data(), list(response.headers.items()))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > MAX_CACHED_RESPONSES:
+                self.entries.popitem(last=False)
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class PageRequest:
+    limit: int
+    # The position of the last item on the previous page, as passed to json_page() -- or None for
+    # the first page.
+    cursor: Any
+    fields: Optional[Set[str]]  # None for all fields.
+
+
+def page_request(cursor_type: Type = str) -> PageRequest:
+    """
+    Parses the pagination parameters for a JSON API view from the current request's query string:
+    `limit` (the page size), `cursor` (from the previous page's next_cursor) and `fields` (a
+    comma-separated list of fields to include in each item). The decoded cursor must be an instance
+    of `cursor_type`.
+    """
+    args = flask.request.args
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest('limit must be a number')
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = None
+    if args.get('cursor'):
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(args['cursor']))
+        except ValueError:
+            raise werkzeug.exceptions.BadRequest('Bad cursor')
+        if not isinstance(cursor, cursor_type):
+            raise werkzeug.exceptions.BadRequest('Bad cursor')
+    fields = set(args['fields'].split(',')) if args.get('fields') else None
+    return PageRequest(limit, cursor, fields)
+
+
+def json_page(page: PageRequest, items: Iterable[Tuple[Any, Dict[str, Any]]]) -> flask.Response:
+    """
+    Renders one page of a JSON API response.
+
+    `items` yields (position, item) pairs, starting just after page.cursor; each position is any
+    JSON-serializable value the view can use to pick up again after that item. This only consumes
+    as many items as it needs, so it's best to pass an iterator that reads lazily.
+    """
+    result = []
+    last_position = None
+    more = False
+    for position, item in items:
+        if len(result) == page.limit:
+            more = True
+            break
+        if page.fields is not None:
+            item = {k: v for k, v in item.items() if k in page.fields}
+        result.append(item)
+        last_position = position
+    next_cursor = None
+    if more:
+        next_cursor = base64.urlsafe_b64encode(json.dumps(last_position).encode()).decode()
+    return flask.jsonify(data=result, next_cursor=next_cursor)
+
+
+def url(url: str, read_only: bool = False, cached: bool = False, ignore_volatile: bool = False,
+        **options):
     """
     Decorator that turns a Connection or Handler method into a web view.
 
-    The args are as Flask's app.route decorator.
+    The args are as Flask's app.route decorator, plus `read_only` and `cached`. Handler views
+    normally run on the event thread, so they can safely share state with the Handler's other
+    methods. A view that only reads from the Handler's data namespace (and doesn't touch any other
+    Handler state) can set read_only=True to run on the web server thread instead, against a
+    consistent snapshot of the database. Connection views always run on the web server thread, so
+    it makes no difference there.
+
+    A read-only Handler view whose output depends only on the request URL and the Handler's data
+    namespace can also set cached=True. Then it's only rendered again after the namespace changes,
+    and clients that already have the latest version get a 304 Not Modified. If it doesn't show
+    anything the Handler writes with volatile=True (like usage counts), it can also set
+    ignore_volatile=True, so that those writes don't make it render again.
     """
-    return functools.partial(_UrlDecorator, url, options)
+    if cached and not read_only:
+        raise ValueError('Only read-only views can be cached.')
+    if ignore_volatile and not cached:
+        raise ValueError('Only cached views can ignore volatile writes.')
+    return functools.partial(_UrlDecorator, url, read_only, cached, ignore_volatile, options)
 
 
 class _UrlDecorator:
-    def __init__(self, url: str, options: Dict[str, Any], func: ViewFunc):
+    def __init__(self, url: str, read_only: bool, cached: bool, ignore_volatile: bool,
+                 options: Dict[str, Any], func: ViewFunc):
         self.url = url
+        self.read_only = read_only
+        self.cached = cached
+        self.ignore_volatile = ignore_volatile
         self.options = options
         self.func = func
 
     def __set_name__(self, owner: Type[base.Module], name: str):
+        if self.cached and not issubclass(owner, base.Handler):
+            raise TypeError('Only Handler views can be cached.')
         # We want to modify owner's url_rules, not the one inherited from Connection or Handler.
         if 'url_rules' not in owner.__dict__:
             owner.url_rules = []
-        owner.url_rules.append((self.url, self.func, self.options))
+        owner.url_rules.append(
+            UrlRule(self.url, self.func, self.options, self.read_only, self.cached,
+                    self.ignore_volatile))
         setattr(owner, name, self.func)
@@ -1,7 +1,6 @@
 import logging
-import threading
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Optional, cast
 
 import dateutil.parser
 
@@ -11,6 +10,7 @@ from impbot.handlers import command
 from impbot.util import twitch_util
 
 logger = logging.getLogger(__name__)
+TIMER_NAME = 'AnnouncementHandler.announce'
 
 
 class AnnouncementHandler(command.CommandHandler):
@@ -20,29 +20,30 @@ class AnnouncementHandler(command.CommandHandler):
         self.chat = chat
         self.timer_conn = timer_conn
         self.util = util
+        self.timer: Optional[timer.RepeatingTimer] = None
 
     def startup(self) -> None:
-        interval = self._interval()
-        try:
-            last_announce = self.data.get('last_announce')
-        except KeyError:
-            last_announce_time = datetime.fromtimestamp(0, tz=timezone.utc)
-        else:
-            last_announce_time = dateutil.parser.isoparse(last_announce)
-        if datetime.now(timezone.utc) - last_announce_time > interval:
-            # The announcement is overdue. This happens if the bot was offline when it should have
-            # fired. (It also happens when the bot is started up for the first time, but then we
-            # just announce the empty string until the text is set.)
-            self.announce()
-            last_announce_time = datetime.now(timezone.utc)
-        # Wait out the rest of the interval, then announce and start the repeating timer.
-        wait = last_announce_time + interval - datetime.now(timezone.utc)
-
-        def run():
-            self.announce()
-            self.timer_conn.start_repeating(self._interval(), self.announce)
-
-        threading.Timer(wait.total_seconds(), run).start()
+        # If the bot was offline when the announcement should have fired, it fires right away.
+        resumed = self.timer_conn.resume_durable(TIMER_NAME, self.announce, catch_up='once')
+        if resumed is None:
+            interval = self._interval()
+            first_interval = interval
+            try:
+                last_announce = self.data.get('last_announce')
+            except KeyError:
+                last_announce = None
+            else:
+                # Saved by versions from before durable timers. Pick up where they left off (firing
+                # right away, if the announcement is overdue) and then the timer takes over.
+                first_interval = max(dateutil.parser.isoparse(last_announce) + interval -
+                                     datetime.now(timezone.utc), timedelta(0))
+            resumed = self.timer_conn.start_durable(
+                TIMER_NAME, interval, self.announce, repeating=True, first_interval=first_interval)
+            if last_announce is not None:
+                self.data.unset('last_announce')
+        self.timer = cast(timer.RepeatingTimer, resumed)
+        # In case the interval setting changed while we were down.
+        self.timer.interval = self._interval()
 
     def _interval(self) -> timedelta:
         return timedelta(minutes=int(self.data.get('interval', default='30')))
@@ -56,7 +57,6 @@ class AnnouncementHandler(command.CommandHandler):
             self.chat.say(announcement)
         else:
             logger.debug('Offline, not announcing.')
-        self.data.set('last_announce', str(datetime.now(timezone.utc)))
 
     def run_setannouncement(self, message: base.Message, text: str) -> Optional[str]:
         if not (message.user.moderator or message.user.admin):
@@ -1,7 +1,7 @@
 import collections
 import datetime
 import html
-from typing import Dict, Optional, Tuple, cast
+from typing import Any, Dict, Optional, Tuple, cast
 
 import flask
 
@@ -49,16 +49,24 @@ class CustomCommandHandler(command.CommandHandler):
 
         # self.lookup is guaranteed non-None by check().
         name, comm = cast(Tuple[str, CommandDict], self.lookup)
+        data = self.data.for_channel(message.channel)
         if 'cooldowns' in comm:
             cooldowns = eval(comm['cooldowns'])
             if not cooldowns.fire(message.user):
                 return None
-            self.data.set_subkey(name, 'cooldowns', repr(cooldowns))
+            data.set_subkey(name, 'cooldowns', repr(cooldowns), volatile=True)
         count = int(comm['count']) + 1
-        self.data.set_subkey(name, 'count', str(count))
+        # Volatile, so that using a command doesn't make /commands render again.
+        data.set_subkey(name, 'count', str(count), volatile=True)
         return comm['response'].replace('(count)', f'{count:,}')
 
-    @web.url('/commands')
+    @web.url('/api/commands', read_only=True, cached=True)
+    def api(self) -> flask.Response:
+        page = web.page_request()
+        return web.json_page(page, ((name, _command_json(name, subkeys))
+                                    for name, subkeys in self.data.iter_all_dicts(page.cursor)))
+
+    @web.url('/commands', read_only=True, cached=True, ignore_volatile=True)
     def web(self) -> str:
         data = self.data.get_all_dicts().items()
         aliases = collections.defaultdict(set)
@@ -79,22 +87,23 @@ class CustomCommandHandler(command.CommandHandler):
 
     def _lookup_message(self, message: base.Message) -> Optional[Tuple[str, CommandDict]]:
         name = normalize(message.text.split(None, 1)[0])
-        return self._lookup(name)
+        return self._lookup(message, name)
 
-    def _lookup(self, name: str) -> Optional[Tuple[str, CommandDict]]:
+    def _lookup(self, message: base.Message, name: str) -> Optional[Tuple[str, CommandDict]]:
         """
-        Look up the right command from the DB, resolving aliases, or None if it doesn't exist
-        (including if an alias points to a command that isn't there, or if there are aliases in a
-        loop). Never returns an alias.
+        Look up the right command from the DB for the message's channel (each channel has its own
+        commands), resolving aliases, or None if it doesn't exist (including if an alias points to a
+        command that isn't there, or if there are aliases in a loop). Never returns an alias.
 
         (We don't actually expect aliases to point to other aliases, but if it does happen, better
         to follow the chain than have problems.)
         """
+        data = self.data.for_channel(message.channel)
         visited = set()
         while True:
             visited.add(name)
             try:
-                result = self.data.get_dict(name)
+                result = data.get_dict(name)
             except KeyError:
                 return None
             if 'alias' in result:
@@ -108,11 +117,12 @@ class CustomCommandHandler(command.CommandHandler):
 
     def run_addcom(self, message: base.Message, name: str, text: str) -> str:
         name = normalize(name)
-        if self.data.exists(name):
+        data = self.data.for_channel(message.channel)
+        if data.exists(name):
             raise base.UserError(f'!{name} already exists.')
         if hasattr(self, 'run_' + name):
             raise base.UserError(f"Can't use !{name} for a command.")
-        self.data.set(name, {
+        data.set(name, {
             'response': text,
             'count': '0',
             'cooldowns': repr(cooldown.GlobalAndUserCooldowns(datetime.timedelta(seconds=5), None)),
@@ -124,10 +134,11 @@ class CustomCommandHandler(command.CommandHandler):
 
     def run_editcom(self, message: base.Message, name: str, text: str) -> str:
         name = normalize(name)
-        lookup = self._lookup(name)
+        data = self.data.for_channel(message.channel)
+        lookup = self._lookup(message, name)
         if lookup:
             lookup_name, lookup_data = lookup
-            self.data.set_subkey(lookup_name, 'response', text)
+            data.set_subkey(lookup_name, 'response', text)
             if self.discord:
                 msg = f'**{message.user}** edited the command **!{lookup_name}**:\n\n{text}'
                 self.discord.embed(EMBED_COLOR, msg, {'Old response': lookup_data['response']})
@@ -136,7 +147,7 @@ class CustomCommandHandler(command.CommandHandler):
             else:
                 return f'Edited !{name} (alias to !{lookup_name}).'
         else:
-            self.data.set(name, {
+            data.set(name, {
                 'response': text,
                 'count': '0'
             })
@@ -147,11 +158,12 @@ class CustomCommandHandler(command.CommandHandler):
 
     def run_delcom(self, message: base.Message, name: str) -> str:
         name = normalize(name)
+        data = self.data.for_channel(message.channel)
         try:
-            comm = self.data.get_dict(name)
+            comm = data.get_dict(name)
         except KeyError:
             raise base.UserError(f"!{name} doesn't exist.")
-        self.data.unset(name)
+        data.unset(name)
         if 'alias' in comm:
             target = comm['alias']
             if self.discord:
@@ -168,30 +180,38 @@ class CustomCommandHandler(command.CommandHandler):
                 self.discord.embed(EMBED_COLOR, msg, fields)
             return f'Deleted !{name}.'
 
-    def run_resetcount(self, name: str, count: Optional[int]) -> str:
+    def run_resetcount(self, message: base.Message, name: str, count: Optional[int]) -> str:
         if count is None:
             count = 0
         name = normalize(name)
-        lookup = self._lookup(name)
+        lookup = self._lookup(message, name)
         if not lookup:
             raise base.UserError(f"!{name} doesn't exist")
         name, _ = lookup
-        self.data.set_subkey(name, 'count', str(count))
+        self.data.for_channel(message.channel).set_subkey(name, 'count', str(count), volatile=True)
         return f'Reset !{name} counter to {count}.'
 
     def run_aliascom(self, message: base.Message, name: str, target: str):
         name = normalize(name)
         target = normalize(target)
-        if self.data.exists(name):
+        data = self.data.for_channel(message.channel)
+        if data.exists(name):
             raise base.UserError(f'!{name} already exists.')
         if hasattr(self, 'run_' + name):
             raise base.UserError(f"Can't use !{name} for a command.")
-        lookup = self._lookup(target)
+        lookup = self._lookup(message, target)
         if not lookup:
             raise base.UserError(f"!{target} isn't a custom command.")
         target, _ = lookup
-        self.data.set(name, {'alias': target})
+        data.set(name, {'alias': target})
         if self.discord:
             msg = f'**{message.user}** created **!{name}** as an alias to **!{target}**.'
             self.discord.embed(EMBED_COLOR, msg)
         return f'Added !{name} as an alias to !{target}.'
+
+
+def _command_json(name: str, subkeys: CommandDict) -> Dict[str, Any]:
+    if 'alias' in subkeys:
+        return {'name': name, 'alias': subkeys['alias']}
+    return {'name': name, 'response': subkeys.get('response', ''),
+            'count': int(subkeys.get('count', '0'))}
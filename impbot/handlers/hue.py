@@ -17,7 +17,7 @@ from impbot.connections import twitch_event, twitch_eventsub
 from impbot.core import base, web
 from impbot.core import data
 from impbot.handlers import command
-from impbot.util import cooldown, twitch_util
+from impbot.util import cooldown, resilience, twitch_util
 
 logger = logging.getLogger(__name__)
 cache_cd = cooldown.Cooldown(duration=timedelta(minutes=5))
@@ -30,6 +30,7 @@ CONFIG_KEY = '_config'
 class HueClient:
     def __init__(self):
         self.data = data.Namespace('impbot.handlers.hue.HueClient')
+        self.service = resilience.Service('hue')
 
     def startup(self) -> None:
         if not all(self.data.exists(CONFIG_KEY, subkey)
@@ -78,10 +79,13 @@ class HueClient:
 
     def _action(self, **body) -> None:
         username = self.data.get(CONFIG_KEY, 'username')
-        response = requests.put(f'https://api.meethue.com/bridge/{username}/groups/1/action',
-                                json=body,
-                                headers={'Authorization': f'Bearer {self._access_token()}',
-                                         'Content-Type': 'application/json'})
+        # Setting a light's state is idempotent, but an alert would blink twice if a retry raced
+        # with a slow success.
+        response = self.service.request(
+            'PUT', f'https://api.meethue.com/bridge/{username}/groups/1/action', json=body,
+            headers={'Authorization': f'Bearer {self._access_token()}',
+                     'Content-Type': 'application/json'},
+            idempotent='alert' not in body)
         _log(response)
         if response.status_code != 200:
             raise HueError
@@ -92,8 +96,9 @@ class HueClient:
             return
 
         username = self.data.get(CONFIG_KEY, 'username')
-        response = requests.get(f'https://api.meethue.com/bridge/{username}/scenes',
-                                headers={'Authorization': f'Bearer {self._access_token()}'})
+        response = self.service.request(
+            'GET', f'https://api.meethue.com/bridge/{username}/scenes',
+            headers={'Authorization': f'Bearer {self._access_token()}'})
 
         _log(response)
         if response.status_code != 200:
@@ -140,7 +145,7 @@ class HueClient:
                 'grant_type': 'refresh_token',
                 'refresh_token': self.data.get(CONFIG_KEY, 'refresh_token')
             }
-        response = requests.post(f'https://api.meethue.com{path}', data=form_data)
+        response = self.service.request('POST', f'https://api.meethue.com{path}', data=form_data)
         _log(response, normal_status=401)
         auth = response.headers['WWW-Authenticate']
         realm_match = re.search('realm="(.*?)"', auth)
@@ -160,7 +165,8 @@ class HueClient:
                 f'Digest username="{secret.HUE_CLIENT_ID}", realm="{realm}", '
                 f'nonce="{nonce}", uri="{path}", response="{digest_response}"'
         }
-        response = requests.post(f'https://api.meethue.com{path}', headers=headers, data=form_data)
+        response = self.service.request('POST', f'https://api.meethue.com{path}', headers=headers,
+                                        data=form_data)
         _log(response)
         tokens = response.json()
         self.data.set_subkey(CONFIG_KEY, 'access_token', tokens['access_token'])
@@ -222,7 +228,7 @@ class HueOAuthWebHandler(base.Handler[twitch_util.NullEvent]):
         response = requests.put(
             'https://api.meethue.com/route/api/0/config',
             headers={'Authorization': f'Bearer {self.hue_client._access_token()}'},
-            json={'linkbutton': True})
+            json={'linkbutton': True}, timeout=resilience.DEFAULT_TIMEOUT)
         request = response.request
         logger.debug('%s %s %s %s', request.method, request.url, request.body, request.headers)
         logger.debug('%d %s', response.status_code, response.text)
@@ -230,7 +236,7 @@ class HueOAuthWebHandler(base.Handler[twitch_util.NullEvent]):
         response = requests.post(
             'https://api.meethue.com/route/api',
             headers={'Authorization': f'Bearer {self.hue_client._access_token()}'},
-            json={'devicetype': 'impbot'})
+            json={'devicetype': 'impbot'}, timeout=resilience.DEFAULT_TIMEOUT)
         request = response.request
         logger.debug('%s %s %s %s', request.method, request.url, request.body, request.headers)
         json = response.json()
@@ -11,6 +11,7 @@ import requests
 from impbot.connections import twitch
 from impbot.core import base
 from impbot.handlers import command
+from impbot.util import resilience
 
 MAX_EMOTES = 27
 
@@ -26,8 +27,8 @@ USERINFO = "(?:(?:[a-z0-9_.+!~*'();:&=+$,-]|%[0-9a-f]{2})+@)"
 IPV4 = r'(\d+.\d+.\d+.\d+)'
 IPV6 = r'(?:\[([0-9a-f:]+)\])'
 TLDS_URL = 'https://data.iana.org/TLD/tlds-alpha-by-domain.txt'
-TLD = '|'.join(line for line in requests.get(TLDS_URL).text.splitlines()
-               if not line.startswith('#'))
+TLD = '|'.join(line for line in requests.get(TLDS_URL, timeout=resilience.DEFAULT_TIMEOUT)
+               .text.splitlines() if not line.startswith('#'))
 NAME = rf'(?:[a-z0-9-]+\.)+(?:{TLD})'
 PORT = r'(?::\d+)'
 PCHAR = "[a-z0-9._~!$&'()*+,;=:@-]|%[0-9a-f]{2}"
@@ -169,7 +170,7 @@ class ModerationFilterHandler(base.Handler[twitch.TwitchMessage]):
         return False
 
     def run(self, message: twitch.TwitchMessage) -> None:
-        conn = cast(twitch.TwitchChatConnection, message.reply_connection)
+        conn = cast(twitch.TwitchChat, message.reply_connection)
         if self.action == 'delete':
             conn.delete(message, self.reply)
         elif self.action == 'timeout':
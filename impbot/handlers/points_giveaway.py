@@ -2,6 +2,8 @@ import logging
 from datetime import datetime, timedelta
 from typing import Optional
 
+import flask
+
 import impbot.connections.twitch_eventsub
 from impbot.connections import twitch_event
 from impbot.core import base, web
@@ -40,7 +42,7 @@ class PointsGiveawayHandler(base.Handler[impbot.connections.twitch_eventsub.Poin
         else:
             return None
 
-    @web.url('/giveaway')
+    @web.url('/giveaway', read_only=True, cached=True)
     def _get_all_entries(self) -> str:
         items = self.data.get_all_values().items()
         if not items:
@@ -50,3 +52,10 @@ class PointsGiveawayHandler(base.Handler[impbot.connections.twitch_eventsub.Poin
             entries.extend([key] * int(value))
         entries.sort()
         return '<br>'.join(f'{i + 1}. {name}' for i, name in enumerate(entries))
+
+    @web.url('/api/giveaway', read_only=True, cached=True)
+    def api(self) -> flask.Response:
+        page = web.page_request()
+        entries = ((name, {'name': name, 'entries': int(count)})
+                   for name, count in self.data.iter_all_values(page.cursor))
+        return web.json_page(page, entries)
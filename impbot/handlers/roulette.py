@@ -6,7 +6,8 @@ from impbot.handlers import command
 
 class RouletteHandler(command.CommandHandler):
     def run_roulette(self, message: base.Message, points: int) -> str:
-        starting_points = int(self.data.get(message.user.name, default='0'))
+        data = self.data.for_channel(message.channel)
+        starting_points = int(data.get(message.user.name, default='0'))
         if starting_points < points:
             if not starting_points:
                 raise base.UserError("You don't have any points!")
@@ -15,9 +16,9 @@ class RouletteHandler(command.CommandHandler):
             raise base.UserError(f'You only have {starting_points} points.')
         if random.randint(0, 1):
             new_points = starting_points + points
-            self.data.set(message.user.name, str(new_points))
+            data.set(message.user.name, str(new_points))
             return f'{message.user} won {points} points and now has {new_points} points!'
         else:
             new_points = starting_points - points
-            self.data.set(message.user.name, str(new_points))
+            data.set(message.user.name, str(new_points))
             return f'{message.user} lost {points} points and now has {new_points} points.'
@@ -0,0 +1,47 @@
+import datetime
+from unittest import mock
+
+from impbot.connections import timer
+from impbot.handlers import announcement
+from impbot.util import tests_util
+
+
+class AnnouncementHandlerTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.timer_conn = timer.TimerConnection()
+        self.handler = announcement.AnnouncementHandler(mock.Mock(), self.timer_conn, mock.Mock())
+
+    def tearDown(self):
+        self.handler.data.clear_all()
+        self.timer_conn.data.clear_all()
+        super().tearDown()
+
+    def last_announce(self, ago: datetime.timedelta) -> None:
+        # Saved the way versions from before durable timers did.
+        self.handler.data.set(
+            'last_announce', str(datetime.datetime.now(datetime.timezone.utc) - ago))
+
+    def test_migrate_overdue(self):
+        self.last_announce(datetime.timedelta(minutes=45))
+        self.handler.startup()
+        self.assertLessEqual(self.handler.timer.end_time, datetime.datetime.now())
+        self.assertEqual(self.handler.timer.interval, datetime.timedelta(minutes=30))
+        self.assertFalse(self.handler.data.exists('last_announce'))
+
+    def test_migrate_not_due(self):
+        self.last_announce(datetime.timedelta(minutes=10))
+        self.handler.startup()
+        self.assertAlmostEqual(
+            self.handler.timer.end_time - datetime.datetime.now(), datetime.timedelta(minutes=20),
+            delta=datetime.timedelta(seconds=5))
+        self.assertFalse(self.handler.data.exists('last_announce'))
+        # And from then on, the durable timer is what counts.
+        self.assertIsNotNone(timer.TimerConnection().resume_durable(
+            announcement.TIMER_NAME, mock.Mock()))
+
+    def test_fresh_start(self):
+        self.handler.startup()
+        self.assertAlmostEqual(
+            self.handler.timer.end_time - datetime.datetime.now(), datetime.timedelta(minutes=30),
+            delta=datetime.timedelta(seconds=5))
@@ -35,6 +35,19 @@ class CustomCommandHandlerTest(tests_util.DataHandlerTest):
         self.assert_response('!delcom blame', 'Deleted !blame.', self.mod)
         self.assert_no_trigger('!blame')
 
+    def testPerChannel(self, mock_peek, mock_fire):
+        self.assert_response(
+            "!addcom !blame It's always Ms. Boogie's fault.", 'Added !blame.', self.mod)
+        self.assert_no_trigger('!blame', channel='#other')
+        self.assert_response(
+            '!addcom !blame Blame the streamer.', 'Added !blame.', self.mod, channel='#other')
+        self.assert_response('!blame', "It's always Ms. Boogie's fault.")
+        self.assert_response('!blame', 'Blame the streamer.', channel='#other')
+        self.assert_response('!delcom blame', 'Deleted !blame.', self.mod, channel='#other')
+        self.assert_no_trigger('!blame', channel='#other')
+        self.assert_response('!blame', "It's always Ms. Boogie's fault.")
+        self.assert_response('!delcom blame', 'Deleted !blame.', self.mod)
+
     def testWithCount(self, mock_peek, mock_fire):
         self.assert_no_trigger('!sheep')
         self.assert_response('!addcom !sheep (count) sheep jumped the fence.', 'Added !sheep.',
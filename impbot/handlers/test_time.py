@@ -1,6 +1,8 @@
+import base64
+import json
 from unittest import mock
 
-from impbot.core import base
+from impbot.core import base, web
 from impbot.handlers import time
 from impbot.util import tests_util
 
@@ -21,6 +23,8 @@ class TimeHandlerTest(tests_util.DataHandlerTest):
         twitch_util.get_display_name = mock.Mock(return_value='Username')
         chat = mock.Mock()
         chat.all_chatters = mock.Mock(return_value=[])
+        chat.is_present = mock.Mock(return_value=False)
+        chat.for_channel = mock.Mock(return_value=chat)
         self.handler = time.TimeHandler(twitch_util, chat, mock.Mock())
 
     def tearDown(self):
@@ -64,3 +68,45 @@ class TimeHandlerTest(tests_util.DataHandlerTest):
             'Username has spent 6 minutes in the chat (5 minutes during the Arbor Day event).',
             user=base.User('another_user'))
         self.assert_response('!time olduser', 'olduser spent 7 minutes in the chat.')
+
+    def test_per_channel(self):
+        chat = self.handler.chat
+        chat.channels = ['#streamer', '#other']
+        chat.channel = '#streamer'
+        other_chat = mock.Mock()
+        other_chat.all_chatters = mock.Mock(return_value=['username'])
+        chat.for_channel = mock.Mock(side_effect=lambda channel: other_chat if channel else chat)
+        self.handler.twitch_util.get_channel_ids = mock.Mock(
+            side_effect=lambda names: [1234 for _ in names])
+        self.handler.increment_all()
+        try:
+            self.assert_response('!time', "@username You've spent 1 minute in the chat.",
+                                 channel='#other')
+            self.assert_response(
+                '!time',
+                "@username Uh, it says here you've never been in the chat, but that can't be "
+                "right, because here you are... valeS")
+        finally:
+            self.handler.data.for_channel('#other').clear_all()
+
+    def test_api(self):
+        self.handler.data.set('total_time', {'1': '60', '2': '600', '3': '180'})
+        web_conn = web.WebServerConnection('127.0.0.1', 9999, '127.0.0.1:9999')
+        web_conn.init_routes([], [self.handler])
+        client = web_conn.flask.test_client()
+        try:
+            first = client.get('/api/watchtime?limit=2').get_json()
+            self.assertEqual(first['data'], [{'user_id': 2, 'seconds': 600},
+                                             {'user_id': 3, 'seconds': 180}])
+            second = client.get(
+                f'/api/watchtime?limit=2&fields=user_id&cursor={first["next_cursor"]}').get_json()
+            self.assertEqual(second, {'data': [{'user_id': 1}], 'next_cursor': None})
+            self.assertEqual(client.get('/api/watchtime?cursor=bogus').status_code, 400)
+            for cursor in ([None, 'x'], [1], [1, '2', 3]):
+                encoded = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+                self.assertEqual(
+                    client.get(f'/api/watchtime?cursor={encoded}').status_code, 400, cursor)
+            self.assertEqual(client.get('/api/watchtime?event=1').get_json(),
+                             {'data': [], 'next_cursor': None})
+        finally:
+            web_conn.flask_server.server_close()
@@ -2,8 +2,11 @@ import datetime
 import logging
 from typing import Optional
 
+import flask
+import werkzeug.exceptions
+
 from impbot.connections import timer, twitch
-from impbot.core import base, data
+from impbot.core import base, data, web
 from impbot.handlers import command
 from impbot.observers import mod_insights
 from impbot.util import twitch_util
@@ -19,21 +22,26 @@ class TimeHandler(command.CommandHandler):
         self.twitch_util = util
         self.chat = chat
         self.mod_insights_data = data.Namespace(mod_insights.ModInsightsObserver.__name__)
-        timer_conn.start_repeating(datetime.timedelta(seconds=INTERVAL_SECONDS), self.increment_all)
+        # Each tick credits everyone in chat with a full interval, so a backed-up event thread
+        # mustn't run several ticks back to back.
+        timer_conn.start_repeating(datetime.timedelta(seconds=INTERVAL_SECONDS), self.increment_all,
+                                   coalesce=True, skip_if_running=True)
 
     def increment_all(self) -> None:
-        data = self.twitch_util.get_stream_data(username=self.twitch_util.streamer_username)
-        if data == twitch_util.OFFLINE:
-            return
-
         # TODO: Do this away from the event thread, if it turns out to be slow when there are a lot
         #  of viewers.
-
         start = datetime.datetime.utcnow()
-        ids = (str(id) for id in self.twitch_util.get_channel_ids(self.chat.all_chatters()))
-        self.data.increment_subkeys('total_time', ids, INTERVAL_SECONDS)
-        if self.data.exists('event_name'):
-            self.data.increment_subkeys('event_time', ids, INTERVAL_SECONDS)
+        for channel_name in self.chat.channels:
+            # Each channel's watch time is kept separately, counting while that channel is live.
+            if self.twitch_util.get_stream_data(username=channel_name[1:]) == twitch_util.OFFLINE:
+                continue
+            channel = None if channel_name == self.chat.channel else channel_name
+            chatters = self.chat.for_channel(channel).all_chatters()
+            ids = [str(id) for id in self.twitch_util.get_channel_ids(chatters)]
+            data = self.data.for_channel(channel)
+            data.increment_subkeys('total_time', ids, INTERVAL_SECONDS)
+            if data.exists('event_name'):
+                data.increment_subkeys('event_time', ids, INTERVAL_SECONDS)
         finish = datetime.datetime.utcnow()
         logger.info('Time incremented in %s.', finish - start)
 
@@ -45,6 +53,7 @@ class TimeHandler(command.CommandHandler):
             who = message.user.name
         if who.startswith('@'):
             who = who[1:]
+        data = self.data.for_channel(message.channel)
         try:
             id = self.twitch_util.get_channel_id(who)
         except KeyError:
@@ -52,14 +61,14 @@ class TimeHandler(command.CommandHandler):
             # the database from when these were stored by name, not by ID, so users who changed
             # their names before December 2020 will still have their old names stored there.
             try:
-                seconds = int(self.data.get('legacy_time', who.lower()))
+                seconds = int(data.get('legacy_time', who.lower()))
                 return f'{who} spent {human_duration(seconds)} in the chat.'
             except KeyError:
                 raise base.UserError(f"@{message.user} {who} isn't a Twitch user.")
 
-        seconds = int(self.data.get('total_time', str(id), default='0'))
+        seconds = int(data.get('total_time', str(id), default='0'))
         if (not seconds and not self.mod_insights_data.exists(str(id)) and
-                who.lower() not in self.chat.all_chatters()):
+                not self.chat.for_channel(message.channel).is_present(who)):
             if who == message.user.name:
                 return (f"@{message.user} Uh, it says here you've never been in the chat, but that "
                         "can't be right, because here you are... valeS")
@@ -67,9 +76,9 @@ class TimeHandler(command.CommandHandler):
                 who = self.twitch_util.get_display_name(who)
                 return f"{who} hasn't been in the chat."
 
-        event = self.data.get('event_name', default='')
+        event = data.get('event_name', default='')
         if event:
-            event_seconds = int(self.data.get('event_time', str(id), default='0'))
+            event_seconds = int(data.get('event_time', str(id), default='0'))
             if event_seconds == seconds:
                 event_time = f' (all during the {event} event)'
             else:
@@ -87,25 +96,49 @@ class TimeHandler(command.CommandHandler):
     def run_startevent(self, message: base.Message, name: str) -> Optional[str]:
         if not message.user.admin:
             return None
+        data = self.data.for_channel(message.channel)
         try:
-            existing_name = self.data.get('event_name')
+            existing_name = data.get('event_name')
             raise base.UserError(
                 f"@{message.user} I'm already tracking watch time for the {existing_name} event.")
         except KeyError:
-            self.data.set('event_name', name)
+            data.set('event_name', name)
             return f'@{message.user} Tracking watch time for the {name} event!'
 
     def run_endevent(self, message: base.Message) -> Optional[str]:
         if not message.user.admin:
             return None
+        data = self.data.for_channel(message.channel)
         try:
-            name = self.data.get('event_name')
+            name = data.get('event_name')
         except KeyError:
             raise base.UserError(f"@{message.user} I'm not tracking watch time for an event.")
         else:
-            self.data.unset('event_name')
+            data.unset('event_name')
             return f'@{message.user} Stopped tracking watch time for the {name} event.'
 
+    @web.url('/api/watchtime', read_only=True, cached=True)
+    def api(self) -> flask.Response:
+        """Watch time leaderboard, most time first. Pass ?event=1 for the current event only."""
+        page = web.page_request(cursor_type=list)
+        key = 'event_time' if flask.request.args.get('event') else 'total_time'
+        if page.cursor is not None:
+            if len(page.cursor) != 2:
+                raise werkzeug.exceptions.BadRequest('Bad cursor')
+            try:
+                after = (int(page.cursor[0]), str(page.cursor[1]))
+            except (ValueError, TypeError):
+                raise werkzeug.exceptions.BadRequest('Bad cursor')
+        else:
+            after = None
+        try:
+            rows = self.data.iter_dict_by_int_value(key, after)
+        except KeyError:
+            rows = iter(())
+        entries = (([seconds, user_id], {'user_id': int(user_id), 'seconds': seconds})
+                   for user_id, seconds in rows)
+        return web.json_page(page, entries)
+
 
 def human_duration(seconds: int):
     parts = []
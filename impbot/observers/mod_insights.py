@@ -58,6 +58,7 @@ class ModInsightsObserver(base.Observer[twitch.TwitchMessage]):
                 f'viewercard/{viewer.name})')
 
     def account_age(self, user_id: int) -> timedelta:
-        response = self.twitch_util.helix_get('users', {'id': user_id})
+        # Nobody's waiting on this, so it shouldn't use up the rate limit that chat commands need.
+        response = self.twitch_util.helix_get('users', {'id': user_id}, priority='low')
         created = dateutil.parser.isoparse(response['data'][0]['created_at'])
         return datetime.now(timezone.utc) - created
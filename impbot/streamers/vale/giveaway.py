@@ -52,7 +52,15 @@ class CommandGiveawayHandler(command.CommandHandler):
         self.data.set('_ended', '1')
         return 'No more entries! vale7'
 
-    @web.url('/giveaway')
+    @web.url('/api/giveaway', read_only=True, cached=True)
+    def api(self) -> flask.Response:
+        page = web.page_request()
+        entries = ((name, {'name': name, 'display_name': display_name})
+                   for name, display_name in self.data.iter_all_values(page.cursor)
+                   if name != '_ended')
+        return web.json_page(page, entries)
+
+    @web.url('/giveaway', read_only=True, cached=True)
     def web(self) -> str:
         data = self.data.get_all_values()
         data.pop('_ended', None)
@@ -1,6 +1,6 @@
 import datetime
 import logging
-from typing import Optional
+from typing import Optional, cast
 
 import pytz
 import requests
@@ -8,11 +8,15 @@ import requests
 import secret
 from impbot.connections import timer, twitch, twitch_eventsub
 from impbot.core import base
-from impbot.util import twitch_util
+from impbot.util import resilience, twitch_util
 from impbot.util.twitch_util import OFFLINE
 
 logger = logging.getLogger(__name__)
+
+_movie_night = resilience.Service('movie_night')
+
 DURATION = datetime.timedelta(minutes=2)
+EMOTE_ONLY_TIMER = 'ValePointsHandler.emote_only'
 REDEEMED_BETWEEN_STREAMS = 'REDEEMED_BETWEEN_STREAMS'
 
 
@@ -25,6 +29,12 @@ class ValePointsHandler(base.Handler[twitch_eventsub.PointsRewardRedemption]):
         self.timer: Optional[timer.SingleTimer] = None
         self.twitch_util = util
 
+    def startup(self) -> None:
+        # If the bot restarted while chat was in emote-only mode, make sure it still gets turned
+        # off (right away, if it's overdue).
+        self.timer = cast(Optional[timer.SingleTimer],
+                          self.timer_conn.resume_durable(EMOTE_ONLY_TIMER, self.emote_only_off))
+
     def check(self, event: twitch_eventsub.PointsRewardRedemption) -> bool:
         return event.reward_title.startswith(
             ('Emote only mode', 'VIP for the day', 'Movie night pass', 'Extra Hello with'))
@@ -44,8 +54,8 @@ class ValePointsHandler(base.Handler[twitch_eventsub.PointsRewardRedemption]):
     def emote_only(self, event: twitch_eventsub.PointsRewardRedemption) -> str:
         if not self.timer or not self.timer.active():
             self.twitch_conn.command('.emoteonly')
-            self.timer = self.timer_conn.start_once(
-                DURATION, lambda: self.twitch_conn.command('.emoteonlyoff'))
+            self.timer = cast(timer.SingleTimer, self.timer_conn.start_durable(
+                EMOTE_ONLY_TIMER, DURATION, self.emote_only_off))
             return f'{event.user} redeemed emote-only mode for two minutes! valePanic'
         else:
             self.timer.extend(DURATION)
@@ -53,6 +63,9 @@ class ValePointsHandler(base.Handler[twitch_eventsub.PointsRewardRedemption]):
             return (f'{event.user} redeemed emote-only mode for ANOTHER two minutes! '
                     f'{time_left.seconds // 60}:{time_left.seconds % 60:02} left now! valePanic')
 
+    def emote_only_off(self) -> None:
+        self.twitch_conn.command('.emoteonlyoff')
+
     def vip(self, event: twitch_eventsub.PointsRewardRedemption) -> str:
         if self.data.exists(event.user.name):
             return f'@{event.user} What, again? valeThink'
@@ -71,10 +84,16 @@ class ValePointsHandler(base.Handler[twitch_eventsub.PointsRewardRedemption]):
     def movie_night(self, event: twitch_eventsub.PointsRewardRedemption) -> str:
         uid = self.twitch_util.get_channel_id(event.user.name)
         url = f'https://valestream.fatalsyntax.com/api/twitch_token/{uid}'
-        response = requests.post(url, headers={
-            'Authorization': secret.MOVIE_NIGHT_API_KEY,
-            'Accept': 'application/json',
-        })
+        try:
+            # Not retried: each call makes a new token.
+            response = _movie_night.request('POST', url, headers={
+                'Authorization': secret.MOVIE_NIGHT_API_KEY,
+                'Accept': 'application/json',
+            })
+        except (requests.RequestException, base.ServerError):
+            logger.exception('Movie night pass for %s failed', event.user)
+            return (f'@{event.user} tried to redeem a movie night pass, but something went wrong. '
+                    'valeS')
         if response.status_code != 200:
             logger.error(response.status_code)
             logger.error(response.text)
@@ -0,0 +1,28 @@
+import random
+from typing import Callable
+
+
+class ExponentialBackoff:
+    """
+    Delays between retries: exponential backoff with "full jitter," i.e. a random delay between 0
+    and base * 2^n seconds after the nth consecutive failure, capped at `cap` seconds. The jitter
+    keeps a lot of clients that failed at the same moment from all retrying at the same moment too.
+    """
+
+    def __init__(self, base: float = 1.0, cap: float = 60.0,
+                 rand: Callable[[], float] = random.random) -> None:
+        self.base = base
+        self.cap = cap
+        self.rand = rand
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        """Records a failure and returns how long to wait before the next attempt."""
+        # Past 2^32 it's going to be capped anyway, and this keeps the float from overflowing.
+        ceiling = min(self.cap, self.base * 2 ** min(self.failures, 32))
+        self.failures += 1
+        return self.rand() * ceiling
+
+    def reset(self) -> None:
+        """Call this after a success."""
+        self.failures = 0
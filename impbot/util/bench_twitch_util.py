@@ -0,0 +1,132 @@
+"""
+Measures TwitchUtil's Helix client against a local stand-in for Helix:
+
+- the per-request latency, compared with opening a new session (and so a new connection) for every
+  request, and
+- how long get_channel_ids() takes to resolve 10,000 names, with and without concurrent batches.
+
+Run with:
+
+    python -m impbot.util.bench_twitch_util
+
+The stand-in server speaks plain HTTP, so this only shows the cost of the TCP handshake; against the
+real Helix, every new connection also pays for a TLS handshake, which costs several round trips more.
+For the same reason, the stand-in adds USERS_LATENCY to each response when resolving names.
+"""
+import concurrent.futures
+import http.server
+import json
+import sqlite3
+import statistics
+import threading
+import time
+from typing import Callable, List
+from unittest import mock
+from urllib import parse
+
+import requests
+
+from impbot.core import data
+from impbot.util import twitch_util
+
+REQUESTS = 1000
+THREADS = 8
+NAMES = 10_000
+USERS_LATENCY = 0.05  # Seconds, about a round trip to Helix.
+BODY = json.dumps({'data': [{'id': '1234', 'login': 'streamer', 'display_name': 'Streamer'}]})
+
+
+class FakeHelixHandler(http.server.BaseHTTPRequestHandler):
+    server: 'FakeHelixServer'
+    protocol_version = 'HTTP/1.1'  # For keep-alive.
+    # The headers and body go out in separate writes, which would otherwise stall each response
+    # for a delayed ACK once the connection is reused.
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        url = parse.urlparse(self.path)
+        logins = [value for name, value in parse.parse_qsl(url.query) if name == 'login']
+        if url.path.endswith('/users') and logins != ['streamer']:
+            # Names like 'user123' get resolved to the ID 123.
+            body = json.dumps({'data': [
+                {'id': login[len('user'):], 'login': login, 'display_name': login.upper()}
+                for login in logins if login.startswith('user')]}).encode()
+        else:
+            body = BODY.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeHelixServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeHelixHandler)
+        self.latency = 0.0  # Added to every response, in seconds.
+
+
+def measure(name: str, func: Callable[[], None], threads: int = 1) -> None:
+    def timed(_: int) -> float:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        latencies: List[float] = list(executor.map(timed, range(REQUESTS)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'{name}: median {statistics.median(latencies) * 1e3:.2f}ms, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f}ms, '
+          f'{REQUESTS / elapsed:,.0f} requests/s')
+
+
+def main() -> None:
+    server = FakeHelixServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    helix_url = f'http://127.0.0.1:{server.server_address[1]}/helix'
+    util = twitch_util.TwitchUtil(mock.Mock(access_token='token'), helix_url=helix_url)
+
+    def new_session() -> None:
+        # What TwitchUtil used to do for every request.
+        with requests.Session() as s:
+            s.get(f'{helix_url}/users', params={'login': 'streamer'}).json()
+
+    def pooled() -> None:
+        util.helix_get('users', {'login': 'streamer'})
+
+    for threads in (1, THREADS):
+        measure(f'new session per request, {threads} thread(s)', new_session, threads)
+        measure(f'pooled session, {threads} thread(s)', pooled, threads)
+
+    # Resolving names goes through the user cache, which needs a database.
+    db = 'file:bench_twitch_util?mode=memory&cache=shared'
+    keep_db = sqlite3.connect(db, uri=True)  # An in-memory database lasts while it's connected.
+    data.startup(db)
+    names = [f'user{i}' for i in range(NAMES)]
+    server.latency = USERS_LATENCY
+    for workers in (1, twitch_util.HELIX_BATCH_WORKERS):
+        util = twitch_util.TwitchUtil(mock.Mock(access_token='token'), helix_url=helix_url,
+                                      batch_workers=workers)
+        util.users.data.clear_all()
+        start = time.perf_counter()
+        ids = util.get_channel_ids(names)
+        elapsed = time.perf_counter() - start
+        assert len(ids) == NAMES, len(ids)
+        print(f'resolve {NAMES:,} names, {workers} worker(s): {elapsed * 1e3:.0f}ms')
+        start = time.perf_counter()
+        util.get_channel_ids(names)
+        print(f'resolve {NAMES:,} cached names: {(time.perf_counter() - start) * 1e3:.0f}ms')
+    keep_db.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,14 @@
 import logging
 from typing import Any, Dict, Optional
 
-import requests
-
 import secret
+from impbot.util import resilience
 
 logger = logging.getLogger(__name__)
 
+# Shared by all the channels, since it's Discord that's up or down, not each channel.
+_service = resilience.Service('discord')
+
 
 class DiscordLogger:
     def __init__(self, channel_id: int):
@@ -28,11 +30,12 @@ class DiscordLogger:
         self._post_message(content=text, allowed_mentions={'parse': []})
 
     def _post_message(self, **json: Any) -> None:
-        response = requests.post(f'https://discord.com/api/v6/channels/{self.channel_id}/messages',
-                                 json=json,
-                                 headers={
-                                     'Authorization': f'Bot {secret.DISCORD_BOT_TOKEN}',
-                                     'User-Agent': 'Impbot',
-                                 })
+        # Not retried, since the message might have been posted even if the response got lost.
+        response = _service.request(
+            'POST', f'https://discord.com/api/v6/channels/{self.channel_id}/messages', json=json,
+            headers={
+                'Authorization': f'Bot {secret.DISCORD_BOT_TOKEN}',
+                'User-Agent': 'Impbot',
+            })
         if response.status_code != 200:
             logger.error('%d %s', response.status_code, response.text)
@@ -0,0 +1,94 @@
+"""
+A minimal in-process metrics registry.
+
+Anything in the bot can record a metric by name, e.g. metrics.counter('foo.bar').inc(), without
+setting anything up first. The current values of all metrics are available from snapshot() (and over
+HTTP at /metrics, if there's a WebServerConnection).
+"""
+import threading
+from typing import Any, Dict, Type, TypeVar
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        with self.lock:
+            self.value += n
+
+    def snapshot(self) -> Any:
+        return self.value
+
+
+class Gauge:
+    def __init__(self) -> None:
+        self.value: Any = None
+
+    def set(self, value: Any) -> None:
+        self.value = value
+
+    def snapshot(self) -> Any:
+        return self.value
+
+
+class Timing:
+    """Summary statistics of a duration (or any other measurement), in seconds."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.last = seconds
+
+    def snapshot(self) -> Any:
+        with self.lock:
+            return {
+                'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'last': self.last,
+            }
+
+
+M = TypeVar('M', Counter, Gauge, Timing)
+_lock = threading.Lock()
+_metrics: Dict[str, Any] = {}
+
+
+def _get(name: str, metric_type: Type[M]) -> M:
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = metric_type()
+        elif not isinstance(metric, metric_type):
+            raise TypeError(f'Metric {name} is a {type(metric).__name__}, not a '
+                            f'{metric_type.__name__}')
+        return metric
+
+
+def counter(name: str) -> Counter:
+    return _get(name, Counter)
+
+
+def gauge(name: str) -> Gauge:
+    return _get(name, Gauge)
+
+
+def timing(name: str) -> Timing:
+    return _get(name, Timing)
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        metrics = dict(_metrics)
+    return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
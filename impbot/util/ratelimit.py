@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Callable, Optional
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter: it holds up to `capacity` tokens, refilled at `rate` tokens per
+    second, and each action spends one (or more).
+
+    Over any window of T seconds, at most capacity + rate * T tokens can be spent. So to stay under
+    a limit of N actions per T-second window, choose capacity + rate * T <= N.
+    """
+
+    def __init__(self, capacity: float, rate: float,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last_refill = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def set_rate(self, capacity: float, rate: float) -> None:
+        with self.lock:
+            self._refill()
+            self.capacity = capacity
+            self.rate = rate
+            self.tokens = min(self.tokens, capacity)
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Spends the tokens and returns 0 if they're available. Otherwise, spends nothing and returns
+        the number of seconds until they will be.
+        """
+        with self.lock:
+            wait = self._wait(tokens)
+            if not wait:
+                self.tokens -= tokens
+            return wait
+
+    def peek(self, tokens: float = 1.0) -> float:
+        """Like try_acquire(), but it never spends anything."""
+        with self.lock:
+            return self._wait(tokens)
+
+    def _wait(self, tokens: float) -> float:
+        # Call this with self.lock held.
+        self._refill()
+        return max(0.0, tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Blocks until the tokens are available, then spends them."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class ServerRateLimit:
+    """
+    A rate limit that the server keeps track of and reports back with each response: how many
+    requests are left, and when they're refilled. Until the first report, and after the reported
+    reset time, requests go through freely.
+
+    Low-priority requests leave `reserve` requests for everything else, and wait while any
+    normal-priority request is waiting.
+    """
+
+    def __init__(self, reserve: int = 0, clock: Callable[[], float] = time.time) -> None:
+        self.cond = threading.Condition()
+        self.clock = clock
+        self.reserve = reserve
+        self.remaining: Optional[int] = None
+        self.reset = 0.0  # In the clock's time, i.e. Unix time by default.
+        self.normal_waiting = 0
+
+    def update(self, remaining: int, reset: float) -> None:
+        with self.cond:
+            self.remaining = remaining
+            self.reset = reset
+            self.cond.notify_all()
+
+    def _wait_time(self, low_priority: bool) -> Optional[float]:
+        # Returns 0 if a request can go now, otherwise how long to wait (or None, to wait until
+        # notified). Call this with self.cond held.
+        if low_priority and self.normal_waiting:
+            return None
+        now = self.clock()
+        if self.remaining is None or now >= self.reset:
+            self.remaining = None
+            return 0.0
+        if self.remaining > (self.reserve if low_priority else 0):
+            return 0.0
+        return self.reset - now
+
+    def acquire(self, low_priority: bool = False) -> None:
+        """Blocks until a request can go, and counts it against the remaining requests."""
+        with self.cond:
+            if not low_priority:
+                self.normal_waiting += 1
+            try:
+                while True:
+                    wait = self._wait_time(low_priority)
+                    if wait == 0:
+                        if self.remaining is not None:
+                            self.remaining -= 1
+                        return
+                    self.cond.wait(wait)
+            finally:
+                if not low_priority:
+                    self.normal_waiting -= 1
+                    self.cond.notify_all()
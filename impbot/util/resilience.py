@@ -0,0 +1,157 @@
+"""
+Keeps calls to outside services from failing on every little blip, or from hanging on a service
+that's down: idempotent requests are retried with backoff, and a circuit breaker per service fails
+calls right away while the service seems to be down, until it's time to try it again.
+
+The state of each service's circuit breaker is in the '<name>.circuit' metric.
+"""
+import datetime
+import logging
+import threading
+import time
+from typing import Any, Callable, Literal, Optional, Tuple
+
+import requests
+
+from impbot.core import base
+from impbot.util import backoff, metrics
+
+logger = logging.getLogger(__name__)
+
+# (Connect, read) timeouts for requests that don't specify their own, in seconds.
+DEFAULT_TIMEOUT = (3.05, 10.0)
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+CircuitState = Literal['closed', 'open', 'half_open']
+
+
+class CircuitOpenError(base.ServerError):
+    """Raised instead of calling a service that's been failing."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    After `failure_threshold` failures in a row, the circuit opens: calls fail right away for
+    `reset_timeout`. After that it's half-open: one call goes through as a trial, and if that
+    succeeds, the circuit closes again. If it fails, the circuit opens for another `reset_timeout`.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: datetime.timedelta = datetime.timedelta(seconds=30),
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout.total_seconds()
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.state: CircuitState = 'closed'
+        self._set_state('closed')
+
+    def _set_state(self, state: CircuitState) -> None:
+        # Call this with self.lock held (or from the constructor).
+        self.state = state
+        metrics.gauge(f'{self.name}.circuit').set(state)
+
+    def before_call(self) -> None:
+        """Raises CircuitOpenError if the call shouldn't go through."""
+        with self.lock:
+            if self.state == 'open':
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    metrics.counter(f'{self.name}.circuit_rejected').inc()
+                    raise CircuitOpenError(f"{self.name} isn't responding, try again later.")
+                self._set_state('half_open')
+            if self.state == 'half_open':
+                if self.trial_in_flight:
+                    metrics.counter(f'{self.name}.circuit_rejected').inc()
+                    raise CircuitOpenError(f"{self.name} isn't responding, try again later.")
+                self.trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.trial_in_flight = False
+            if self.state != 'closed':
+                logger.info('%s is back, closing the circuit.', self.name)
+                self._set_state('closed')
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning('%s failed %d times in a row, opening the circuit.', self.name,
+                                   self.failures)
+                self._set_state('open')
+                self.opened_at = self.clock()
+
+    def record_neither(self) -> None:
+        """For a call that ended in a way that says nothing about the service, e.g. a bug."""
+        with self.lock:
+            self.trial_in_flight = False
+
+
+class Service:
+    """
+    Makes HTTP requests to one outside service through a circuit breaker. Connection errors,
+    timeouts and 5xx responses count as failures. Idempotent requests are retried up to `attempts`
+    times in total, with exponential backoff and jitter in between.
+    """
+
+    def __init__(self, name: str, attempts: int = 3, retry_base: float = 0.2,
+                 retry_cap: float = 2.0, breaker: Optional[CircuitBreaker] = None,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self.name = name
+        self.attempts = attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.breaker = breaker if breaker is not None else CircuitBreaker(name)
+        self.sleep = sleep
+
+    def request(self, method: str, url: str, timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                idempotent: Optional[bool] = None, **kwargs: Any) -> requests.Response:
+        """
+        Like requests.request(). By default, requests are retried if the method is idempotent, but
+        some POSTs are too, and some PUTs aren't.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        return self.call(lambda: requests.request(method, url, timeout=timeout, **kwargs),
+                         idempotent)
+
+    def call(self, func: Callable[[], requests.Response], idempotent: bool) -> requests.Response:
+        """
+        Calls func, which makes an HTTP request and returns the response. If it keeps failing, the
+        last response (or exception) is passed on.
+        """
+        delays = backoff.ExponentialBackoff(self.retry_base, self.retry_cap)
+        attempts = self.attempts if idempotent else 1
+        attempt = 1
+        while True:
+            self.breaker.before_call()
+            try:
+                response = func()
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                logger.warning('%s: %s, retrying.', self.name, e)
+            except BaseException:
+                self.breaker.record_neither()
+                raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt == attempts:
+                    return response
+                logger.warning('%s: %d %s, retrying.', self.name, response.status_code,
+                               response.text)
+            metrics.counter(f'{self.name}.retries').inc()
+            self.sleep(delays.next_delay())
+            attempt += 1
@@ -0,0 +1,47 @@
+"""
+Coalesces concurrent identical calls: while one call for a key is in flight, anyone else who asks for
+the same key waits for it and gets the same result (or exception), instead of making their own.
+"""
+import concurrent.futures
+import threading
+from typing import Callable, Dict, Generic, Hashable, TypeVar
+
+from impbot.util import metrics
+
+T = TypeVar('T')
+
+
+class SingleFlight(Generic[T]):
+    def __init__(self, name: str) -> None:
+        """`name` is the prefix of this group's metrics."""
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, 'concurrent.futures.Future[T]'] = {}
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        """
+        Returns func(), unless a call with the same key is already in flight, in which case it
+        returns that call's result. The result is shared between all of the callers, so they
+        shouldn't modify it.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+        if not leader:
+            metrics.counter(f'{self.name}.coalesced').inc()
+            return future.result()
+
+        metrics.counter(f'{self.name}.calls').inc()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -0,0 +1,255 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Container, Deque, Optional
+
+import attr
+from irc import client
+
+from impbot.core import base
+from impbot.util import backoff, metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+# What Twitch says (just before it hangs up) when it doesn't accept the OAuth token.
+AUTH_FAILED_NOTICES = {'Login authentication failed', 'Improperly formatted auth'}
+
+
+@attr.s(auto_attribs=True)
+class _Command:
+    text: str
+    success_msg: str
+    failure_msgs: Container[str]
+    future: 'concurrent.futures.Future[str]'
+    # time.monotonic() by which it has to have succeeded or failed, sent or not.
+    give_up_at: float
+    attempts: int = 0
+    deadline: float = 0.0  # time.monotonic() by which Twitch should have responded.
+
+    def expects(self, msg_id: str) -> bool:
+        return msg_id == self.success_msg or msg_id in self.failure_msgs
+
+
+class StreamerIrcSession:
+    """
+    A long-lived IRC connection logged in as the streamer, for chat commands that only the
+    broadcaster can use (like .mod and .vip).
+
+    It connects the first time a command is submitted, and reconnects whenever the connection drops
+    or Twitch stops responding. Commands are pipelined: each one goes out as soon as it's submitted
+    (subject to the rate limit), and each pubnotice Twitch sends back is matched to the oldest
+    outstanding command that expects that msg-id.
+    """
+
+    def __init__(self, username: str, get_token: Callable[[], str],
+                 host: str = 'irc.chat.twitch.tv', port: int = 6667, timeout: float = 10.0,
+                 max_attempts: int = 2, on_auth_failure: Optional[Callable[[str], None]] = None,
+                 reconnect_backoff: Optional[backoff.ExponentialBackoff] = None,
+                 give_up_after: float = 60.0) -> None:
+        """
+        get_token is called before each connection attempt and should return a fresh OAuth access
+        token for the streamer. If Twitch rejects it, on_auth_failure is called with the rejected
+        token before reconnecting. A command that gets no response within `timeout` seconds is
+        resent on a new connection, up to `max_attempts` times in total. Either way, a command
+        fails if it hasn't gotten a response `give_up_after` seconds after it was submitted, even if
+        it never got sent (e.g. because the session can't connect).
+        """
+        self.username = username.lower()
+        self.channel = '#' + self.username
+        self.get_token = get_token
+        self.on_auth_failure = on_auth_failure
+        self.token: Optional[str] = None  # The one used for the current connection.
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.give_up_after = give_up_after
+        # The broadcaster gets the moderator limit of 100 messages per 30 seconds.
+        self.rate_limit = ratelimit.TokenBucket(25, 2.5)
+        self.lock = threading.Lock()
+        self.unsent: Deque[_Command] = collections.deque()
+        self.outstanding: Deque[_Command] = collections.deque()
+        self.ready = False  # True once the capabilities we need are acknowledged.
+        # Reset only once a connection gets all the way to ready, so that a connection that Twitch
+        # accepts but then hangs up on (e.g. for a bad token) still backs off.
+        self.backoff = (reconnect_backoff if reconnect_backoff is not None
+                        else backoff.ExponentialBackoff(base=1.0, cap=60.0))
+        self.connected_before = False
+        self.shutdown_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.reactor = client.Reactor()
+        self.connection = self.reactor.server()
+        self.reactor.add_global_handler('welcome', self.on_welcome)
+        self.reactor.add_global_handler('cap', self.on_cap)
+        self.reactor.add_global_handler('pubnotice', self.on_pubnotice)
+        self.reactor.add_global_handler('privnotice', self.on_privnotice)
+        self.reactor.add_global_handler('disconnect', self.on_disconnect)
+
+    def submit(self, command: str, success_msg: str,
+               failure_msgs: Container[str]) -> 'concurrent.futures.Future[str]':
+        """
+        Queues a command to send, and returns a future for its result. The future resolves to
+        success_msg, or fails with a ServerError if Twitch responds with one of failure_msgs or
+        doesn't respond at all.
+        """
+        future: concurrent.futures.Future[str] = concurrent.futures.Future()
+        with self.lock:
+            if self.shutdown_event.is_set():
+                raise base.ServerError('Streamer IRC session is shut down.')
+            self.unsent.append(_Command(command, success_msg, failure_msgs, future,
+                                        time.monotonic() + self.give_up_after))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    name='StreamerIrcSession', target=self.run, daemon=True)
+                self.thread.start()
+        return future
+
+    def shutdown(self) -> None:
+        self.shutdown_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self) -> None:
+        # All IRC operations happen on this thread; other threads only touch self.unsent.
+        while not self.shutdown_event.is_set():
+            if not self.connection.is_connected():
+                if self.connected_before:
+                    delay = self.backoff.next_delay()
+                    logger.info('Reconnecting to IRC as %s in %.1fs.', self.username, delay)
+                    if self._wait(delay):
+                        break
+                self.connected_before = True
+                try:
+                    self._connect()
+                except client.ServerConnectionError:
+                    logger.exception('Streamer IRC connection failed, retrying.')
+                    continue
+            self.reactor.process_once(timeout=0.1)
+            if self.ready:
+                self._send_unsent()
+            self._check_deadlines()
+            self._give_up_on_expired()
+        if self.connection.is_connected():
+            self.connection.disconnect()
+        self._fail_all(base.ServerError('Streamer IRC session is shut down.'))
+
+    def _wait(self, delay: float) -> bool:
+        # Like shutdown_event.wait(), but still gives up on commands that run out of time meanwhile.
+        end = time.monotonic() + delay
+        while True:
+            self._give_up_on_expired()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.shutdown_event.wait(min(remaining, 1.0)):
+                return True
+
+    def _connect(self) -> None:
+        logger.info('Connecting to IRC as %s...', self.username)
+        metrics.counter('twitch.streamer_irc.connects').inc()
+        self.ready = False
+        self.token = self.get_token()
+        self.connection.connect(self.host, self.port, self.username, password=f'oauth:{self.token}')
+
+    def _send_unsent(self) -> None:
+        while True:
+            with self.lock:
+                if not self.unsent:
+                    return
+                if self.rate_limit.try_acquire():
+                    return  # Try again on the next pass.
+                command = self.unsent.popleft()
+            command.attempts += 1
+            command.deadline = time.monotonic() + self.timeout
+            self.outstanding.append(command)
+            self.connection.privmsg(self.channel, command.text)
+
+    def _check_deadlines(self) -> None:
+        if not self.outstanding or self.outstanding[0].deadline > time.monotonic():
+            return
+        command = self.outstanding[0]
+        logger.error('%s: No response after %ss.', command.text, self.timeout)
+        if command.attempts >= self.max_attempts:
+            self.outstanding.popleft()
+            command.future.set_exception(base.ServerError(f'{command.text}: No response.'))
+        else:
+            # The connection is probably dead. on_disconnect requeues everything in flight.
+            self.connection.disconnect()
+
+    def _give_up_on_expired(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            expired = [c for c in itertools.chain(self.outstanding, self.unsent)
+                       if c.give_up_at <= now]
+            for command in expired:
+                if command in self.outstanding:
+                    self.outstanding.remove(command)
+                else:
+                    self.unsent.remove(command)
+        for command in expired:
+            logger.error('%s: Gave up after %ss.', command.text, self.give_up_after)
+            command.future.set_exception(base.ServerError(f'{command.text}: Timed out.'))
+
+    def _fail_all(self, error: Exception) -> None:
+        with self.lock:
+            commands = list(self.outstanding) + list(self.unsent)
+            self.outstanding.clear()
+            self.unsent.clear()
+        for command in commands:
+            command.future.set_exception(error)
+
+    # IRC handlers:
+
+    def on_welcome(self, connection: client.ServerConnection, _: client.Event) -> None:
+        connection.cap('REQ', 'twitch.tv/commands', 'twitch.tv/tags')
+        connection.cap('END')
+
+    def on_cap(self, _: client.ServerConnection, event: client.Event) -> None:
+        if event.arguments and event.arguments[0] == 'ACK':
+            logger.info('Connected to IRC as %s.', self.username)
+            self.ready = True
+            self.backoff.reset()
+
+    def on_pubnotice(self, _: client.ServerConnection, event: client.Event) -> None:
+        msg_ids = [i['value'] for i in event.tags if i['key'] == 'msg-id']
+        if not msg_ids:
+            return
+        if len(msg_ids) > 1:
+            logger.error('Multiple msg-id tags: %s', event)
+            # ... but continue anyway, and just use the first one.
+        msg_id = msg_ids[0]
+        command = next((c for c in self.outstanding if c.expects(msg_id)), None)
+        if command is None:
+            logger.error('Unexpected pubnotice: %s', msg_id)
+            return
+        self.outstanding.remove(command)
+        if msg_id == command.success_msg:
+            logger.info('%s: success', command.text)
+            command.future.set_result(msg_id)
+        else:
+            logger.error('%s: %s', command.text, msg_id)
+            command.future.set_exception(base.ServerError(f'{command.text}: {msg_id}'))
+
+    def on_privnotice(self, connection: client.ServerConnection, event: client.Event) -> None:
+        if not event.arguments or event.arguments[0] not in AUTH_FAILED_NOTICES:
+            return
+        logger.error('Twitch rejected the token for %s: %s', self.username, event.arguments[0])
+        metrics.counter('twitch.streamer_irc.auth_failures').inc()
+        connection.disconnect()
+        if self.on_auth_failure is not None and self.token is not None:
+            try:
+                self.on_auth_failure(self.token)
+            except Exception:
+                logger.exception('Handling the rejected token failed.')
+
+    def on_disconnect(self, _: client.ServerConnection, _event: client.Event) -> None:
+        self.ready = False
+        if not self.outstanding:
+            return
+        logger.info('Disconnected with %d commands in flight, resending.', len(self.outstanding))
+        with self.lock:
+            self.unsent.extendleft(reversed(self.outstanding))
+        self.outstanding.clear()
@@ -0,0 +1,16 @@
+import unittest
+
+from impbot.util import backoff
+
+
+class ExponentialBackoffTest(unittest.TestCase):
+    def test_ceiling(self):
+        b = backoff.ExponentialBackoff(base=1, cap=10, rand=lambda: 1.0)
+        self.assertEqual([b.next_delay() for _ in range(6)], [1, 2, 4, 8, 10, 10])
+        b.reset()
+        self.assertEqual(b.next_delay(), 1)
+
+    def test_jitter(self):
+        b = backoff.ExponentialBackoff(base=1, cap=60)
+        for _ in range(100):
+            self.assertTrue(0 <= b.next_delay() <= 60)
@@ -0,0 +1,110 @@
+import threading
+import time
+import unittest
+
+from impbot.util import ratelimit
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = ratelimit.TokenBucket(capacity=2, rate=0.5, clock=self.clock)
+
+    def test_burst_then_refill(self):
+        self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertEqual(self.bucket.try_acquire(), 2.0)
+        self.clock.now = 1.0
+        self.assertEqual(self.bucket.try_acquire(), 1.0)
+        self.clock.now = 2.0
+        self.assertEqual(self.bucket.try_acquire(), 0)
+
+    def test_capacity(self):
+        self.clock.now = 100.0
+        self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertGreater(self.bucket.try_acquire(), 0)
+
+    def test_peek(self):
+        self.assertEqual(self.bucket.peek(), 0)
+        self.bucket.try_acquire(2)
+        self.assertEqual(self.bucket.peek(), 2.0)
+        self.assertEqual(self.bucket.peek(), 2.0)
+        self.clock.now = 2.0
+        self.assertEqual(self.bucket.peek(), 0)
+        self.assertEqual(self.bucket.try_acquire(), 0)
+
+    def test_set_rate(self):
+        self.bucket.set_rate(capacity=1, rate=1)
+        self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertEqual(self.bucket.try_acquire(), 1.0)
+
+
+class ServerRateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = ratelimit.ServerRateLimit(reserve=1)
+
+    def acquire_in_thread(self, low_priority: bool) -> threading.Thread:
+        thread = threading.Thread(target=self.limit.acquire, args=(low_priority,), daemon=True)
+        thread.start()
+        return thread
+
+    def test_unknown(self):
+        for _ in range(100):
+            self.limit.acquire()
+        self.assertIsNone(self.limit.remaining)
+
+    def test_remaining(self):
+        self.limit.update(remaining=3, reset=time.time() + 60)
+        self.limit.acquire(low_priority=True)  # Not yet down to the reserve.
+        self.limit.acquire()
+        self.limit.acquire()
+        self.assertEqual(self.limit.remaining, 0)
+        thread = self.acquire_in_thread(low_priority=False)
+        thread.join(timeout=0.1)
+        self.assertTrue(thread.is_alive())
+        self.limit.update(remaining=10, reset=time.time() + 60)
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+    def test_reserve(self):
+        self.limit.update(remaining=1, reset=time.time() + 60)
+        low = self.acquire_in_thread(low_priority=True)
+        low.join(timeout=0.1)
+        self.assertTrue(low.is_alive())
+        self.limit.acquire()  # Uses up the reserve.
+        self.assertEqual(self.limit.remaining, 0)
+        self.limit.update(remaining=5, reset=time.time() + 60)
+        low.join(timeout=5)
+        self.assertFalse(low.is_alive())
+
+    def test_reset(self):
+        self.limit.update(remaining=0, reset=time.time() + 0.1)
+        start = time.monotonic()
+        self.limit.acquire()
+        self.assertGreater(time.monotonic() - start, 0.05)
+        self.assertIsNone(self.limit.remaining)
+
+    def test_low_priority_waits_for_normal(self):
+        self.limit.update(remaining=0, reset=time.time() + 60)
+        normal = self.acquire_in_thread(low_priority=False)
+        normal.join(timeout=0.1)
+        low = self.acquire_in_thread(low_priority=True)
+        low.join(timeout=0.1)
+        # There's only room for one request above the reserve, and the normal one gets it.
+        self.limit.update(remaining=2, reset=time.time() + 60)
+        normal.join(timeout=5)
+        self.assertFalse(normal.is_alive())
+        low.join(timeout=0.1)
+        self.assertTrue(low.is_alive())
+        self.limit.update(remaining=5, reset=time.time() + 60)
+        low.join(timeout=5)
+        self.assertFalse(low.is_alive())
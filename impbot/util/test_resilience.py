@@ -0,0 +1,104 @@
+import datetime
+import unittest
+from unittest import mock
+
+import requests
+
+from impbot.util import metrics, resilience
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def response(status_code: int) -> mock.Mock:
+    return mock.Mock(status_code=status_code, text='')
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = resilience.CircuitBreaker(
+            'test_breaker', failure_threshold=2, reset_timeout=datetime.timedelta(seconds=30),
+            clock=self.clock)
+
+    def fail(self) -> None:
+        self.breaker.before_call()
+        self.breaker.record_failure()
+
+    def test_opens(self):
+        self.fail()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.fail()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(metrics.snapshot()['test_breaker.circuit'], 'open')
+        self.assertRaises(resilience.CircuitOpenError, self.breaker.before_call)
+
+    def test_success_resets_count(self):
+        self.fail()
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.fail()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open(self):
+        self.fail()
+        self.fail()
+        self.clock.now = 31
+        self.breaker.before_call()  # The trial call.
+        self.assertEqual(self.breaker.state, 'half_open')
+        # Only one at a time.
+        self.assertRaises(resilience.CircuitOpenError, self.breaker.before_call)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.clock.now = 62
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.before_call()
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.sleep = mock.Mock()
+        self.service = resilience.Service(
+            'test_service', attempts=3,
+            breaker=resilience.CircuitBreaker('test_service', failure_threshold=5),
+            sleep=self.sleep)
+
+    def test_retries_idempotent(self):
+        func = mock.Mock(side_effect=[requests.ConnectionError(), response(503), response(200)])
+        self.assertEqual(self.service.call(func, idempotent=True).status_code, 200)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(self.service.breaker.failures, 0)
+
+    def test_no_retry_if_not_idempotent(self):
+        func = mock.Mock(return_value=response(503))
+        self.assertEqual(self.service.call(func, idempotent=False).status_code, 503)
+        func.assert_called_once()
+
+    def test_gives_up(self):
+        func = mock.Mock(side_effect=requests.Timeout())
+        self.assertRaises(requests.Timeout, self.service.call, func, idempotent=True)
+        self.assertEqual(func.call_count, 3)
+
+    def test_client_errors_are_not_failures(self):
+        func = mock.Mock(return_value=response(404))
+        self.assertEqual(self.service.call(func, idempotent=True).status_code, 404)
+        func.assert_called_once()
+        self.assertEqual(self.service.breaker.failures, 0)
+
+    def test_fails_fast_when_open(self):
+        func = mock.Mock(side_effect=requests.ConnectionError())
+        self.assertRaises(requests.ConnectionError, self.service.call, func, idempotent=True)
+        # That was three failures. Two more open the circuit, partway through the retries.
+        self.assertRaises(resilience.CircuitOpenError, self.service.call, func, idempotent=True)
+        self.assertEqual(func.call_count, 5)
+        self.assertRaises(resilience.CircuitOpenError, self.service.call, func, idempotent=True)
+        self.assertEqual(func.call_count, 5)
@@ -0,0 +1,60 @@
+import threading
+import unittest
+
+from impbot.util import singleflight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.group: singleflight.SingleFlight[int] = singleflight.SingleFlight('test')
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self) -> int:
+        self.calls += 1
+        self.started.set()
+        self.release.wait(timeout=5)
+        return self.calls
+
+    def run_concurrently(self, func, n: int) -> list:
+        results: list = []
+
+        def call() -> None:
+            try:
+                results.append(self.group.do('key', func))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        threads[0].start()
+        self.assertTrue(self.started.wait(timeout=5))
+        for thread in threads[1:]:
+            thread.start()
+        # Give the others a moment to join the call in flight.
+        threading.Event().wait(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        return results
+
+    def test_coalesces(self):
+        self.assertEqual(self.run_concurrently(self.slow, 5), [1] * 5)
+        self.assertEqual(self.calls, 1)
+
+    def test_exception(self):
+        def fail() -> int:
+            self.slow()
+            raise ValueError('oops')
+
+        results = self.run_concurrently(fail, 3)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(self.calls, 1)
+
+    def test_sequential(self):
+        self.release.set()
+        self.assertEqual(self.group.do('key', self.slow), 1)
+        self.assertEqual(self.group.do('key', self.slow), 2)
+        self.assertEqual(self.group.calls, {})
@@ -0,0 +1,109 @@
+import socketserver
+import threading
+import time
+import unittest
+
+from impbot.core import base
+from impbot.util import backoff, streamer_irc
+
+RESPONSES = {
+    '.mod good': 'mod_success',
+    '.mod banned': 'bad_mod_banned',
+}
+
+
+class FakeTwitchHandler(socketserver.StreamRequestHandler):
+    server: 'FakeTwitchServer'
+
+    def handle(self) -> None:
+        self.server.connections += 1
+        for line in self.rfile:
+            command, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            if command == 'PASS' and rest[len('oauth:'):] in self.server.bad_tokens:
+                self.send(':tmi.twitch.tv NOTICE * :Login authentication failed')
+                return
+            if command == 'NICK':
+                self.send(f':tmi.twitch.tv 001 {rest} :Welcome, GLHF!')
+            elif command == 'CAP' and rest.startswith('REQ'):
+                self.send(':tmi.twitch.tv CAP * ACK :twitch.tv/commands twitch.tv/tags')
+            elif command == 'PRIVMSG':
+                channel, _, text = rest.partition(' :')
+                if text in self.server.ignore:
+                    self.server.ignore.remove(text)
+                    continue
+                if text in RESPONSES:
+                    self.send(f'@msg-id={RESPONSES[text]} :tmi.twitch.tv NOTICE {channel} :{text}')
+
+    def send(self, line: str) -> None:
+        self.wfile.write(f'{line}\r\n'.encode())
+
+
+class FakeTwitchServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeTwitchHandler)
+        self.connections = 0
+        self.ignore = set()
+        self.bad_tokens = set()
+
+
+class StreamerIrcSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTwitchServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.token = 'token'
+        self.rejected = []
+        self.session = streamer_irc.StreamerIrcSession(
+            'streamer', lambda: self.token, host='127.0.0.1', port=self.server.server_address[1],
+            timeout=0.5, on_auth_failure=self.rejected.append,
+            reconnect_backoff=backoff.ExponentialBackoff(base=0.05, rand=lambda: 1.0),
+            give_up_after=2.0)
+
+    def tearDown(self):
+        self.session.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pipelined(self):
+        futures = [self.session.submit(f'.mod {name}', 'mod_success', {'bad_mod_banned'})
+                   for name in ['good', 'banned', 'good']]
+        self.assertEqual(futures[0].result(timeout=5), 'mod_success')
+        self.assertRaises(base.ServerError, futures[1].result, timeout=5)
+        self.assertEqual(futures[2].result(timeout=5), 'mod_success')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect_on_timeout(self):
+        self.server.ignore.add('.mod good')
+        future = self.session.submit('.mod good', 'mod_success', {'bad_mod_banned'})
+        self.assertEqual(future.result(timeout=5), 'mod_success')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_no_response(self):
+        future = self.session.submit('.mod unknown', 'mod_success', {'bad_mod_banned'})
+        self.assertRaises(base.ServerError, future.result, timeout=5)
+
+    def test_auth_failure(self):
+        self.server.bad_tokens.add('token')
+
+        def refresh(token):
+            self.rejected.append(token)
+            self.token = 'new_token'
+
+        self.session.on_auth_failure = refresh
+        future = self.session.submit('.mod good', 'mod_success', {'bad_mod_banned'})
+        self.assertEqual(future.result(timeout=5), 'mod_success')
+        self.assertEqual(self.rejected, ['token'])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_backs_off(self):
+        # Twitch accepts the connection but keeps hanging up, so it has to back off.
+        self.server.bad_tokens.add('token')
+        future = self.session.submit('.mod good', 'mod_success', {'bad_mod_banned'})
+        time.sleep(1)
+        # Waiting 0.05s, then 0.1s, 0.2s, 0.4s, ...
+        self.assertLessEqual(self.server.connections, 5)
+        self.assertGreaterEqual(len(self.rejected), 2)
+        # It never gets sent, but it doesn't wait forever either.
+        self.assertFalse(future.done())
+        self.assertRaises(base.ServerError, future.result, timeout=5)
@@ -0,0 +1,340 @@
+import asyncio
+import datetime
+import http.server
+import itertools
+import json
+import threading
+import time
+import unittest
+from typing import Any, Dict, List, Tuple
+from unittest import mock
+from urllib import parse
+
+from impbot.core import base
+from impbot.util import tests_util, twitch_util, user_cache
+
+
+class FakeHelixHandler(http.server.BaseHTTPRequestHandler):
+    server: 'FakeHelixServer'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self) -> None:
+        url = parse.urlparse(self.path)
+        path = url.path[len('/helix/'):]
+        with self.server.lock:
+            self.server.requests.append((path, parse.parse_qsl(url.query)))
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            reject = self.server.reject > 0
+            self.server.reject -= reject
+        if reject:
+            status, body = 429, {'error': 'Too Many Requests'}
+        else:
+            response = self.server.responses.get(path, (404, {}))
+            # A response can also be a function of the query parameters.
+            status, body = response(dict(parse.parse_qsl(url.query))) if callable(
+                response) else response
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeHelixServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeHelixHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.delay = 0.0
+        self.reject = 0  # How many of the next requests to reject with a 429.
+        self.headers: Dict[str, str] = {}
+        self.requests: List[Tuple[str, List[Tuple[str, str]]]] = []
+        self.responses: Dict[str, Any] = {}
+
+    def handle_error(self, request, client_address) -> None:
+        pass  # E.g. the client timing out and hanging up.
+
+    @property
+    def helix_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/helix'
+
+
+class TwitchUtilTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.server = FakeHelixServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.oauth = mock.Mock(streamer_username='streamer', access_token='token',
+                               app_access_token='app_token')
+        self.util = twitch_util.TwitchUtil(self.oauth, helix_url=self.server.helix_url,
+                                           timeout=(1, 0.1))
+
+    def tearDown(self):
+        self.util.session.close()
+        self.util.users.flush()  # So that nothing's left to save after the database is gone.
+        self.util.users.data.clear_all()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_keep_alive(self):
+        self.server.responses['games'] = (200, {'data': [{'id': '1', 'name': 'Celeste'}]})
+        for _ in range(5):
+            self.assertEqual(self.util.game_name(1), 'Celeste')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_error(self):
+        self.assertRaises(base.ServerError, self.util.game_name, 1)
+
+    def test_timeout(self):
+        self.server.delay = 0.3
+        self.assertRaises(base.ServerError, self.util.game_name, 1)
+
+    def test_rate_limit_headers(self):
+        self.server.responses['games'] = (200, {'data': [{'id': '1', 'name': 'Celeste'}]})
+        reset = time.time() + 60
+        self.server.headers = {'Ratelimit-Remaining': '42', 'Ratelimit-Reset': str(int(reset))}
+        self.util.game_name(1)
+        self.assertEqual(self.util.rate_limits['user'].remaining, 42)
+        self.assertEqual(self.util.rate_limits['user'].reset, int(reset))
+        self.assertIsNone(self.util.rate_limits['app'].remaining)
+
+    def test_retry_after_429(self):
+        self.server.responses['games'] = (200, {'data': [{'id': '1', 'name': 'Celeste'}]})
+        self.server.reject = 1
+        self.server.headers = {'Ratelimit-Remaining': '0', 'Ratelimit-Reset': str(time.time() + 0.2)}
+        start = time.monotonic()
+        self.assertEqual(self.util.game_name(1), 'Celeste')
+        self.assertGreater(time.monotonic() - start, 0.1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_too_many_429s(self):
+        self.server.reject = twitch_util.HELIX_MAX_RATE_LIMIT_RETRIES + 1
+        self.server.headers = {'Ratelimit-Remaining': '0', 'Ratelimit-Reset': '0'}
+        self.assertRaises(base.ServerError, self.util.game_name, 1)
+        self.assertEqual(len(self.server.requests), twitch_util.HELIX_MAX_RATE_LIMIT_RETRIES + 1)
+
+    def test_stream_data_cache(self):
+        stream = {'id': '1', 'user_id': '1234', 'user_name': 'Streamer', 'title': 'Hello'}
+        self.server.responses['streams'] = (200, {'data': [stream]})
+        self.assertEqual(self.util.get_stream_data(username='Streamer'), stream)
+        self.assertEqual(self.util.get_stream_data(username='streamer'), stream)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Title change: fetched again.
+        self.server.responses['streams'] = (200, {'data': [dict(stream, title='Goodbye')]})
+        self.util.stream_changed()
+        self.assertEqual(self.util.get_stream_data(username='streamer')['title'], 'Goodbye')
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Offline: known without fetching.
+        self.util.stream_changed(online=False)
+        self.assertEqual(self.util.get_stream_data(username='streamer'), twitch_util.OFFLINE)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_stream_data_lags_notification(self):
+        stream = {'id': '1', 'user_id': '1234', 'user_name': 'Streamer', 'title': 'Hello'}
+        self.server.responses['streams'] = (200, {'data': []})
+        self.util.stream_changed(online=True)
+        with mock.patch.object(twitch_util, 'STREAM_DATA_LAG_TTL', datetime.timedelta(0)):
+            # Helix hasn't caught up yet...
+            self.assertEqual(self.util.get_stream_data(username='streamer'), twitch_util.OFFLINE)
+            # ... so that's not cached for long.
+            self.server.responses['streams'] = (200, {'data': [stream]})
+            self.assertEqual(self.util.get_stream_data(username='streamer'), stream)
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Other channels' offline answers are still cached for the usual time.
+        self.server.responses['streams'] = (200, {'data': []})
+        with mock.patch.object(twitch_util, 'STREAM_DATA_LAG_TTL', datetime.timedelta(0)):
+            self.util.get_stream_data(username='someone_else')
+            self.util.get_stream_data(username='someone_else')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_stream_data_ttl(self):
+        self.server.responses['streams'] = (200, {'data': []})
+        with mock.patch.object(twitch_util, 'STREAM_DATA_TTL', datetime.timedelta(0)):
+            self.util.get_stream_data(user_id=1234)
+            self.util.get_stream_data(user_id=1234)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_users(self):
+        self.server.responses['users'] = (200, {'data': [
+            {'id': '1234', 'login': 'someone', 'display_name': 'SomeOne'},
+            {'id': '5678', 'login': 'someone_else', 'display_name': 'SomeoneElse'},
+        ]})
+        self.assertEqual(self.util.get_channel_ids(['SomeOne', 'someone_else', 'nobody']),
+                         {1234, 5678})
+        self.assertEqual(self.util.get_channel_id('someone'), 1234)
+        self.assertEqual(self.util.get_display_name('someone_else'), 'SomeoneElse')
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Learned from chat.
+        self.util.users.update(9, 'chatter', 'Chatter')
+        self.assertEqual(self.util.get_display_name('chatter'), 'Chatter')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_coalesce_gets(self):
+        self.server.responses['games'] = (200, {'data': [{'id': '1', 'name': 'Celeste'}]})
+        self.server.delay = 0.2
+        self.util.timeout = (1, 5)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.util.game_name(1)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(results, ['Celeste'] * 5)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_channel_ids_in_batches(self):
+        self.server.responses['users'] = (200, {'data': []})
+        self.util.users.update(1, 'cached', 'Cached')
+        names = ['cached'] + [f'user{i}' for i in range(250)] + ['USER0']
+        self.assertEqual(self.util.get_channel_ids(names), {1})
+        # Each unknown name is requested once.
+        requested = [name for _, params in self.server.requests for _, name in params]
+        self.assertEqual(sorted(requested), sorted(f'user{i}' for i in range(250)))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def pages(self, params: Dict[str, str]) -> Tuple[int, Any]:
+        # 250 numbered items, in pages of the requested size, with the cursor being the offset.
+        start = int(params.get('after', 0))
+        end = min(start + int(params['first']), 250)
+        return 200, {'data': list(range(start, end)),
+                     'pagination': {'cursor': str(end)} if end < 250 else {}}
+
+    def test_paginate(self):
+        self.server.responses['things'] = self.pages
+        self.assertEqual(list(self.util.helix_paginate('things', {'id': 1})), list(range(250)))
+        self.assertEqual([dict(params) for _, params in self.server.requests], [
+            {'id': '1', 'first': '100'},
+            {'id': '1', 'first': '100', 'after': '100'},
+            {'id': '1', 'first': '100', 'after': '200'},
+        ])
+
+    def test_paginate_early_termination(self):
+        self.server.responses['things'] = self.pages
+        pages = self.util.helix_paginate('things', page_size=10, prefetch=False)
+        self.assertEqual(list(itertools.islice(pages, 15)), list(range(15)))
+        pages.close()
+        self.assertEqual(len(self.server.requests), 2)
+
+        # With prefetch, it's at most one page ahead.
+        self.server.requests.clear()
+        pages = self.util.helix_paginate('things', page_size=10)
+        self.assertEqual(list(itertools.islice(pages, 15)), list(range(15)))
+        pages.close()
+        time.sleep(0.05)
+        self.assertLessEqual(len(self.server.requests), 3)
+
+    @mock.patch.object(twitch_util.streamer_irc, 'StreamerIrcSession')
+    def test_streamer_irc_rejected_token(self, session):
+        self.util.mod('someone')
+        session.call_args.kwargs['on_auth_failure']('revoked_token')
+        self.oauth.refresh.assert_called_once_with(failed_token='revoked_token')
+
+
+class TwitchOAuthTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.oauth = twitch_util.TwitchOAuth('streamer')
+        # Keep the background thread out of it, and call _maintain() directly instead.
+        self.oauth.refresher = mock.Mock()
+        self.fetch = mock.Mock(return_value=('new_token', 'new_refresh_token', 3600))
+        self.oauth._fetch = self.fetch
+        self.oauth._store('user', 'token', 3600, 'refresh_token')
+
+    def tearDown(self):
+        self.oauth.data.clear_all()
+        super().tearDown()
+
+    def expire(self, seconds_from_now: float) -> None:
+        self.oauth.tokens['user'] = twitch_util._Token('token', time.time() + seconds_from_now,
+                                                       time.time())
+
+    def test_cached_in_memory(self):
+        self.assertEqual(self.oauth.access_token, 'token')
+        # It's saved, for next time...
+        self.assertEqual(twitch_util.TwitchOAuth('streamer')._cached('user'), 'token')
+        # ... but not read back from the database every time.
+        self.oauth.data.set('access_token', 'somewhere_else')
+        self.assertEqual(self.oauth.access_token, 'token')
+
+    def test_refresh_only_once(self):
+        self.oauth.refresh(failed_token='token')
+        self.oauth.refresh(failed_token='token')
+        self.fetch.assert_called_once()
+        self.assertEqual(self.oauth.access_token, 'new_token')
+        self.assertEqual(self.oauth.data.get('refresh_token'), 'new_refresh_token')
+
+    def test_refresh_before_expiry(self):
+        self.assertGreater(self.oauth._maintain('user'), 3000)
+        self.fetch.assert_not_called()
+        self.expire(60)
+        self.oauth._maintain('user')
+        self.fetch.assert_called_once()
+        self.assertEqual(self.oauth.access_token, 'new_token')
+
+    def test_expired(self):
+        self.expire(-1)
+        self.assertEqual(self.oauth.access_token, 'new_token')
+
+    @mock.patch.object(twitch_util.requests, 'get')
+    def test_validate(self, get):
+        get.return_value = mock.Mock(status_code=200, json=lambda: {'expires_in': 100})
+        self.oauth.validate('user')
+        self.assertAlmostEqual(self.oauth.tokens['user'].expires_at, time.time() + 100, delta=5)
+        self.fetch.assert_not_called()
+
+        get.return_value = mock.Mock(status_code=401)
+        self.oauth.validate('user')
+        self.assertEqual(self.oauth.access_token, 'new_token')
+
+
+class AsyncTwitchUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.util = mock.Mock()
+        self.async_util = twitch_util.AsyncTwitchUtil(self.util)
+
+    def test_cached(self):
+        self.util.users.get.return_value = user_cache.UserIdentity(1234, 'someone', 'SomeOne', 0)
+        self.assertEqual(asyncio.run(self.async_util.get_display_name('someone')), 'SomeOne')
+        self.util.get_display_name.assert_not_called()
+
+    def test_concurrent(self):
+        self.util.users.get.return_value = None
+        release = threading.Event()
+
+        def get_display_name(username: str) -> str:
+            release.wait(timeout=5)
+            return username.upper()
+
+        self.util.get_display_name.side_effect = get_display_name
+
+        async def lookups() -> list:
+            tasks = [asyncio.ensure_future(self.async_util.get_display_name(name))
+                     for name in ['a', 'b']]
+            # The lookups are blocked, but the event loop isn't.
+            await asyncio.sleep(0.01)
+            self.assertFalse(any(task.done() for task in tasks))
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        self.assertEqual(asyncio.run(lookups()), ['A', 'B'])
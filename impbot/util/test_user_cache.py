@@ -0,0 +1,91 @@
+import datetime
+import time
+
+from impbot.util import tests_util, user_cache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class UserCacheTest(tests_util.DataHandlerTest):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.cache = user_cache.UserCache(max_size=3, ttl=datetime.timedelta(hours=1),
+                                          clock=self.clock, flush_delay=None)
+
+    def tearDown(self):
+        self.cache.data.clear_all()
+        super().tearDown()
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get('someone'))
+        self.cache.update(1234, 'SomeOne', 'SomeOne')
+        user = self.cache.get('someone')
+        self.assertEqual((user.id, user.login, user.display_name), (1234, 'someone', 'SomeOne'))
+
+    def test_ttl(self):
+        self.cache.update(1234, 'someone', 'SomeOne')
+        self.clock.now += 3599
+        self.assertIsNotNone(self.cache.get('someone'))
+        self.clock.now += 2
+        self.assertIsNone(self.cache.get('someone'))
+        # Seeing them again (e.g. in chat) refreshes it.
+        self.cache.update(1234, 'someone', 'SomeOne')
+        self.assertIsNotNone(self.cache.get('someone'))
+
+    def test_lru(self):
+        for id, login in enumerate(['a', 'b', 'c']):
+            self.cache.update(id, login, login.upper())
+        self.cache.get('a')
+        self.cache.update(3, 'd', 'D')
+        self.assertIsNone(self.cache.get('b'))
+        for login in 'acd':
+            self.assertIsNotNone(self.cache.get(login))
+        self.cache.flush()
+        self.assertEqual(set(self.cache.data.get_dict('users')), {'a', 'c', 'd'})
+
+    def test_rename(self):
+        self.cache.update(1234, 'oldname', 'OldName')
+        self.cache.update(1234, 'newname', 'NewName')
+        self.assertIsNone(self.cache.get('oldname'))
+        self.assertEqual(self.cache.get('newname').id, 1234)
+        # Then someone else takes the old name.
+        self.cache.update(5678, 'oldname', 'OldName')
+        self.assertEqual(self.cache.get('oldname').id, 5678)
+        self.assertEqual(self.cache.get('newname').id, 1234)
+
+    def test_persistence(self):
+        self.cache.update(1234, 'someone', 'SomeOne')
+        self.cache.update(5678, 'someone_else', 'SomeoneElse')
+        self.cache.flush()
+        restarted = user_cache.UserCache(ttl=datetime.timedelta(hours=1), clock=self.clock)
+        self.assertEqual(restarted.get('someone').id, 1234)
+        self.assertEqual(restarted.get('someone_else').display_name, 'SomeoneElse')
+
+    def test_write_behind(self):
+        self.cache.update(1234, 'someone', 'SomeOne')
+        self.cache.update(5678, 'someone_else', 'SomeoneElse')
+        # Nothing's written until it's flushed, and then all at once.
+        self.assertFalse(self.cache.data.exists('users'))
+        version = self.cache.data.version
+        self.cache.flush()
+        self.assertEqual(set(self.cache.data.get_dict('users')), {'someone', 'someone_else'})
+        self.assertEqual(self.cache.data.version, version + 1)
+        # Nothing left to save.
+        self.cache.flush()
+        self.assertEqual(self.cache.data.version, version + 1)
+
+    def test_flush_delay(self):
+        cache = user_cache.UserCache(flush_delay=datetime.timedelta(seconds=0.01))
+        cache.update(1234, 'someone', 'SomeOne')
+        for _ in range(100):
+            if cache.data.exists('users', 'someone'):
+                break
+            time.sleep(0.01)
+        self.assertTrue(cache.data.exists('users', 'someone'))
@@ -13,21 +13,23 @@ class HandlerTest(unittest.TestCase):
         self.reply_conn: base.ChatConnection = mock.Mock()
         self.handler: base.Handler[base.Message] = None
 
-    def _message(self, input: str, user: Optional[base.User] = None):
+    def _message(self, input: str, user: Optional[base.User] = None,
+                 channel: Optional[str] = None):
         if not user:
             user = base.User('username')
-        return base.Message(self.reply_conn, user, input)
+        return base.Message(self.reply_conn, user, input, channel=channel)
 
-    def assert_no_trigger(self, input: str) -> None:
-        self.assertFalse(self.handler.check(self._message(input)))
+    def assert_no_trigger(self, input: str, channel: Optional[str] = None) -> None:
+        self.assertFalse(self.handler.check(self._message(input, channel=channel)))
 
-    def assert_response(self, input: str, output: str, user: Optional[base.User] = None) -> None:
-        message = self._message(input, user)
+    def assert_response(self, input: str, output: str, user: Optional[base.User] = None,
+                        channel: Optional[str] = None) -> None:
+        message = self._message(input, user, channel)
         self.assertTrue(self.handler.check(message))
         self.assertEqual(self.handler.run(message), output)
 
-    def assert_error(self, input: str, output: str):
-        message = self._message(input)
+    def assert_error(self, input: str, output: str, channel: Optional[str] = None):
+        message = self._message(input, channel=channel)
         self.assertTrue(self.handler.check(message))
         with self.assertRaises(base.UserError) as ar:
             self.handler.run(message)
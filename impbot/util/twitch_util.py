@@ -1,31 +1,81 @@
+import asyncio
+import concurrent.futures
 import datetime
 import functools
 import logging
-import queue
+import math
 import random
 import string
 import threading
-from typing import Any, Container, Dict, Iterable, List, Literal, Optional, Set, Tuple, Union
+import time
+from typing import (Any, Callable, Container, Dict, Iterable, Iterator, List, Literal, Optional,
+                    Set, Tuple, TypeVar, Union, cast)
 from urllib import parse
 
+import attr
 import flask
 import requests
-from irc import client
 from mypy_extensions import TypedDict
+from requests import adapters
 
 import secret
 from impbot.core import base, web
 from impbot.core import data
-from impbot.util import cooldown
+from impbot.util import (cooldown, metrics, ratelimit, resilience, singleflight, streamer_irc,
+                         user_cache)
 
 logger = logging.getLogger(__name__)
 
+HELIX_URL = 'https://api.twitch.tv/helix'
+# Connections to Helix kept open for reuse. Every thread that's in the middle of a Helix request
+# holds one, so this only needs to cover the number of concurrent callers.
+HELIX_POOL_SIZE = 10
+# (Connect, read) timeouts for Helix requests, in seconds.
+HELIX_TIMEOUT = (3.05, 10.0)
+# How many requests for a batch of users (e.g. in get_channel_ids()) can be in flight at once. This
+# should be well under HELIX_POOL_SIZE, so that other requests get a connection too.
+HELIX_BATCH_WORKERS = 4
+# Of the requests left in a Helix rate limit bucket, how many to keep for normal-priority requests
+# (i.e. ones a user is waiting on). The bucket holds 800 requests per minute.
+HELIX_LOW_PRIORITY_RESERVE = 100
+# How many times to retry a request that Helix rejected for going over the rate limit.
+HELIX_MAX_RATE_LIMIT_RETRIES = 3
+# How long get_stream_data() trusts what it fetched. EventSub tells us right away about changes to
+# the streamer's own stream, so this is only a fallback, e.g. in case a notification gets lost.
+STREAM_DATA_TTL = datetime.timedelta(minutes=5)
+# Helix's /streams usually lags behind EventSub's stream.online, so after that notification, an
+# answer that the streamer is offline is only trusted this long.
+STREAM_DATA_LAG_TTL = datetime.timedelta(seconds=10)
+# OAuth tokens are refreshed this long before they expire, so that requests never use expired ones.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Twitch wants apps to validate their tokens this often, since they can be revoked at any time.
+TOKEN_VALIDATE_INTERVAL = datetime.timedelta(hours=1)
+# How soon to try again if refreshing or validating a token fails.
+TOKEN_RETRY_INTERVAL = datetime.timedelta(minutes=1)
+
+TokenType = Literal['user', 'app']
+Priority = Literal['normal', 'low']
+T = TypeVar('T')
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class _Token:
+    value: str
+    expires_at: Optional[float]  # Unix time, or None if we don't know.
+    checked_at: float  # When we last got or validated it, in Unix time.
+
 
 class TwitchOAuth:
     def __init__(self, streamer_username: str, scopes: Optional[List[str]] = None):
         self.streamer_username = streamer_username
         self.data = data.Namespace('impbot.util.twitch_util.TwitchOAuth')
+        # Held while authorizing or refreshing, so that only one of those happens at a time.
         self.lock = threading.Lock()
+        # Only ever held briefly, to read or update the tokens cached in memory.
+        self.tokens_lock = threading.Lock()
+        self.tokens: Dict[TokenType, Optional[_Token]] = {}
+        self.refresher: Optional[threading.Thread] = None
+        self.tokens_changed = threading.Event()
         self.auth_finished = threading.Event()
         # TODO: In principle you could DoS this by starting a bunch of OAuth flows, so that this
         #  would consume too much memory. The fix is to make it a FIFO queue instead of (or in
@@ -81,7 +131,7 @@ class TwitchOAuth:
 
     def finish_authorization(self, code: str) -> None:
         try:
-            access_token, refresh_token = self._fetch({
+            access_token, refresh_token, expires_in = self._fetch({
                 'grant_type': 'authorization_code',
                 'code': code,
                 'redirect_uri': secret.TWITCH_REDIRECT_URI,
@@ -95,7 +145,8 @@ class TwitchOAuth:
             headers={
                 'Client-ID': secret.TWITCH_CLIENT_ID,
                 'Authorization': f'Bearer {access_token}'
-            })
+            },
+            timeout=HELIX_TIMEOUT)
         if response.status_code != 200:
             logger.error(
                 "Couldn't fetch user info with new bearer token: %d %s",
@@ -108,55 +159,182 @@ class TwitchOAuth:
             raise base.UserError(f"You're logged into Twitch as {display_name}. Please log in "
                                  f"as {self.streamer_username} to authorize the bot.")
 
-        self.data.set('access_token', access_token)
-        self.data.set('refresh_token', refresh_token)
+        self._store('user', access_token, expires_in, refresh_token)
         self.auth_finished.set()
 
-    def refresh(self) -> None:
+    def refresh(self, failed_token: Optional[str] = None) -> None:
+        """
+        Gets a new access token. If this is because Twitch rejected one, pass that one: if another
+        thread has already replaced it, there's no need to refresh again.
+        """
         with self.lock:  # Hold the lock between the DB read and writes.
-            access_token, refresh_token = self._fetch({
+            if failed_token is not None and self._cached('user') != failed_token:
+                return
+            access_token, refresh_token, expires_in = self._fetch({
                 'grant_type': 'refresh_token',
                 'refresh_token': self.data.get('refresh_token'),
             })
-            self.data.set('access_token', access_token)
-            self.data.set('refresh_token', refresh_token)
+            self._store('user', access_token, expires_in, refresh_token)
         logger.info('Twitch OAuth: Refreshed!')
 
     @property
     def has_access_token(self) -> bool:
-        return self.data.exists('access_token')
+        return self._cached('user') is not None
 
     @property
     def access_token(self) -> str:
-        return self.data.get('access_token')
+        token = self._current('user')
+        if token is None:
+            raise KeyError('access_token')
+        return token
 
-    def refresh_app_access_token(self) -> None:
-        access_token, refresh_token = self._fetch({'grant_type': 'client_credentials'})
-        # There's no refresh token in this case, since we refresh with the
-        # client ID and secret.
-        self.data.set('app_access_token', access_token)
+    def refresh_app_access_token(self, failed_token: Optional[str] = None) -> None:
+        with self.lock:
+            if failed_token is not None and self._cached('app') != failed_token:
+                return
+            access_token, _, expires_in = self._fetch({'grant_type': 'client_credentials'})
+            # There's no refresh token in this case, since we refresh with the
+            # client ID and secret.
+            self._store('app', access_token, expires_in)
 
     @property
     def app_access_token(self) -> str:
-        try:
-            return self.data.get('app_access_token')
-        except KeyError:
+        token = self._current('app')
+        if token is None:
             self.refresh_app_access_token()
-            return self.data.get('app_access_token')
+            token = self._current('app')
+        return cast(str, token)
 
-    def _fetch(self, params: Dict[str, str]) -> Tuple[str, str]:
+    def validate(self, token_type: TokenType) -> None:
+        """
+        Asks Twitch whether the token is still good, and how long it has left, and refreshes it if
+        not. Twitch wants apps to do this hourly, since tokens can be revoked before they expire.
+        """
+        token = self._cached_token(token_type)
+        if token is None:
+            return
+        response = requests.get('https://id.twitch.tv/oauth2/validate',
+                                headers={'Authorization': f'OAuth {token.value}'},
+                                timeout=HELIX_TIMEOUT)
+        if response.status_code == 401:
+            logger.warning('Twitch OAuth: %s token is no longer valid.', token_type)
+            if token_type == 'user':
+                self.refresh(failed_token=token.value)
+            else:
+                self.refresh_app_access_token(failed_token=token.value)
+            return
+        if response.status_code != 200:
+            raise base.ServerError(f'{response.status_code} {response.text}')
+        expires_in = response.json().get('expires_in')
+        with self.tokens_lock:
+            if self.tokens.get(token_type) == token:
+                self.tokens[token_type] = _Token(
+                    token.value, time.time() + expires_in if expires_in else None, time.time())
+
+    def _current(self, token_type: TokenType) -> Optional[str]:
+        # Returns the token, first refreshing it if it's already expired. Normally, the background
+        # thread refreshes it before that happens.
+        self._start_refresher()
+        token = self._cached_token(token_type)
+        if token is not None and token.expires_at is not None and token.expires_at <= time.time():
+            logger.warning('Twitch OAuth: %s token expired before it was refreshed.', token_type)
+            if token_type == 'user':
+                self.refresh(failed_token=token.value)
+            else:
+                self.refresh_app_access_token(failed_token=token.value)
+            return self._cached(token_type)
+        return token.value if token is not None else None
+
+    def _cached(self, token_type: TokenType) -> Optional[str]:
+        token = self._cached_token(token_type)
+        return token.value if token is not None else None
+
+    def _cached_token(self, token_type: TokenType) -> Optional[_Token]:
+        with self.tokens_lock:
+            if token_type not in self.tokens:
+                # First time: load it from the database.
+                key = 'access_token' if token_type == 'user' else 'app_access_token'
+                try:
+                    value = self.data.get(key)
+                except KeyError:
+                    self.tokens[token_type] = None
+                else:
+                    expires_at = self.data.get(f'{key}_expires_at', default='')
+                    # We don't know when it was last checked, so it'll be validated right away.
+                    self.tokens[token_type] = _Token(
+                        value, float(expires_at) if expires_at else None, 0.0)
+            return self.tokens[token_type]
+
+    def _store(self, token_type: TokenType, access_token: str, expires_in: Optional[int],
+               refresh_token: Optional[str] = None) -> None:
+        now = time.time()
+        expires_at = now + expires_in if expires_in else None
+        key = 'access_token' if token_type == 'user' else 'app_access_token'
+        self.data.set(key, access_token)
+        self.data.set(f'{key}_expires_at', str(expires_at) if expires_at else '')
+        if refresh_token is not None:
+            self.data.set('refresh_token', refresh_token)
+        with self.tokens_lock:
+            self.tokens[token_type] = _Token(access_token, expires_at, now)
+        self.tokens_changed.set()
+
+    def _start_refresher(self) -> None:
+        with self.tokens_lock:
+            if self.refresher is not None:
+                return
+            self.refresher = threading.Thread(name='TwitchOAuth refresher',
+                                              target=self.refresh_forever, daemon=True)
+        self.refresher.start()
+
+    def refresh_forever(self) -> None:
+        """Refreshes tokens shortly before they expire, and validates them periodically."""
+        while True:
+            self.tokens_changed.clear()
+            wait = TOKEN_VALIDATE_INTERVAL.total_seconds()
+            for token_type in cast(List[TokenType], ['user', 'app']):
+                try:
+                    wait = min(wait, self._maintain(token_type))
+                except (base.ServerError, requests.RequestException, KeyError):
+                    logger.exception('Twitch OAuth: Couldn\'t refresh the %s token.', token_type)
+                    wait = min(wait, TOKEN_RETRY_INTERVAL.total_seconds())
+            self.tokens_changed.wait(max(wait, 1.0))
+
+    def _maintain(self, token_type: TokenType) -> float:
+        # Refreshes or validates the token if it's due, and returns the seconds until it's next due.
+        token = self._cached_token(token_type)
+        if token is None:
+            return math.inf
+        now = time.time()
+        margin = TOKEN_REFRESH_MARGIN.total_seconds()
+        if token.expires_at is not None and token.expires_at - margin <= now:
+            if token_type == 'user':
+                self.refresh(failed_token=token.value)
+            else:
+                self.refresh_app_access_token(failed_token=token.value)
+        elif token.checked_at + TOKEN_VALIDATE_INTERVAL.total_seconds() <= now:
+            self.validate(token_type)
+        else:
+            due = token.checked_at + TOKEN_VALIDATE_INTERVAL.total_seconds()
+            if token.expires_at is not None:
+                due = min(due, token.expires_at - margin)
+            return due - now
+        return 0.0
+
+    def _fetch(self, params: Dict[str, str]) -> Tuple[str, str, Optional[int]]:
+        # This runs with self.lock held, so a hung request would hold up everyone who needs a token.
         response = requests.post('https://id.twitch.tv/oauth2/token',
                                  params={
                                      'client_id': secret.TWITCH_CLIENT_ID,
                                      'client_secret': secret.TWITCH_CLIENT_SECRET,
                                      **params
-                                 })
+                                 },
+                                 timeout=HELIX_TIMEOUT)
         if response.status_code != 200:
             raise base.ServerError(f'{response.status_code} {response.text}')
         body = response.json()
         if 'error' in body:
             raise base.ServerError(body)
-        return body['access_token'], body.get('refresh_token', '')
+        return body['access_token'], body.get('refresh_token', ''), body.get('expires_in')
 
 
 class NullEvent(base.Event):
@@ -222,12 +400,44 @@ OFFLINE = OfflineStreamData()
 
 
 class TwitchUtil:
-    def __init__(self, oauth: TwitchOAuth):
+    def __init__(self, oauth: TwitchOAuth, helix_url: str = HELIX_URL,
+                 pool_size: int = HELIX_POOL_SIZE,
+                 timeout: Tuple[float, float] = HELIX_TIMEOUT,
+                 batch_workers: int = HELIX_BATCH_WORKERS):
         self.oauth = oauth
+        self.helix_url = helix_url
+        self.timeout = timeout
+        # One long-lived session for all Helix requests, so that they reuse kept-alive connections
+        # instead of paying for a new TCP and TLS handshake every time. Sessions are safe to share
+        # between threads as long as nothing changes their settings after this.
+        self.session = requests.Session()
+        self.session.mount(helix_url, adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size))
+        self.session.headers['Client-ID'] = secret.TWITCH_CLIENT_ID
+        # Retries GETs that fail transiently, and fails fast while Helix is down.
+        self.service = resilience.Service('helix')
+        self._batch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=batch_workers, thread_name_prefix='TwitchUtil batch')
+        self._helix_gets: singleflight.SingleFlight[Dict] = singleflight.SingleFlight('helix.get')
+        # Helix keeps a separate rate limit bucket for the app token and for each user token.
+        self.rate_limits: Dict[TokenType, ratelimit.ServerRateLimit] = {
+            'user': ratelimit.ServerRateLimit(reserve=HELIX_LOW_PRIORITY_RESERVE),
+            'app': ratelimit.ServerRateLimit(reserve=HELIX_LOW_PRIORITY_RESERVE),
+        }
         self.streamer_username = oauth.streamer_username
         self._cached_sub_count: Optional[int] = None
         self._sub_count_ttl = cooldown.Cooldown(datetime.timedelta(minutes=5))
-        self._channel_id_cache: Dict[str, int] = {}
+        self.users = user_cache.UserCache()
+        self._stream_data_lock = threading.Lock()
+        # ('user_id' or 'user_login', value) -> (expiration time, data).
+        self._stream_data_cache: Dict[Tuple[str, str], Tuple[float, StreamData]] = {}
+        # Bumped whenever the cache is invalidated, so that a fetch that started before then
+        # doesn't put its outdated result in the cache.
+        self._stream_data_generation = 0
+        # What the latest EventSub notification said about the streamer's stream, if anything.
+        self._streamer_online: Optional[bool] = None
+        self._streamer_session: Optional[streamer_irc.StreamerIrcSession] = None
+        self._streamer_session_lock = threading.Lock()
 
     def get_channel_id(self, streamer_username: str) -> int:
         result = self.get_channel_ids([streamer_username])
@@ -236,48 +446,98 @@ class TwitchUtil:
         return list(result)[0]
 
     def get_channel_ids(self, streamer_usernames: Iterable[str]) -> Set[int]:
-        streamer_usernames = list(streamer_usernames)
         result = set()
-        to_fetch: List[str] = []
+        to_fetch: Dict[str, None] = {}  # A set, but in a stable order.
         # First, grab any that we already have from cache.
         for name in streamer_usernames:
-            name = name.lower()
-            try:
-                result.add(self._channel_id_cache[name])
-            except KeyError:
-                to_fetch.append(name)
-        # Break the list up into multiple requests, asking for at most 100 names
-        # at a time (per the API docs).
-        for i in range(0, len(to_fetch), 100):
-            body = self.helix_get('users', [('login', name) for name in to_fetch[i:i + 100]])
+            user = self.users.get(name)
+            if user is not None:
+                result.add(user.id)
+            else:
+                to_fetch[name.lower()] = None
+        # Break the list up into multiple requests, asking for at most 100 names at a time (per the
+        # API docs), and make them concurrently.
+        names = list(to_fetch)
+        batches = [names[i:i + 100] for i in range(0, len(names), 100)]
+
+        def fetch(batch: List[str]) -> Dict:
+            return self.helix_get('users', [('login', name) for name in batch])
+
+        if len(batches) == 1:
+            bodies: Iterable[Dict] = [fetch(batches[0])]
+        else:
+            bodies = self._batch_pool.map(fetch, batches)
+        for body in bodies:
             # We *don't* check that all names are present -- if any of the input
             # names were bogus, then the output will be smaller than the input.
             for user in body['data']:
                 result.add(int(user['id']))
-                self._channel_id_cache[user['login']] = int(user['id'])
+                self.users.update(int(user['id']), user['login'], user['display_name'])
         return result
 
     def get_display_name(self, username: str) -> str:
-        return self._get_display_name(username.lower())
-
-    @functools.lru_cache()
-    def _get_display_name(self, username: str) -> str:
-        body = self.helix_get('users', {'login': username})
+        user = self.users.get(username)
+        if user is not None:
+            return user.display_name
+        body = self.helix_get('users', {'login': username.lower()})
         if not body['data']:
             raise KeyError(f'No Twitch user "{username}"')
-        return body['data'][0]['display_name']
+        user_data = body['data'][0]
+        self.users.update(int(user_data['id']), user_data['login'], user_data['display_name'])
+        return user_data['display_name']
 
     def get_stream_data(
             self, user_id: Optional[int] = None, username: Optional[str] = None) -> StreamData:
         if user_id:
-            body = self.helix_get('streams', {'user_id': user_id})
+            key = ('user_id', str(user_id))
         elif username:
-            body = self.helix_get('streams', {'user_login': username})
+            key = ('user_login', username.lower())
         else:
             raise ValueError('Must pass either user_id or username.')
-        if not body['data']:
-            return OFFLINE
-        return body['data'][0]
+        with self._stream_data_lock:
+            cached = self._stream_data_cache.get(key)
+            generation = self._stream_data_generation
+        if cached is not None and cached[0] > time.monotonic():
+            metrics.counter('twitch_util.stream_data.hits').inc()
+            return cached[1]
+        metrics.counter('twitch_util.stream_data.misses').inc()
+        body = self.helix_get('streams', {key[0]: key[1]})
+        data: StreamData = body['data'][0] if body['data'] else OFFLINE
+        ttl = STREAM_DATA_TTL
+        if data == OFFLINE and self._streamer_online and self._is_streamer(key):
+            # Probably just not caught up yet, so check again soon.
+            ttl = STREAM_DATA_LAG_TTL
+        with self._stream_data_lock:
+            if generation == self._stream_data_generation:
+                self._stream_data_cache[key] = (time.monotonic() + ttl.total_seconds(), data)
+        return data
+
+    def _is_streamer(self, key: Tuple[str, str]) -> bool:
+        if key[0] == 'user_login':
+            return key[1] == self.streamer_username.lower()
+        streamer = self.users.get(self.streamer_username)
+        return streamer is not None and key[1] == str(streamer.id)
+
+    def stream_changed(self, online: Optional[bool] = None) -> None:
+        """
+        Tells get_stream_data() that the streamer's stream has changed: it went online (True),
+        offline (False), or its title or category changed (None).
+        """
+        with self._stream_data_lock:
+            self._stream_data_generation += 1
+            if online is not None:
+                self._streamer_online = online
+            # Only the streamer's own stream gets these updates, but other channels' data is rarely
+            # cached, so it's simplest to drop everything.
+            self._stream_data_cache.clear()
+            if online is False:
+                # This one we don't even need to fetch.
+                expires = time.monotonic() + STREAM_DATA_TTL.total_seconds()
+                self._stream_data_cache[('user_login', self.streamer_username.lower())] = (
+                    expires, OFFLINE)
+                streamer = self.users.get(self.streamer_username)
+                if streamer is not None:
+                    self._stream_data_cache[('user_id', str(streamer.id))] = (expires, OFFLINE)
 
     def game_name(self, game_id: int) -> str:
         body = self.helix_get('games', {'id': game_id})
@@ -301,41 +561,95 @@ class TwitchUtil:
 
     def helix_get(self, path: str,
                   params: Optional[Union[Dict[str, Any], List[Tuple[str, Any]]]] = None,
-                  token_type: Literal['user', 'app'] = 'user', expected_status: int = 200) -> Dict:
-        return self._helix('GET', path, token_type, expected_status, params=params)
+                  token_type: TokenType = 'user', expected_status: int = 200,
+                  priority: Priority = 'normal') -> Dict:
+        """
+        Low-priority requests (ones that no user is waiting on) leave some of the rate limit for
+        normal-priority ones, and wait behind them when it runs low.
+
+        If an identical request is already in flight, this waits for it and returns its response
+        instead of making another one. That response is shared, so don't modify it.
+        """
+        if params is None:
+            param_key: Tuple[Tuple[str, str], ...] = ()
+        else:
+            items = params.items() if isinstance(params, dict) else params
+            param_key = tuple(sorted((name, str(value)) for name, value in items))
+        return self._helix_gets.do(
+            (path, param_key, token_type, expected_status, priority),
+            lambda: self._helix('GET', path, token_type, expected_status, priority, params=params))
+
+    def helix_paginate(self, path: str,
+                       params: Optional[Union[Dict[str, Any], List[Tuple[str, Any]]]] = None,
+                       token_type: TokenType = 'user', priority: Priority = 'normal',
+                       page_size: Optional[int] = 100,
+                       prefetch: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        Iterates over the items of every page of a Helix list endpoint, following its cursor. Pages
+        are only fetched as they're needed, so at most two are in memory at once, and stopping early
+        (e.g. breaking out of the loop) doesn't fetch the rest. With prefetch, each page is fetched
+        in the background while the caller works through the one before.
+
+        page_size is passed as the 'first' parameter; pass None for the few endpoints that don't
+        take one.
+        """
+        if params is None:
+            base_params: List[Tuple[str, Any]] = []
+        else:
+            base_params = list(params.items() if isinstance(params, dict) else params)
+        if page_size is not None:
+            base_params.append(('first', page_size))
+
+        def fetch(cursor: Optional[str]) -> Dict:
+            page_params = base_params + ([('after', cursor)] if cursor else [])
+            return self.helix_get(path, page_params, token_type, priority=priority)
+
+        next_page: Optional['concurrent.futures.Future[Dict]'] = None
+        try:
+            page = fetch(None)
+            while True:
+                # Some endpoints return a cursor even on the last page, but then it's empty.
+                cursor = page.get('pagination', {}).get('cursor') if page['data'] else None
+                if cursor and prefetch:
+                    next_page = self._batch_pool.submit(fetch, cursor)
+                yield from page['data']
+                if not cursor:
+                    return
+                page = next_page.result() if next_page is not None else fetch(cursor)
+                next_page = None
+        finally:
+            if next_page is not None:
+                next_page.cancel()
 
-    def helix_post(self, path: str, json: Dict[str, Any],
-                   token_type: Literal['user', 'app'] = 'user', expected_status: int = 200) -> Dict:
-        return self._helix('POST', path, token_type, expected_status, json=json)
+    def helix_post(self, path: str, json: Dict[str, Any], token_type: TokenType = 'user',
+                   expected_status: int = 200, priority: Priority = 'normal') -> Dict:
+        return self._helix('POST', path, token_type, expected_status, priority, json=json)
 
     def helix_patch(self, path: str, params: Dict[str, Any], json: Dict[str, Any],
-                    token_type: Literal['user', 'app'] = 'user',
-                    expected_status: int = 204) -> Dict:
-        return self._helix('PATCH', path, token_type, expected_status, params=params, json=json)
+                    token_type: TokenType = 'user', expected_status: int = 204,
+                    priority: Priority = 'normal') -> Dict:
+        return self._helix('PATCH', path, token_type, expected_status, priority, params=params,
+                           json=json)
 
-    def _helix(self, method: str, path: str, token_type: Literal['user', 'app'],
-               expected_status: int,
+    def _helix(self, method: str, path: str, token_type: TokenType, expected_status: int,
+               priority: Priority,
                params: Optional[Union[Dict[str, Any], List[Tuple[str, Any]]]] = None,
                json: Optional[Dict[str, Any]] = None) -> Dict:
         token = self.oauth.access_token if token_type == 'user' else self.oauth.app_access_token
         request = requests.Request(
-            method=method, url=f'https://api.twitch.tv/helix/{path}', params=params, json=json,
-            headers={
-                'Client-ID': secret.TWITCH_CLIENT_ID,
-                'Authorization': f'Bearer {token}',
-            })
-        with requests.Session() as s:
-            response = s.send(request.prepare())
+            method=method, url=f'{self.helix_url}/{path}', params=params, json=json,
+            headers={'Authorization': f'Bearer {token}'})
+        response = self._send_rate_limited(request, token_type, priority)
         if response.status_code == 401:
+            # Tokens are normally refreshed before they expire, but they can also be revoked.
             if token_type == 'user':
-                self.oauth.refresh()
+                self.oauth.refresh(failed_token=token)
                 token = self.oauth.access_token
             else:
-                self.oauth.refresh_app_access_token()
+                self.oauth.refresh_app_access_token(failed_token=token)
                 token = self.oauth.app_access_token
             request.headers['Authorization'] = f'Bearer {token}'
-            with requests.Session() as s:
-                response = s.send(request.prepare())
+            response = self._send_rate_limited(request, token_type, priority)
         if response.status_code != expected_status:
             logger.error(request.prepare())
             logger.error(
@@ -347,103 +661,113 @@ class TwitchUtil:
             return {}
         return response.json()
 
-    def mod(self, usernames: Union[str, List[str]]) -> None:
-        if isinstance(usernames, str):
-            usernames = [usernames]
-        self._irc_command_as_streamer([f'.mod {name}' for name in usernames], 'mod_success',
-                                      {'bad_mod_banned', 'bad_mod_mod'})
-
-    def unmod(self, usernames: Union[str, List[str]]) -> None:
-        if isinstance(usernames, str):
-            usernames = [usernames]
-        self._irc_command_as_streamer(
-            [f'.unmod {name}' for name in usernames], 'unmod_success', {'bad_unmod_mod'})
-
-    def vip(self, usernames: Union[str, List[str]]) -> None:
-        if isinstance(usernames, str):
-            usernames = [usernames]
-        self._irc_command_as_streamer([f'.vip {name}' for name in usernames], 'vip_success',
-                                      {'bad_vip_grantee_banned', 'bad_vip_grantee_already_vip',
-                                       'bad_vip_achievement_incomplete'})
-
-    def unvip(self, usernames: Union[str, List[str]]) -> None:
+    def _send_rate_limited(self, request: requests.Request, token_type: TokenType,
+                           priority: Priority) -> requests.Response:
+        rate_limit = self.rate_limits[token_type]
+        retries = 0
+        while True:
+            rate_limit.acquire(low_priority=priority == 'low')
+            response = self._send(request)
+            try:
+                rate_limit.update(int(response.headers['Ratelimit-Remaining']),
+                                  float(response.headers['Ratelimit-Reset']))
+            except (KeyError, ValueError):
+                if response.status_code == 429:
+                    # We know we're out, just not for how long.
+                    rate_limit.update(0, time.time() + 1)
+            if response.status_code != 429 or retries == HELIX_MAX_RATE_LIMIT_RETRIES:
+                return response
+            # The rate limit is now empty until the reset time, so the next acquire() waits it out.
+            logger.warning('Over the Helix rate limit: %s %s', request.method, request.url)
+            metrics.counter('helix.rate_limited').inc()
+            retries += 1
+
+    def _send(self, request: requests.Request) -> requests.Response:
+        prepared = self.session.prepare_request(request)
+        try:
+            return self.service.call(lambda: self.session.send(prepared, timeout=self.timeout),
+                                     idempotent=request.method == 'GET')
+        except requests.RequestException as e:
+            logger.error('%s %s: %s', request.method, request.url, e)
+            raise base.ServerError(f'{request.method} {request.url}: {e}') from e
+
+    def mod(self, usernames: Union[str, List[str]]) -> List['concurrent.futures.Future[str]']:
+        return self._irc_command_as_streamer('.mod', usernames, 'mod_success',
+                                             {'bad_mod_banned', 'bad_mod_mod'})
+
+    def unmod(self, usernames: Union[str, List[str]]) -> List['concurrent.futures.Future[str]']:
+        return self._irc_command_as_streamer('.unmod', usernames, 'unmod_success',
+                                             {'bad_unmod_mod'})
+
+    def vip(self, usernames: Union[str, List[str]]) -> List['concurrent.futures.Future[str]']:
+        return self._irc_command_as_streamer('.vip', usernames, 'vip_success',
+                                             {'bad_vip_grantee_banned',
+                                              'bad_vip_grantee_already_vip',
+                                              'bad_vip_achievement_incomplete'})
+
+    def unvip(self, usernames: Union[str, List[str]]) -> List['concurrent.futures.Future[str]']:
+        return self._irc_command_as_streamer('.unvip', usernames, 'unvip_success',
+                                             {'bad_unvip_grantee_not_vip'})
+
+    def _irc_command_as_streamer(
+            self, command: str, usernames: Union[str, List[str]], success_msg: str,
+            failure_msgs: Container[str]) -> List['concurrent.futures.Future[str]']:
+        """
+        Sends `command <username>` for each username, without waiting for the results. Failures are
+        logged by the session; callers that care can wait on the returned futures.
+        """
         if isinstance(usernames, str):
             usernames = [usernames]
-        self._irc_command_as_streamer([f'.unvip {name}' for name in usernames], 'unvip_success',
-                                      {'bad_unvip_grantee_not_vip'})
-
-    def _irc_command_as_streamer(self, commands: Union[str, List[str]], success_msg: str,
-                                 failure_msgs: Container[str], retry_on_error: bool = True) -> None:
-        if isinstance(commands, str):
-            commands = [commands]
-
-        channel = '#' + self.oauth.streamer_username.lower()
-        pubnotices: queue.Queue[str] = queue.Queue()
-        welcome = threading.Event()
-
-        def on_welcome(_c: client.ServerConnection, _e: client.Event) -> None:
-            welcome.set()
-
-        def on_pubnotice(_: client.ServerConnection, event: client.Event) -> None:
-            msg_ids = [i['value'] for i in event.tags if i['key'] == 'msg-id']
-            if not msg_ids:
-                return
-            if len(msg_ids) > 1:
-                logger.error('Multiple msg-id tags: %s', event)
-                # ... but continue anyway, and just use the first one.
-            pubnotices.put(msg_ids[0])
-
-        self.oauth.refresh()
-        reactor = client.Reactor()
-        connection = reactor.server().connect('irc.chat.twitch.tv', 6667,
-                                              self.oauth.streamer_username.lower(),
-                                              password=f'oauth:{self.oauth.access_token}')
-        connection.add_global_handler('welcome', on_welcome)
-        connection.add_global_handler('pubnotice', on_pubnotice)
-        reactor.process_once(timeout=5)
-        if not welcome.wait(timeout=5):
-            connection.disconnect()
-            if retry_on_error:
-                self._irc_command_as_streamer(
-                    commands, success_msg, failure_msgs, retry_on_error=False)
-                return
-            else:
-                raise base.ServerError('WELCOME not received.')
-        connection.cap('REQ', 'twitch.tv/commands', 'twitch.tv/tags')
-        connection.cap('END')
-        reactor.process_once(timeout=5)
-        for command in commands:
-            connection.privmsg(channel, command)
-            result = ''
-            unknown_msgs = []
-            deadline = (datetime.datetime.utcnow() + datetime.timedelta(seconds=10))
-            while result == '' and datetime.datetime.utcnow() < deadline:
-                timeout = deadline - datetime.datetime.utcnow()
-                reactor.process_once(timeout=timeout.total_seconds())
-                while True:
-                    try:
-                        msg = pubnotices.get_nowait()
-                    except queue.Empty:
-                        break
-                    if (msg == success_msg or msg in failure_msgs) and result == '':
-                        result = msg
-                    else:
-                        unknown_msgs.append(msg)
-            if result == success_msg:
-                logger.info('%s: success', command)
-            elif result:
-                logger.error('%s: %s', command, result)
-            else:
-                if unknown_msgs:
-                    logger.error('%s: No response. Unknown pubnotices: %s', command, unknown_msgs)
-                else:
-                    logger.error('%s: No response.')
-                if retry_on_error:
-                    connection.disconnect()
-                    self._irc_command_as_streamer(
-                        commands, success_msg, failure_msgs, retry_on_error=False)
-                    return
-        connection.disconnect()
+        with self._streamer_session_lock:
+            if self._streamer_session is None:
+                # If Twitch rejects the token (e.g. it was revoked), refresh it right away, rather
+                # than reconnecting with it until the hourly validation notices.
+                self._streamer_session = streamer_irc.StreamerIrcSession(
+                    self.streamer_username, lambda: self.oauth.access_token,
+                    on_auth_failure=lambda token: self.oauth.refresh(failed_token=token))
+        return [self._streamer_session.submit(f'{command} {name}', success_msg, failure_msgs)
+                for name in usernames]
+
+
+class AsyncTwitchUtil:
+    """
+    TwitchUtil for asyncio code. It shares everything with the TwitchUtil it wraps (auth, caches,
+    rate limits), but calls that need Helix run on a thread pool, so they don't block the event loop
+    while they wait. Answers that are already cached come straight back.
+    """
+
+    def __init__(self, util: TwitchUtil, max_workers: int = HELIX_BATCH_WORKERS) -> None:
+        self.util = util
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='AsyncTwitchUtil')
+
+    async def call(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Runs any blocking function (e.g. another TwitchUtil method) on the thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get_display_name(self, username: str) -> str:
+        user = self.util.users.get(username)
+        if user is not None:
+            return user.display_name
+        return await self.call(self.util.get_display_name, username)
+
+    async def get_channel_id(self, username: str) -> int:
+        user = self.util.users.get(username)
+        if user is not None:
+            return user.id
+        return await self.call(self.util.get_channel_id, username)
+
+    async def get_stream_data(
+            self, user_id: Optional[int] = None, username: Optional[str] = None) -> StreamData:
+        return await self.call(self.util.get_stream_data, user_id, username)
+
+    async def helix_get(self, path: str,
+                        params: Optional[Union[Dict[str, Any], List[Tuple[str, Any]]]] = None,
+                        token_type: TokenType = 'user', expected_status: int = 200,
+                        priority: Priority = 'normal') -> Dict:
+        return await self.call(self.util.helix_get, path, params, token_type, expected_status,
+                               priority)
 
 
 def nonce() -> str:
@@ -0,0 +1,166 @@
+"""
+A cache of Twitch user identities: which login goes with which user ID, and the user's display name.
+It's bounded (least recently used entries are dropped first), entries expire after a while in case
+the user changes their name, and it's saved in the database (in the background, in batches) so that
+it starts out warm.
+"""
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import attr
+
+from impbot.core import data
+from impbot.util import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE = 50_000
+# Users get renamed, and logins get reused by other users after that, so don't trust an entry
+# forever. Anyone who's chatting gets refreshed for free, so this mostly affects lurkers.
+TTL = datetime.timedelta(days=1)
+# Changes are saved to the database in batches, this long after the first one, so that chat (which
+# updates the cache for every message) never waits on a database write.
+FLUSH_DELAY = datetime.timedelta(seconds=5)
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class UserIdentity:
+    id: int
+    login: str
+    display_name: str
+    updated: float  # Unix time.
+
+
+class UserCache:
+    def __init__(self, max_size: int = MAX_SIZE, ttl: datetime.timedelta = TTL,
+                 clock: Callable[[], float] = time.time,
+                 flush_delay: Optional[datetime.timedelta] = FLUSH_DELAY) -> None:
+        """With flush_delay=None, changes are only saved when flush() is called."""
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+        self.clock = clock
+        self.flush_delay = flush_delay
+        self.data = data.Namespace('impbot.util.user_cache.UserCache')
+        self.lock = threading.Lock()
+        # Changes that haven't been saved yet: login -> JSON, or None to delete it.
+        self.unsaved: Dict[str, Optional[str]] = {}
+        self.flush_timer: Optional[threading.Timer] = None
+        # Keeps flushes in order, so that an older batch never overwrites a newer one.
+        self.flush_lock = threading.Lock()
+        # Keyed by login, least recently used first.
+        self.users: collections.OrderedDict[str, UserIdentity] = collections.OrderedDict()
+        self.logins_by_id: Dict[int, str] = {}
+        self.loaded = False
+
+    def _load(self) -> None:
+        # Call this with self.lock held. It's loaded lazily, since the database might not be set up
+        # yet when this is constructed.
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            saved = self.data.get_dict('users')
+        except KeyError:
+            return
+        users = []
+        for login, value in saved.items():
+            try:
+                fields = json.loads(value)
+                users.append(UserIdentity(int(fields['id']), login, fields['display_name'],
+                                          float(fields['updated'])))
+            except (ValueError, KeyError):
+                logger.warning('Ignoring malformed cached user %s: %s', login, value)
+        users.sort(key=lambda user: user.updated)
+        for user in users:
+            self._put(user, save=False)
+        logger.info('Loaded %d cached users.', len(self.users))
+
+    def get(self, login: str) -> Optional[UserIdentity]:
+        """Returns the user with this login, or None if they're not cached (or it's expired)."""
+        login = login.lower()
+        with self.lock:
+            self._load()
+            user = self.users.get(login)
+            if user is None or self.clock() - user.updated > self.ttl:
+                metrics.counter('user_cache.misses').inc()
+                return None
+            self.users.move_to_end(login)
+        metrics.counter('user_cache.hits').inc()
+        return user
+
+    def update(self, id: int, login: str, display_name: str) -> None:
+        """Records what we've just heard about a user, from Helix, chat or anywhere else."""
+        login = login.lower()
+        now = self.clock()
+        with self.lock:
+            self._load()
+            user = self.users.get(login)
+            # Writing to the database for every chat message would be a waste, so unless something
+            # changed, only do it once it's getting on for expiring.
+            save = (user is None or user.id != id or user.display_name != display_name or
+                    now - user.updated > self.ttl / 2)
+            if save:
+                user = UserIdentity(id, login, display_name, now)
+            else:
+                user = attr.evolve(user, updated=now)
+            self._put(user, save)
+
+    def _put(self, user: UserIdentity, save: bool) -> None:
+        # Call this with self.lock held.
+        old_login = self.logins_by_id.get(user.id)
+        if old_login is not None and old_login != user.login:
+            # They've been renamed.
+            self._remove(old_login)
+        old_user = self.users.get(user.login)
+        if old_user is not None and old_user.id != user.id:
+            # Someone else has this login now.
+            self._remove(user.login)
+        self.users[user.login] = user
+        self.users.move_to_end(user.login)
+        self.logins_by_id[user.id] = user.login
+        if save:
+            self._unsaved(user.login, json.dumps({
+                'id': user.id, 'display_name': user.display_name, 'updated': user.updated}))
+        while len(self.users) > self.max_size:
+            self._remove(next(iter(self.users)))
+
+    def _remove(self, login: str) -> None:
+        # Call this with self.lock held.
+        user = self.users.pop(login)
+        if self.logins_by_id.get(user.id) == login:
+            del self.logins_by_id[user.id]
+        self._unsaved(login, None)
+
+    def _unsaved(self, login: str, value: Optional[str]) -> None:
+        # Call this with self.lock held.
+        self.unsaved[login] = value
+        if self.flush_delay is not None and self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.flush_delay.total_seconds(), self._flush_later)
+            self.flush_timer.name = 'UserCache flush'
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_later(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            # It's only a cache: the worst case is that these users get looked up again later.
+            logger.exception('Saving cached users failed.')
+
+    def flush(self) -> None:
+        """Saves any unsaved changes to the database now."""
+        with self.flush_lock:
+            with self.lock:
+                unsaved, self.unsaved = self.unsaved, {}
+                self.flush_timer = None
+            if not unsaved:
+                return
+            self.data.set_subkeys(
+                'users', {login: value for login, value in unsaved.items() if value is not None},
+                unset=[login for login, value in unsaved.items() if value is None])
+            metrics.counter('user_cache.saved').inc(len(unsaved))